@@ -0,0 +1,140 @@
+import json
+import argparse
+
+import torch
+
+from time import time
+
+from entity_index import build_entity_index, ExactIndex, faiss
+from logger_config import logger
+
+parser = argparse.ArgumentParser(description='benchmark entity retrieval backends against exact search')
+parser.add_argument('--embeddings', default='', type=str, metavar='N',
+                    help='torch-saved entity embedding tensor (e.g. a wiki5m shard), random vectors if empty')
+parser.add_argument('--num-entities', default=100000, type=int, metavar='N',
+                    help='number of random entities if --embeddings is empty')
+parser.add_argument('--dim', default=768, type=int, metavar='N',
+                    help='embedding size of random entities')
+parser.add_argument('--num-queries', default=1000, type=int, metavar='N',
+                    help='number of queries')
+parser.add_argument('--topk', default='1,10,100', type=str,
+                    help='comma separated k values for recall@k')
+parser.add_argument('--index-types', default='ivf,hnsw,pq', type=str,
+                    help='comma separated approximate index types to compare against exact: ivf, hnsw, pq')
+parser.add_argument('--nlist', default=0, type=int,
+                    help='number of inverted lists for ivf, 0 means sqrt(#entities)')
+parser.add_argument('--nprobe', default='1,4,16,64', type=str,
+                    help='comma separated nprobe values for ivf')
+parser.add_argument('--ef-search', default='32,128,512', type=str,
+                    help='comma separated efSearch values for hnsw, values below the largest k are skipped')
+parser.add_argument('--pq-m', default=96, type=int,
+                    help='number of sub-quantizers for pq')
+parser.add_argument('--pq-rerank-k', default='100,300,1000', type=str,
+                    help='comma separated numbers of exactly re-scored candidates for pq')
+parser.add_argument('--seed', default=0, type=int,
+                    help='random seed')
+parser.add_argument('--output', default='', type=str,
+                    help='path to write the report as json')
+
+args = parser.parse_args()
+
+
+def _random_embeddings(num_entities: int, dim: int, num_clusters: int = 1000) -> torch.tensor:
+    # clustered data resembles trained embeddings much better than uniform random vectors
+    centers = torch.randn(num_clusters, dim)
+    assignments = torch.randint(num_clusters, (num_entities,))
+    vectors = centers[assignments] + 0.5 * torch.randn(num_entities, dim)
+    return torch.nn.functional.normalize(vectors, dim=1)
+
+
+def _load_queries(entities_tensor: torch.tensor, num_queries: int) -> torch.tensor:
+    # queries are perturbed entity vectors, similar to hr vectors that land close to their tails
+    query_ids = torch.randperm(entities_tensor.size(0))[:num_queries]
+    queries = entities_tensor[query_ids] + 0.1 * torch.randn(len(query_ids), entities_tensor.size(1))
+    return torch.nn.functional.normalize(queries, dim=1)
+
+
+def _recall(approx_indices: torch.tensor, exact_indices: torch.tensor, k: int) -> float:
+    hits = 0
+    for approx_row, exact_row in zip(approx_indices[:, :k].tolist(), exact_indices[:, :k].tolist()):
+        hits += len(set(approx_row) & set(exact_row))
+    return hits / exact_indices[:, :k].numel()
+
+
+def _timed_search(index, queries: torch.tensor, k: int):
+    start_time = time()
+    _, indices = index.search(queries, k)
+    return indices, time() - start_time
+
+
+def main():
+    torch.manual_seed(args.seed)
+    if args.embeddings:
+        entities_tensor = torch.load(args.embeddings, map_location=lambda storage, loc: storage).float()
+    else:
+        entities_tensor = _random_embeddings(args.num_entities, args.dim)
+    queries = _load_queries(entities_tensor, args.num_queries)
+    topk = [int(k) for k in args.topk.split(',')]
+    max_k = max(topk)
+    logger.info('Benchmark {} entities, {} queries, dim={}'.format(
+        entities_tensor.size(0), queries.size(0), entities_tensor.size(1)))
+
+    exact_indices, exact_secs = _timed_search(ExactIndex(entities_tensor), queries, max_k)
+    results = [{'index': 'exact', 'param': '', 'build_secs': 0.0,
+                'ms_per_query': round(1000 * exact_secs / queries.size(0), 4),
+                **{'recall@{}'.format(k): 1.0 for k in topk}}]
+
+    for index_type in args.index_types.split(','):
+        if index_type == 'ivf':
+            start_time = time()
+            index = build_entity_index(entities_tensor, index_type='ivf', nlist=args.nlist)
+            build_secs = time() - start_time
+            settings = [('nprobe={}'.format(nprobe), 'nprobe', int(nprobe)) for nprobe in args.nprobe.split(',')]
+        elif index_type == 'hnsw':
+            if faiss is None:
+                logger.info('Skip hnsw since faiss is not available')
+                continue
+            start_time = time()
+            index = build_entity_index(entities_tensor, index_type='hnsw')
+            build_secs = time() - start_time
+            settings = [('efSearch={}'.format(ef), 'ef_search', int(ef)) for ef in args.ef_search.split(',')]
+        elif index_type == 'pq':
+            start_time = time()
+            index = build_entity_index(entities_tensor, index_type='pq', pq_m=args.pq_m)
+            build_secs = time() - start_time
+            settings = [('rerank_k={}'.format(rerank_k), 'rerank_k', int(rerank_k))
+                        for rerank_k in args.pq_rerank_k.split(',')]
+        else:
+            assert False, 'Unknown index type: {}'.format(index_type)
+
+        for param, attr, value in settings:
+            if attr == 'ef_search' and value < max_k:
+                # the search would run with efSearch=max_k, the row would be mislabeled
+                logger.info('Skip hnsw {} below the largest k={}'.format(param, max_k))
+                continue
+            if attr == 'nprobe':
+                index.nprobe = min(value, index.nlist)
+            elif attr == 'rerank_k':
+                index.rerank_k = value
+            else:
+                index.ef_search = value
+            approx_indices, secs = _timed_search(index, queries, max_k)
+            result = {'index': index_type, 'param': param, 'build_secs': round(build_secs, 3),
+                      'ms_per_query': round(1000 * secs / queries.size(0), 4)}
+            for k in topk:
+                result['recall@{}'.format(k)] = round(_recall(approx_indices, exact_indices, k), 4)
+            results.append(result)
+            logger.info(json.dumps(result))
+
+    header = list(results[0].keys())
+    print('\t'.join(header))
+    for result in results:
+        print('\t'.join(str(result[key]) for key in header))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as writer:
+            json.dump(results, writer, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+import os
+import sys
+import json
+import random
+import argparse
+import subprocess
+
+import torch
+
+from time import time
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from synthetic_kg import generate_kg, kg_vocab
+from logger_config import logger
+
+parser = argparse.ArgumentParser(description='benchmark the data, training and evaluation pipeline on synthetic graphs')
+parser.add_argument('--scales', default='1000,10000,100000,1000000,10000000', type=str,
+                    help='comma separated numbers of triplets, every scale runs in its own process')
+parser.add_argument('--data-dir', default='data/synthetic', type=str,
+                    help='directory of generated graphs and the tiny BERT model, reused if present')
+parser.add_argument('--num-relations', default=50, type=int,
+                    help='number of relations of generated graphs')
+parser.add_argument('--multi-tail-ratio', default=0.3, type=float,
+                    help='fraction of one-to-many relations of generated graphs')
+parser.add_argument('--num-words', default=5000, type=int,
+                    help='vocabulary size of generated names and descriptions')
+parser.add_argument('--hidden-size', default=64, type=int,
+                    help='hidden size of the randomly initialized BERT')
+parser.add_argument('--num-layers', default=2, type=int,
+                    help='number of layers of the randomly initialized BERT')
+parser.add_argument('--max-num-tokens', default=50, type=int,
+                    help='maximum number of tokens')
+parser.add_argument('-b', '--batch-size', default=256, type=int,
+                    help='batch size of collate and training steps')
+parser.add_argument('--num-vectorize', default=4096, type=int,
+                    help='number of sampled training examples to vectorize and collate')
+parser.add_argument('--num-train-steps', default=5, type=int,
+                    help='number of timed training steps')
+parser.add_argument('--num-encode-entities', default=100000, type=int,
+                    help='maximum number of entities encoded by predict_by_entities, '
+                         'the remaining entity vectors for ranking are random')
+parser.add_argument('--num-queries', default=2048, type=int,
+                    help='number of validation queries for compute_metrics and rerank_by_graph')
+parser.add_argument('--eval-batch-size', default=256, type=int,
+                    help='number of queries scored against all entities at once')
+parser.add_argument('--neighbor-weight', default=0.05, type=float,
+                    help='weight of rerank_by_graph')
+parser.add_argument('--rerank-n-hop', default=2, type=int,
+                    help='n-hop of rerank_by_graph')
+parser.add_argument('--use-link-graph', action='store_true',
+                    help='add neighbor names to short descriptions in vectorize')
+parser.add_argument('-j', '--workers', default=1, type=int,
+                    help='number of data loading workers')
+parser.add_argument('--seed', default=0, type=int,
+                    help='random seed')
+parser.add_argument('--output', default='', type=str,
+                    help='path of the json report, <data-dir>/bench_report.json if empty')
+
+
+def _read_proc_status() -> dict:
+    # current and peak resident set size in MB
+    status = {}
+    with open('/proc/self/status', 'r') as reader:
+        for line in reader:
+            key, value = line.split(':', 1)
+            if key in ['VmRSS', 'VmHWM']:
+                status[key] = round(int(value.split()[0]) / 1024, 1)
+    return status
+
+
+def _reset_peak_rss() -> bool:
+    # writing 5 to clear_refs resets VmHWM to the current RSS (Linux >= 4.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as writer:
+            writer.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class StageRecorder:
+    """Wall-clock time and memory of benchmark stages of one process.
+    rss_delta_mb is the resident set size growth over the stage, peak_rss_mb its high-water mark
+    during the stage, or since process start if the kernel does not allow resetting it.
+    Memory of DataLoader worker processes is not included."""
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def measure(self, name: str):
+        stage = {}
+        peak_reset = _reset_peak_rss()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        rss_before = _read_proc_status()['VmRSS']
+        start_time = time()
+        yield stage
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        secs = stage.pop('secs', time() - start_time)
+        status = _read_proc_status()
+        record = {'secs': round(secs, 4), 'rss_mb': status['VmRSS'],
+                  'rss_delta_mb': round(status['VmRSS'] - rss_before, 1),
+                  'peak_rss_mb': status['VmHWM'], 'peak_rss_reset': peak_reset}
+        if torch.cuda.is_available():
+            record['cuda_peak_mb'] = round(torch.cuda.max_memory_allocated() / 1024 ** 2, 1)
+        if 'items' in stage:
+            record['items_per_sec'] = round(stage['items'] / max(secs, 1e-9), 1)
+        record.update(stage)
+        self.stages[name] = record
+        logger.info('Stage {}: {}'.format(name, json.dumps(record)))
+
+
+def run_worker(options: dict, report_path: str):
+    """Run every stage once on the graph given by the SimKGC arguments in sys.argv."""
+    from config import args
+    from dict_hub import get_entity_dict, get_train_triplet_dict, get_all_triplet_dict, get_link_graph
+
+    random.seed(options['seed'])
+    torch.manual_seed(options['seed'])
+    recorder = StageRecorder()
+
+    # the lazily built globals are loaded in their own stages, before the modules that use them are imported
+    with recorder.measure('entity_dict') as stage:
+        stage['items'] = len(get_entity_dict())
+    with recorder.measure('train_triplet_dict') as stage:
+        stage['items'] = get_train_triplet_dict().triplet_cnt
+    with recorder.measure('all_triplet_dict') as stage:
+        stage['items'] = len(get_all_triplet_dict())
+    with recorder.measure('link_graph') as stage:
+        stage['items'] = len(get_link_graph())
+
+    from doc import load_data, collate, BATCH_CPU_KEYS
+    from triplet_mask import construct_mask_by_indices, construct_self_negative_mask_by_indices
+    from models import build_model, ModelOutput
+    from predict import BertPredictor
+    from rerank import rerank_by_graph, RerankSetting
+    from utils import move_to_cuda, get_model_obj
+    import evaluate
+
+    with recorder.measure('load_data') as stage:
+        examples = load_data(args.train_path, add_forward_triplet=True, add_backward_triplet=True)
+        stage['items'] = len(examples)
+
+    sample = random.sample(examples, min(options['num_vectorize'], len(examples)))
+    with recorder.measure('vectorize') as stage:
+        vectorized = [ex.vectorize() for ex in sample]
+        stage['items'] = len(vectorized)
+
+    chunks = [vectorized[start:(start + args.batch_size)] for start in range(0, len(vectorized), args.batch_size)]
+    with recorder.measure('collate') as stage:
+        batches = [collate(chunk) for chunk in chunks]
+        stage['items'] = len(vectorized)
+
+    with recorder.measure('construct_mask') as stage:
+        for batch_dict in batches:
+            construct_mask_by_indices(batch_dict['head_idxs'], batch_dict['relation_idxs'], batch_dict['tail_idxs'])
+            construct_self_negative_mask_by_indices(batch_dict['head_idxs'], batch_dict['relation_idxs'])
+        stage['items'] = len(vectorized)
+
+    model = build_model(args)
+    if torch.cuda.is_available():
+        model.cuda()
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=args.lr)
+    criterion = torch.nn.CrossEntropyLoss()
+
+    def _train_step(batch_dict: dict):
+        model.train()
+        if torch.cuda.is_available():
+            batch_dict = move_to_cuda(batch_dict, cpu_keys=BATCH_CPU_KEYS)
+        batch_size = batch_dict['hr_token_ids'].size(0)
+        outputs = get_model_obj(model).compute_logits(output_dict=model(**batch_dict), batch_dict=batch_dict)
+        outputs = ModelOutput(**outputs)
+        loss = criterion(outputs.logits, outputs.labels)
+        loss += criterion(outputs.logits[:, :batch_size].t(), outputs.labels)
+        optimizer.zero_grad()
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(model.parameters(), args.grad_clip)
+        optimizer.step()
+
+    # the first step allocates optimizer states and is not timed
+    _train_step(batches[0])
+    with recorder.measure('train_step') as stage:
+        for step in range(options['num_train_steps']):
+            _train_step(batches[step % len(batches)])
+        stage['items'] = options['num_train_steps']
+
+    args.is_test = True
+    predictor = BertPredictor()
+    predictor.model = model.eval()
+    predictor.use_cuda = torch.cuda.is_available()
+    entity_dict = evaluate.get_eval_entity_dict()
+    entity_exs = entity_dict.entity_exs[:options['num_encode_entities']]
+    with recorder.measure('predict_by_entities') as stage:
+        entity_tensor = predictor.predict_by_entities(entity_exs)
+        stage['items'] = len(entity_exs)
+    if len(entity_exs) < len(entity_dict):
+        random_tensor = torch.nn.functional.normalize(
+            torch.randn(len(entity_dict) - len(entity_exs), entity_tensor.size(1)), dim=1)
+        entity_tensor = torch.cat([entity_tensor, random_tensor.to(entity_tensor.device)], dim=0)
+
+    queries = load_data(args.valid_path, add_forward_triplet=True, add_backward_triplet=True)
+    queries = queries[:options['num_queries']]
+    hr_tensor, _ = predictor.predict_by_examples(queries)
+    target = [entity_dict.entity_to_idx(ex.tail_id) for ex in queries]
+
+    with recorder.measure('tail_csr') as stage:
+        stage['items'] = len(evaluate._get_tail_csr().keys)
+    with recorder.measure('compute_metrics') as stage:
+        evaluate.compute_metrics(hr_tensor=hr_tensor, entities_tensor=entity_tensor, target=target,
+                                 examples=queries, k=3, batch_size=options['eval_batch_size'])
+        stage['items'] = len(queries)
+
+    setting = RerankSetting('hop', options['neighbor_weight'], options['rerank_n_hop'])
+    with recorder.measure('rerank_by_graph') as stage:
+        # only re-ranking is timed, not the score matrix it is applied to
+        rerank_secs = 0.0
+        for start in range(0, len(queries), options['eval_batch_size']):
+            end = start + options['eval_batch_size']
+            batch_score = torch.mm(hr_tensor[start:end], entity_tensor.t())
+            start_time = time()
+            rerank_by_graph(batch_score, queries[start:end], entity_dict=entity_dict, setting=setting)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            rerank_secs += time() - start_time
+        stage['secs'] = rerank_secs
+        stage['items'] = len(queries)
+
+    with open(report_path, 'w', encoding='utf-8') as writer:
+        json.dump(recorder.stages, writer, indent=4)
+
+
+def _build_tiny_bert(model_dir: str, vocab: list, hidden_size: int, num_layers: int, max_num_tokens: int):
+    from transformers import BertConfig, BertModel, BertTokenizer
+
+    os.makedirs(model_dir, exist_ok=True)
+    vocab_path = os.path.join(model_dir, 'vocab.txt')
+    with open(vocab_path, 'w', encoding='utf-8') as writer:
+        writer.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', ':', 'inverse'] + vocab) + '\n')
+    config = BertConfig(vocab_size=len(vocab) + 7, hidden_size=hidden_size, num_hidden_layers=num_layers,
+                        num_attention_heads=max(1, hidden_size // 32), intermediate_size=4 * hidden_size,
+                        max_position_embeddings=max(max_num_tokens, 64))
+    BertModel(config).save_pretrained(model_dir)
+    BertTokenizer(vocab_path).save_pretrained(model_dir)
+
+
+def _run_scale(args, num_triplets: int, model_dir: str) -> dict:
+    graph_dir = os.path.join(args.data_dir, 'kg_{}'.format(num_triplets))
+    stats_path = os.path.join(graph_dir, 'stats.json')
+    if os.path.exists(stats_path):
+        stats = json.load(open(stats_path, 'r', encoding='utf-8'))
+    else:
+        stats = generate_kg(graph_dir, num_triplets, num_relations=args.num_relations,
+                            multi_tail_ratio=args.multi_tail_ratio, num_words=args.num_words, seed=args.seed)
+
+    options = {key: getattr(args, key) for key in
+               ['num_vectorize', 'num_train_steps', 'num_encode_entities', 'num_queries', 'eval_batch_size',
+                'neighbor_weight', 'rerank_n_hop', 'seed']}
+    simkgc_args = ['--task', 'synthetic', '--pretrained-model', model_dir,
+                   '--train-path', os.path.join(graph_dir, 'train.txt.json'),
+                   '--valid-path', os.path.join(graph_dir, 'valid.txt.json'),
+                   '--model-dir', os.path.join(graph_dir, 'bench'), '--metrics-file', '',
+                   '--batch-size', str(args.batch_size), '--max-num-tokens', str(args.max_num_tokens),
+                   '--workers', str(args.workers), '--use-self-negative', '--finetune-t']
+    if args.use_link_graph:
+        simkgc_args.append('--use-link-graph')
+
+    report_path = os.path.join(graph_dir, 'bench_stages.json')
+    if os.path.exists(report_path):
+        os.remove(report_path)
+    start_time = time()
+    # config.py parses sys.argv on import, so every scale gets a fresh process with its own arguments
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), 'worker', report_path,
+                              json.dumps(options)] + simkgc_args)
+    result = {'num_triplets': num_triplets, 'graph': stats, 'total_secs': round(time() - start_time, 3)}
+    if process.returncode != 0 or not os.path.exists(report_path):
+        # e.g. killed for running out of memory, larger scales are still attempted
+        result['error'] = 'worker exited with code {}'.format(process.returncode)
+    else:
+        result['stages'] = json.load(open(report_path, 'r', encoding='utf-8'))
+    return result
+
+
+def main():
+    args = parser.parse_args()
+    scales = [int(float(scale)) for scale in args.scales.split(',')]
+    model_dir = os.path.join(args.data_dir, 'tiny_bert_h{}_l{}'.format(args.hidden_size, args.num_layers))
+    if not os.path.exists(os.path.join(model_dir, 'config.json')):
+        _build_tiny_bert(model_dir, kg_vocab(args.num_words, args.num_relations),
+                         hidden_size=args.hidden_size, num_layers=args.num_layers,
+                         max_num_tokens=args.max_num_tokens)
+
+    results = []
+    for num_triplets in scales:
+        logger.info('Benchmark {} triplets'.format(num_triplets))
+        results.append(_run_scale(args, num_triplets, model_dir))
+
+    stage_names = []
+    for result in results:
+        stage_names += [name for name in result.get('stages', {}) if name not in stage_names]
+    print('\t'.join(['stage'] + ['secs / peak_rss_mb @ {}'.format(result['num_triplets']) for result in results]))
+    for name in stage_names:
+        cells = []
+        for result in results:
+            stage = result.get('stages', {}).get(name)
+            cells.append('{} / {}'.format(stage['secs'], stage['peak_rss_mb']) if stage else '-')
+        print('\t'.join([name] + cells))
+
+    output = args.output or os.path.join(args.data_dir, 'bench_report.json')
+    with open(output, 'w', encoding='utf-8') as writer:
+        json.dump({'settings': vars(args), 'results': results}, writer, indent=4)
+    logger.info('Write benchmark report to {}'.format(output))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        # bench_pipeline.py worker <report path> <options json> <SimKGC arguments>
+        report_path, options = sys.argv[2], json.loads(sys.argv[3])
+        sys.argv = sys.argv[:1] + sys.argv[4:]
+        run_worker(options, report_path)
+    else:
+        main()
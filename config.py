@@ -4,6 +4,8 @@ import torch
 import argparse
 import warnings
 
+from typing import List
+
 import torch.backends.cudnn as cudnn
 
 parser = argparse.ArgumentParser(description='SimKGC arguments')
@@ -50,6 +52,31 @@ parser.add_argument('--max-num-tokens', default=50, type=int,
 parser.add_argument('--use-self-negative', action='store_true',
                     help='use head entity as negative')
 
+parser.add_argument('--profile', action='store_true',
+                    help='time every phase of training steps and report throughput at print frequency')
+parser.add_argument('--profile-trace-steps', default='', type=str,
+                    help='start,end global steps to capture a torch.profiler trace for, written to model dir')
+parser.add_argument('--no-snapshot-cache', action='store_true',
+                    help='always build entity / triplet dicts and link graph from json, without binary snapshots')
+parser.add_argument('--snapshot-dir', default='', type=str,
+                    help='directory of binary snapshots of entity / triplet dicts and link graph, '
+                         '.snapshots next to the data if empty')
+parser.add_argument('--memory-report', action='store_true',
+                    help='report memory of global data structures at start and of DataLoader workers at print frequency')
+parser.add_argument('--metrics-file', default='metrics.jsonl', type=str,
+                    help='JSONL time series of training / evaluation metrics in model dir, empty to disable')
+parser.add_argument('--prometheus-file', default='', type=str,
+                    help='path of a Prometheus text-file exporter with the latest metrics, empty to disable')
+parser.add_argument('--resume', action='store_true',
+                    help='continue training from the training state saved in model dir at the last evaluation')
+parser.add_argument('--eval-rank-sample', default=0, type=int,
+                    help='number of validation triplets sampled for full ranking MRR / Hits@k during training, 0 to disable')
+parser.add_argument('--entity-cache-budget-secs', default=60.0, type=float,
+                    help='time budget to re-encode stale untouched entities at every full ranking evaluation')
+parser.add_argument('--best-metric', default='Acc@1', type=str,
+                    help='validation metric used to select model_best: Acc@1, or mrr / hit@k / mean_rank '
+                         'from full ranking evaluation (requires --eval-rank-sample)')
+
 parser.add_argument('-j', '--workers', default=1, type=int, metavar='N',
                     help='number of data loading workers')
 parser.add_argument('--epochs', default=10, type=int, metavar='N',
@@ -78,36 +105,114 @@ parser.add_argument('--rerank-n-hop', default=2, type=int,
                     help='use n-hops node for re-ranking entities, only used during evaluation')
 parser.add_argument('--neighbor-weight', default=0.0, type=float,
                     help='weight for re-ranking entities')
+parser.add_argument('--rerank-mode', default='hop', type=str,
+                    help='re-ranking strategy: hop (flat boost within n hops) or ppr (personalized PageRank)')
+parser.add_argument('--ppr-alpha', default=0.15, type=float,
+                    help='restart probability of personalized PageRank re-ranking')
+parser.add_argument('--ppr-iters', default=3, type=int,
+                    help='number of random walk steps of personalized PageRank re-ranking')
+parser.add_argument('--ppr-topk', default=1000, type=int,
+                    help='number of entities kept per query after every personalized PageRank step')
+parser.add_argument('--ppr-max-degree', default=100, type=int,
+                    help='maximum number of neighbours per node used by personalized PageRank')
+parser.add_argument('--rerank-sweep', action='store_true',
+                    help='evaluate a grid of re-ranking settings against the same scores and write one table')
+parser.add_argument('--sweep-neighbor-weights', default='0,0.01,0.05,0.1', type=str,
+                    help='comma separated neighbor weights for --rerank-sweep')
+parser.add_argument('--sweep-n-hops', default='1,2,3', type=str,
+                    help='comma separated n-hop values for --rerank-sweep')
+parser.add_argument('--sweep-rerank-modes', default='hop', type=str,
+                    help='comma separated re-ranking modes for --rerank-sweep')
+parser.add_argument('--rerank-cache-mb', default=1024, type=int,
+                    help='memory cap in MB for cached n-hop neighbourhoods used by re-ranking')
 parser.add_argument('--eval-model-path', default='', type=str, metavar='N',
                     help='path to model, only used for evaluation')
+parser.add_argument('--eval-model-glob', default='', type=str, metavar='N',
+                    help='glob of checkpoints of one training run to evaluate and compare in one process')
+parser.add_argument('--hits-at', default='1,3,10', type=str,
+                    help='comma separated cutoffs k for Hits@k metrics')
+parser.add_argument('--pred-format', default='jsonl', type=str,
+                    help='format of the eval_* prediction files: jsonl, json (array) or none')
+parser.add_argument('--pred-topk', default=3, type=int,
+                    help='number of top predicted entities kept per prediction record')
+parser.add_argument('--pred-fields', default='', type=str,
+                    help='comma separated fields of prediction records, all fields if empty')
+parser.add_argument('--entity-index', default='exact', type=str,
+                    help='retrieval backend over entity embeddings: exact, ivf, hnsw or pq')
+parser.add_argument('--index-nlist', default=0, type=int,
+                    help='number of inverted lists for ivf index, 0 means sqrt(#entities)')
+parser.add_argument('--index-nprobe', default=16, type=int,
+                    help='number of inverted lists probed per query for ivf index')
+parser.add_argument('--index-search-k', default=1000, type=int,
+                    help='number of candidates retrieved per query by approximate indexes')
+parser.add_argument('--pq-m', default=96, type=int,
+                    help='number of sub-quantizers (bytes per entity) for pq index')
+parser.add_argument('--pq-rerank-k', default=300, type=int,
+                    help='number of pq candidates re-scored exactly from the full-precision entity store')
+parser.add_argument('--index-compare-exact', action='store_true',
+                    help='also run exact search and report metric differences of the approximate index')
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    """Parse and check SimKGC arguments from argv, sys.argv by default.
+    Also creates model_dir and seeds the random number generators."""
+    args = parser.parse_args(argv)
+
+    print(args.train_path)
+    assert not args.train_path or os.path.exists(args.train_path)
+    assert args.pooling in ['cls', 'mean', 'max']
+    # assert args.task.lower() in ['wn18rr', 'fb15k237', 'wiki5m_ind', 'wiki5m_trans']
+    assert args.lr_scheduler in ['linear', 'cosine']
+    assert args.entity_index in ['exact', 'ivf', 'hnsw', 'pq']
+    assert args.rerank_mode in ['hop', 'ppr']
+    assert args.pred_format in ['jsonl', 'json', 'none']
+    assert args.best_metric == 'Acc@1' or args.eval_rank_sample > 0, '--best-metric {} requires --eval-rank-sample'.format(
+        args.best_metric)
+
+    if args.model_dir:
+        os.makedirs(args.model_dir, exist_ok=True)
+    elif args.eval_model_glob:
+        args.model_dir = os.path.dirname(args.eval_model_glob)
+    else:
+        assert os.path.exists(args.eval_model_path), 'One of args.model_dir and args.eval_model_path should be valid path'
+        args.model_dir = os.path.dirname(args.eval_model_path)
+
+    if args.seed is not None:
+        random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        cudnn.deterministic = True
+
+    try:
+        if args.use_amp:
+            from torch.cuda import amp
+    except Exception:
+        args.use_amp = False
+        warnings.warn('AMP training is not available, set use_amp=False')
+
+    if not torch.cuda.is_available():
+        args.use_amp = False
+        warnings.warn('GPU is not available, set use_amp=False')
+    return args
+
+
+def _context_args() -> argparse.Namespace:
+    from dict_hub import get_context
+    return get_context().args
+
+
+class _ContextArgs:
+    """Stands for the arguments of the default runtime context (dict_hub.get_context).
+    Modules can keep `from config import args`, sys.argv is only parsed when an argument is first read."""
+
+    def __getattr__(self, name):
+        return getattr(_context_args(), name)
+
+    def __setattr__(self, name, value):
+        setattr(_context_args(), name, value)
+
+    @property
+    def __dict__(self):
+        return _context_args().__dict__
+
 
-args = parser.parse_args()
-
-print(args.train_path)
-assert not args.train_path or os.path.exists(args.train_path)
-assert args.pooling in ['cls', 'mean', 'max']
-# assert args.task.lower() in ['wn18rr', 'fb15k237', 'wiki5m_ind', 'wiki5m_trans']
-assert args.lr_scheduler in ['linear', 'cosine']
-
-if args.model_dir:
-    os.makedirs(args.model_dir, exist_ok=True)
-else:
-    assert os.path.exists(args.eval_model_path), 'One of args.model_dir and args.eval_model_path should be valid path'
-    args.model_dir = os.path.dirname(args.eval_model_path)
-
-if args.seed is not None:
-    random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    cudnn.deterministic = True
-
-try:
-    if args.use_amp:
-        import torch.cuda.amp
-except Exception:
-    args.use_amp = False
-    warnings.warn('AMP training is not available, set use_amp=False')
-
-if not torch.cuda.is_available():
-    args.use_amp = False
-    args.print_freq = 1
-    warnings.warn('GPU is not available, set use_amp=False and print_freq=1')
+args = _ContextArgs()
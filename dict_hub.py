@@ -1,82 +1,162 @@
 import os
 import glob
+import argparse
 
-from transformers import AutoTokenizer
+import numpy as np
+
+from typing import List, Callable
 
-from config import args
 from triplet import TripletDict, EntityDict, LinkGraph
+from snapshot import load_or_build
 from logger_config import logger
 
-# Global variables
-
-# TripletDicts contain dictionaries of the form {(head_id, relation): {tail_id1, tail_id2, ...}}
-train_triplet_dict: TripletDict = None
-all_triplet_dict: TripletDict = None
-
-# LinkGraphs are built as a dictionary where each key is a tuple (head_id, relation) and the value is a set of tail ids.
-# These are used along with the entity dictionary represent the graph structure.
-# EntityDicts store information about entities, such as their id, name, and description, and can be queried by id, index, or value (to get the id or index)
-link_graph: LinkGraph = None
-entity_dict: EntityDict = None
-
-# Tokenizer for the model
-# The tokenizer is built from the pretrained model specified in the config
-tokenizer: AutoTokenizer = None
-
-
-def _init_entity_dict():
-    global entity_dict
-    if not entity_dict:
-        entity_dict = EntityDict(entity_dict_dir=os.path.dirname(args.valid_path))
-
 
-def _init_train_triplet_dict():
-    global train_triplet_dict
-    if not train_triplet_dict:
-        train_triplet_dict = TripletDict(path_list=[args.train_path])
+class RuntimeContext:
+    """Arguments, tokenizer and data structures of one run. Nothing is loaded when a context is created,
+    every structure is built from args on first access and then kept:
+
+    # TripletDicts map every (head_id, relation) to its known tails, as sorted integer arrays
+    train_triplet_dict, all_triplet_dict
+
+    # LinkGraphs hold the neighbor ids of every entity in the training triplets.
+    # These are used along with the entity dictionary represent the graph structure.
+    link_graph
+
+    # EntityDicts store information about entities, such as their id, name, and description,
+    # and can be queried by id, index, or value (to get the id or index)
+    entity_dict
+
+    # train_triplet_dict entity index of every entity_dict index, -1 for entities without training triplets,
+    # to look up batches of entity indices in the train_triplet_dict
+    train_entity_map
+
+    # Tokenizer for the model, built from args.pretrained_model unless build_tokenizer is called first
+    tokenizer
+
+    Without args, sys.argv is parsed by config.parse_args on first access.
+    Data structures are loaded from binary snapshots next to the data when these are fresh, see snapshot.py.
+    Functions that use these take an optional ctx and fall back to the process-wide default context
+    of get_context(), which is the only one command line scripts use."""
+
+    def __init__(self, args: argparse.Namespace = None):
+        self._args = args
+        self._tokenizer = None
+        self._entity_dict: EntityDict = None
+        self._train_triplet_dict: TripletDict = None
+        self._all_triplet_dict: TripletDict = None
+        self._link_graph: LinkGraph = None
+        self._train_entity_map: np.ndarray = None
+
+    @property
+    def args(self) -> argparse.Namespace:
+        if self._args is None:
+            from config import parse_args
+            self._args = parse_args()
+        return self._args
 
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self.build_tokenizer(self.args.pretrained_model)
+        return self._tokenizer
 
-def _init_all_triplet_dict():
-    global all_triplet_dict
-    if not all_triplet_dict:
-        path_pattern = '{}/*.txt.json'.format(os.path.dirname(args.train_path))
-        all_triplet_dict = TripletDict(path_list=glob.glob(path_pattern))
+    def build_tokenizer(self, pretrained_model: str):
+        if self._tokenizer is None:
+            # transformers is only imported by contexts that tokenize
+            from transformers import AutoTokenizer
+            self._tokenizer = AutoTokenizer.from_pretrained(pretrained_model)
+            logger.info('Build tokenizer from {}'.format(pretrained_model))
 
+    def load_or_build(self, cls: type, source_paths: List[str], build: Callable):
+        """snapshot.load_or_build with the snapshot arguments of this context."""
+        return load_or_build(cls, source_paths, build, snapshot_dir=self.args.snapshot_dir,
+                             enabled=not self.args.no_snapshot_cache)
 
-def _init_link_graph():
-    global link_graph
-    if not link_graph:
-        link_graph = LinkGraph(train_path=args.train_path)
+    @property
+    def entity_dict(self) -> EntityDict:
+        if self._entity_dict is None:
+            entity_dict_dir = os.path.dirname(self.args.valid_path)
+            self._entity_dict = self.load_or_build(EntityDict, [os.path.join(entity_dict_dir, 'entities.json')],
+                                                   lambda: EntityDict(entity_dict_dir=entity_dict_dir))
+        return self._entity_dict
 
+    @property
+    def train_triplet_dict(self) -> TripletDict:
+        if self._train_triplet_dict is None:
+            path_list = [self.args.train_path]
+            self._train_triplet_dict = self.load_or_build(TripletDict, path_list,
+                                                          lambda: TripletDict(path_list=path_list))
+        return self._train_triplet_dict
 
-def get_entity_dict():
-    _init_entity_dict()
-    return entity_dict
+    @property
+    def all_triplet_dict(self) -> TripletDict:
+        if self._all_triplet_dict is None:
+            path_pattern = '{}/*.txt.json'.format(os.path.dirname(self.args.train_path))
+            path_list = sorted(glob.glob(path_pattern))
+            self._all_triplet_dict = self.load_or_build(TripletDict, path_list,
+                                                        lambda: TripletDict(path_list=path_list))
+        return self._all_triplet_dict
 
+    @property
+    def link_graph(self) -> LinkGraph:
+        if self._link_graph is None:
+            self._link_graph = self.load_or_build(LinkGraph, [self.args.train_path],
+                                                  lambda: LinkGraph(train_path=self.args.train_path))
+        return self._link_graph
 
-def get_train_triplet_dict():
-    _init_train_triplet_dict()
-    return train_triplet_dict
+    @property
+    def train_entity_map(self) -> np.ndarray:
+        if self._train_entity_map is None:
+            self._train_entity_map = np.array([self.train_triplet_dict.entity_to_idx(entity_id)
+                                               for entity_id in self.entity_dict.ids.to_list()], dtype=np.int64)
+        return self._train_entity_map
+
+    def preload(self, *names: str):
+        """Build the named structures now, e.g. before DataLoader workers are forked,
+        so that they share them instead of each building its own."""
+        for name in names:
+            getattr(self, name)
+
+    def get_loaded(self, name: str):
+        """The named structure if it was built already, None otherwise."""
+        return getattr(self, '_' + name)
+
+
+default_context: RuntimeContext = None
+
+
+def get_context() -> RuntimeContext:
+    global default_context
+    if default_context is None:
+        default_context = RuntimeContext()
+    return default_context
+
+
+def set_context(ctx: RuntimeContext):
+    """Make ctx the default context, e.g. RuntimeContext(args=config.parse_args(argv)) when used as a library."""
+    global default_context
+    default_context = ctx
+
+
+def get_entity_dict() -> EntityDict:
+    return get_context().entity_dict
+
+
+def get_train_triplet_dict() -> TripletDict:
+    return get_context().train_triplet_dict
 
 
-def get_all_triplet_dict():
-    _init_all_triplet_dict()
-    return all_triplet_dict
+def get_all_triplet_dict() -> TripletDict:
+    return get_context().all_triplet_dict
 
 
-def get_link_graph():
-    _init_link_graph()
-    return link_graph
+def get_link_graph() -> LinkGraph:
+    return get_context().link_graph
 
 
 def build_tokenizer(args):
-    global tokenizer
-    if tokenizer is None:
-        tokenizer = AutoTokenizer.from_pretrained(args.pretrained_model)
-        logger.info('Build tokenizer from {}'.format(args.pretrained_model))
+    get_context().build_tokenizer(args.pretrained_model)
 
 
 def get_tokenizer():
-    if tokenizer is None:
-        build_tokenizer(args)
-    return tokenizer
+    return get_context().tokenizer
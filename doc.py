@@ -3,44 +3,56 @@ import json
 import torch
 import torch.utils.data.dataset
 
+import numpy as np
+
+from time import time
 from typing import Optional, List
+from collections.abc import Sequence
 
-from config import args
 from triplet import reverse_triplet
-from triplet_mask import construct_mask, construct_self_negative_mask
-from dict_hub import get_entity_dict, get_link_graph, get_tokenizer
+from triplet_mask import example_indices, construct_mask_by_indices, construct_self_negative_mask_by_indices
+from dict_hub import get_context, RuntimeContext
 from logger_config import logger
 
-entity_dict = get_entity_dict()
-# the link_graph is used during the reranking process, which is optional but
-# improved performance in target prediction by boosting similarity scores
-# of nodes nearby the head
-if args.use_link_graph:
-    # make the lazy data loading happen
-    get_link_graph()
+
+def preload_for_workers(ctx: RuntimeContext = None):
+    """Build everything vectorize and collate read before DataLoader workers are forked,
+    so that the workers share it instead of each loading its own copy."""
+    ctx = ctx or get_context()
+    ctx.preload('tokenizer', 'entity_dict')
+    # the link_graph is used to add neighbor names to short descriptions
+    if ctx.args.use_link_graph:
+        ctx.preload('link_graph')
+    if not ctx.args.is_test:
+        ctx.preload('train_triplet_dict', 'train_entity_map')
+
+
+# entries of collated batches that are only read on the CPU, move_to_cuda(batch_dict, cpu_keys=BATCH_CPU_KEYS)
+BATCH_CPU_KEYS = ['head_idxs', 'relation_idxs', 'tail_idxs', 'collate_secs', 'mask_secs']
 
 
 def _custom_tokenize(text: str,
-                     text_pair: Optional[str] = None) -> dict:
+                     text_pair: Optional[str] = None,
+                     ctx: RuntimeContext = None) -> dict:
     """Tokenize the text and text_pair if provided. Return the encoded inputs.
     Returns the reult of the BERT tokenizer: a dictionary containing the input_ids, token_type_ids, and attention_mask.
     
     (text_pair refers to BERT's sentence pair input, which is used for tasks like question answering and entailment.)"""
-    tokenizer = get_tokenizer()
-    encoded_inputs = tokenizer(text=text,
-                               text_pair=text_pair if text_pair else None,
-                               add_special_tokens=True,
-                               max_length=args.max_num_tokens,
-                               return_token_type_ids=True,
-                               truncation=True)
+    ctx = ctx or get_context()
+    encoded_inputs = ctx.tokenizer(text=text,
+                                   text_pair=text_pair if text_pair else None,
+                                   add_special_tokens=True,
+                                   max_length=ctx.args.max_num_tokens,
+                                   return_token_type_ids=True,
+                                   truncation=True)
     return encoded_inputs
 
 
-def _parse_entity_name(entity: str) -> str:
+def _parse_entity_name(entity: str, ctx: RuntimeContext = None) -> str:
     """Parse the entity name from the entity string. The wn18rr dataset has entities in the format 'family_alcidae_NN_1',
     so this function removes the last two parts of the entity string to get the name of the entity. For other datasets,
     the entity string is returned as is. If the entity string is None, an empty string is returned."""
-    if args.task.lower() == 'wn18rr':
+    if (ctx or get_context()).args.task.lower() == 'wn18rr':
         # family_alcidae_NN_1
         entity = ' '.join(entity.split('_')[:-2])
         return entity
@@ -58,21 +70,23 @@ def _concat_name_desc(entity: str, entity_desc: str) -> str:
     return entity
 
 
-def get_neighbor_desc(head_id: str, tail_id: str = None) -> str:
+def get_neighbor_desc(head_id: str, tail_id: str = None, ctx: RuntimeContext = None) -> str:
     """Get a string containing the names of the neighbors of the given entity id. The names are separated by spaces.
     If a tail_id is provided, the tail entity is excluded from the list of neighbors."""
-    neighbor_ids = get_link_graph().get_neighbor_ids(head_id)
+    ctx = ctx or get_context()
+    neighbor_ids = ctx.link_graph.get_neighbor_ids(head_id)
     # avoid label leakage during training
-    if not args.is_test:
+    if not ctx.args.is_test:
         neighbor_ids = [n_id for n_id in neighbor_ids if n_id != tail_id]
-    entities = [entity_dict.get_entity_by_id(n_id).entity for n_id in neighbor_ids]
-    entities = [_parse_entity_name(entity) for entity in entities]
+    entities = [ctx.entity_dict.get_entity_by_id(n_id).entity for n_id in neighbor_ids]
+    entities = [_parse_entity_name(entity, ctx=ctx) for entity in entities]
     return ' '.join(entities)
 
 
 class HRTExample:
     """A class representing a training example. The object holds the head_id, tail_id, and relation, 
-    and uses the global entity_dict to get other information about the entities.
+    and uses the entity_dict of a RuntimeContext to get other information about the entities
+    (the properties below use the default context).
     An Example object can be vectorized to get the token ids, token type ids, and masks for the head, tail, and relation.
     """
 
@@ -87,53 +101,56 @@ class HRTExample:
         """Get the description of the head entity. If the head_id is None, an empty string is returned."""
         if not self.head_id:
             return ''
-        return entity_dict.get_entity_by_id(self.head_id).entity_desc
+        return get_context().entity_dict.get_entity_by_id(self.head_id).entity_desc
 
     @property
     def tail_desc(self):
         """Get the description of the tail entity. If the tail_id is None, an empty string is returned."""
-        return entity_dict.get_entity_by_id(self.tail_id).entity_desc
+        return get_context().entity_dict.get_entity_by_id(self.tail_id).entity_desc
 
     @property
     def head(self):
         """Get the head entity itself. If the head_id is None, an empty string is returned."""
         if not self.head_id:
             return ''
-        return entity_dict.get_entity_by_id(self.head_id).entity
+        return get_context().entity_dict.get_entity_by_id(self.head_id).entity
 
     @property
     def tail(self):
         """Get the tail entity itself. If the tail_id is None, an empty string is returned."""
-        return entity_dict.get_entity_by_id(self.tail_id).entity
+        return get_context().entity_dict.get_entity_by_id(self.tail_id).entity
 
-    def vectorize(self) -> dict:
+    def vectorize(self, ctx: RuntimeContext = None) -> dict:
         """Vectorize the example by tokenizing the head and tail entities and the relation. The head and tail entities
         are tokenized with their descriptions. If the use_link_graph flag is set, descriptions of the head and tail entities
         that are too short (< 20 words) are concatenated with the names of their neighbors, except 
         for the name of the tail."""
-        head_desc, tail_desc = self.head_desc, self.tail_desc
-        if args.use_link_graph:
+        ctx = ctx or get_context()
+        head = ctx.entity_dict.get_entity_by_id(self.head_id) if self.head_id else None
+        tail = ctx.entity_dict.get_entity_by_id(self.tail_id)
+        head_desc, tail_desc = head.entity_desc if head else '', tail.entity_desc
+        if ctx.args.use_link_graph:
             if len(head_desc.split()) < 20:
-                head_desc += ' ' + get_neighbor_desc(head_id=self.head_id, tail_id=self.tail_id)
+                head_desc += ' ' + get_neighbor_desc(head_id=self.head_id, tail_id=self.tail_id, ctx=ctx)
             if len(tail_desc.split()) < 20:
-                tail_desc += ' ' + get_neighbor_desc(head_id=self.tail_id, tail_id=self.head_id)
+                tail_desc += ' ' + get_neighbor_desc(head_id=self.tail_id, tail_id=self.head_id, ctx=ctx)
 
         # tasks-specific fixups
-        head_word = _parse_entity_name(self.head)
+        head_word = _parse_entity_name(head.entity if head else '', ctx=ctx)
         # smart concatenation of name and description (removes duplicate name from description if present)
         head_text = _concat_name_desc(head_word, head_desc)
 
         # the hr will be encoded via BERTs sentence pair input
         hr_encoded_inputs = _custom_tokenize(text=head_text,
-                                             text_pair=self.relation)
+                                             text_pair=self.relation, ctx=ctx)
 
-        head_encoded_inputs = _custom_tokenize(text=head_text)
+        head_encoded_inputs = _custom_tokenize(text=head_text, ctx=ctx)
 
-        tail_word = _parse_entity_name(self.tail)
+        tail_word = _parse_entity_name(tail.entity, ctx=ctx)
         # tails are encoded without sentence pair input, but the name and description are concatenated for better context
         # (and if the description is short, and the use_link_graph flag is set, the neighbor names are added to the description,
         # except for the name of the head entity in this case)
-        tail_encoded_inputs = _custom_tokenize(text=_concat_name_desc(tail_word, tail_desc))
+        tail_encoded_inputs = _custom_tokenize(text=_concat_name_desc(tail_word, tail_desc), ctx=ctx)
 
         return {'hr_token_ids': hr_encoded_inputs['input_ids'],
                 'hr_token_type_ids': hr_encoded_inputs['token_type_ids'],
@@ -148,35 +165,62 @@ class HRTExample:
         self.hr_embedding = hr_embedding
 
 
+class ExampleTable(Sequence):
+    """HRTExamples stored as arrays of entity and relation indices, HRTExample objects are created on access.
+    Unlike a list of HRTExample objects, reading examples in forked DataLoader workers does not copy them
+    page by page through reference count updates. Entity ids must be in the entity_dict of the context."""
+
+    def __init__(self, examples: List[HRTExample], ctx: RuntimeContext = None):
+        self.ctx = ctx
+        entity2idx = (ctx or get_context()).entity_dict.entity2idx
+        relation2idx = {}
+        # empty head ids, e.g. of examples that only encode a tail entity, are stored as -1
+        self.head_idxs = np.array([entity2idx[ex.head_id] if ex.head_id else -1 for ex in examples], dtype=np.int64)
+        self.relation_idxs = np.array([relation2idx.setdefault(ex.relation, len(relation2idx)) for ex in examples],
+                                      dtype=np.int64)
+        self.tail_idxs = np.array([entity2idx[ex.tail_id] for ex in examples], dtype=np.int64)
+        self.relations = list(relation2idx)
+
+    def __len__(self):
+        return len(self.tail_idxs)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        entity_ids = (self.ctx or get_context()).entity_dict.ids
+        head_idx = int(self.head_idxs[idx])
+        return HRTExample(head_id=entity_ids[head_idx] if head_idx >= 0 else '',
+                          relation=self.relations[self.relation_idxs[idx]],
+                          tail_id=entity_ids[int(self.tail_idxs[idx])])
+
+
 class Dataset(torch.utils.data.dataset.Dataset):
     
-    def __init__(self, path, task, examples=None):
+    def __init__(self, path, task, examples=None, ctx: RuntimeContext = None):
         self.path_list = path.split(',')
         self.task = task
+        self.ctx = ctx
         assert all(os.path.exists(path) for path in self.path_list) or examples
-        if examples:
-            self.examples = examples
-        else:
-            self.examples = []
+        if not examples:
+            examples = []
             for path in self.path_list:
-                if not self.examples:
-                    self.examples = load_data(path)
-                else:
-                    self.examples.extend(load_data(path))
+                examples.extend(load_data(path, ctx=ctx))
+        self.examples = ExampleTable(examples, ctx=ctx)
 
     def __len__(self):
         return len(self.examples)
 
     def __getitem__(self, index):
-        return self.examples[index].vectorize()
+        return self.examples[index].vectorize(ctx=self.ctx)
 
 
 def load_data(path: str,
               add_forward_triplet: bool = True,
-              add_backward_triplet: bool = True) -> List[HRTExample]:
+              add_backward_triplet: bool = True,
+              ctx: RuntimeContext = None) -> List[HRTExample]:
     assert path.endswith('.json'), 'Unsupported format: {}'.format(path)
     assert add_forward_triplet or add_backward_triplet
-    logger.info('In test mode: {}'.format(args.is_test))
+    logger.info('In test mode: {}'.format((ctx or get_context()).args.is_test))
 
     data = json.load(open(path, 'r', encoding='utf-8'))
     logger.info('Load {} examples from {}'.format(len(data), path))
@@ -194,32 +238,44 @@ def load_data(path: str,
     return examples
 
 
-def collate(batch_data: List[dict]) -> dict:
+def collate(batch_data: List[dict], ctx: RuntimeContext = None) -> dict:
     """Collate the batch data. The batch data is a list of dictionaries, where each dictionary contains the token ids,
     token type ids, and masks for the head, tail, and relation. The object is also stored in the dictionary. The triplet
-    mask and self negative mask are constructed for the batch data."""
+    mask and self negative mask are constructed for the batch data.
+    Batches only hold tensors, examples are given by the head_idxs, relation_idxs and tail_idxs of
+    triplet_mask.example_indices, so nothing else is pickled from DataLoader workers and pin_memory covers all of it.
+    DataLoaders of a non-default context pass it with collate_fn=functools.partial(collate, ctx=ctx)."""
+    ctx = ctx or get_context()
+    pad_token_id = ctx.tokenizer.pad_token_id
+    start_time = time()
     hr_token_ids, hr_mask = to_indices_and_mask(
         [torch.LongTensor(ex['hr_token_ids']) for ex in batch_data],
-        pad_token_id=get_tokenizer().pad_token_id)
+        pad_token_id=pad_token_id)
     hr_token_type_ids = to_indices_and_mask(
         [torch.LongTensor(ex['hr_token_type_ids']) for ex in batch_data],
         need_mask=False)
 
     tail_token_ids, tail_mask = to_indices_and_mask(
         [torch.LongTensor(ex['tail_token_ids']) for ex in batch_data],
-        pad_token_id=get_tokenizer().pad_token_id)
+        pad_token_id=pad_token_id)
     tail_token_type_ids = to_indices_and_mask(
         [torch.LongTensor(ex['tail_token_type_ids']) for ex in batch_data],
         need_mask=False)
 
     head_token_ids, head_mask = to_indices_and_mask(
         [torch.LongTensor(ex['head_token_ids']) for ex in batch_data],
-        pad_token_id=get_tokenizer().pad_token_id)
+        pad_token_id=pad_token_id)
     head_token_type_ids = to_indices_and_mask(
         [torch.LongTensor(ex['head_token_type_ids']) for ex in batch_data],
         need_mask=False)
 
-    batch_exs = [ex['obj'] for ex in batch_data]
+    head_idxs, relation_idxs, tail_idxs = example_indices([ex['obj'] for ex in batch_data], ctx=ctx)
+    mask_start_time = time()
+    triplet_mask = construct_mask_by_indices(head_idxs, relation_idxs, tail_idxs, ctx=ctx) \
+        if not ctx.args.is_test else None
+    self_negative_mask = construct_self_negative_mask_by_indices(head_idxs, relation_idxs, ctx=ctx) \
+        if not ctx.args.is_test else None
+    mask_secs = time() - mask_start_time
     batch_dict = {
         'hr_token_ids': hr_token_ids,
         'hr_mask': hr_mask,
@@ -230,9 +286,14 @@ def collate(batch_data: List[dict]) -> dict:
         'head_token_ids': head_token_ids,
         'head_mask': head_mask,
         'head_token_type_ids': head_token_type_ids,
-        'batch_data': batch_exs,
-        'triplet_mask': construct_mask(row_exs=batch_exs) if not args.is_test else None,
-        'self_negative_mask': construct_self_negative_mask(batch_exs) if not args.is_test else None,
+        'head_idxs': head_idxs,
+        'relation_idxs': relation_idxs,
+        'tail_idxs': tail_idxs,
+        'triplet_mask': triplet_mask,
+        'self_negative_mask': self_negative_mask,
+        # timings for the step profiler, collate usually runs in DataLoader workers
+        'collate_secs': torch.tensor(time() - start_time, dtype=torch.float64),
+        'mask_secs': torch.tensor(mask_secs, dtype=torch.float64),
     }
 
     return batch_dict
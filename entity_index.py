@@ -0,0 +1,327 @@
+import math
+import warnings
+
+import torch
+import numpy as np
+
+from typing import List, Tuple
+
+from logger_config import logger
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+class EntityIndex:
+    """Retrieval backend over a (num_entities x hidden_size) entity embedding matrix.
+
+       All backends share the same search semantics:
+            scores, indices = index.search(hr_vectors, k)
+       where both outputs have shape (num_queries, k), rows are sorted by descending score,
+       and indices are row indices into the entity embedding matrix (i.e. entity_dict indices).
+       Scores are inner products, which equal cosine similarities for the normalized vectors produced by the model."""
+
+    # approximate backends may miss some of the true top-k entities
+    exact = False
+
+    def __init__(self, entities_tensor: torch.tensor):
+        assert entities_tensor.dim() == 2
+        self.num_entities, self.dim = entities_tensor.size()
+
+    def search(self, hr_vectors: torch.tensor, k: int) -> Tuple[torch.tensor, torch.tensor]:
+        raise NotImplementedError
+
+    def reconstruct(self, indices: torch.tensor) -> torch.tensor:
+        """Full-precision entity vectors for the given entity indices, used to score targets exactly."""
+        raise NotImplementedError
+
+    def __len__(self):
+        return self.num_entities
+
+
+class ExactIndex(EntityIndex):
+    """Brute-force inner product search, equivalent to torch.mm(hr_vectors, entities_tensor.t()).topk(k)."""
+
+    exact = True
+
+    def __init__(self, entities_tensor: torch.tensor, batch_size: int = 256):
+        super().__init__(entities_tensor)
+        self.entities_tensor = entities_tensor
+        self.batch_size = batch_size
+
+    @torch.no_grad()
+    def search(self, hr_vectors: torch.tensor, k: int) -> Tuple[torch.tensor, torch.tensor]:
+        k = min(k, self.num_entities)
+        hr_vectors = hr_vectors.to(self.entities_tensor.device)
+        topk_scores, topk_indices = [], []
+        for start in range(0, hr_vectors.size(0), self.batch_size):
+            batch_score = torch.mm(hr_vectors[start:start + self.batch_size], self.entities_tensor.t())
+            batch_topk_scores, batch_topk_indices = batch_score.topk(k, dim=1)
+            topk_scores.append(batch_topk_scores)
+            topk_indices.append(batch_topk_indices)
+        return torch.cat(topk_scores, dim=0), torch.cat(topk_indices, dim=0)
+
+    def reconstruct(self, indices: torch.tensor) -> torch.tensor:
+        return self.entities_tensor[indices.to(self.entities_tensor.device)]
+
+
+class IVFIndex(EntityIndex):
+    """Inverted file index: entities are clustered with (spherical) k-means into nlist lists,
+       and a query only scores the entities in its nprobe closest lists.
+
+       The entity embeddings are stored permuted so that every inverted list is a contiguous slice,
+       which keeps the per-query candidate scoring a single matrix product."""
+
+    def __init__(self, entities_tensor: torch.tensor, nlist: int = 0, nprobe: int = 16,
+                 niter: int = 10, seed: int = 0):
+        super().__init__(entities_tensor)
+        entities_tensor = entities_tensor.float().cpu()
+        # common rule of thumb: ~sqrt(N) lists
+        self.nlist = nlist if nlist > 0 else max(1, int(math.sqrt(self.num_entities)))
+        self.nlist = min(self.nlist, self.num_entities)
+        self.nprobe = min(nprobe, self.nlist)
+
+        self.centroids = kmeans(entities_tensor, self.nlist, niter=niter, spherical=True, seed=seed)
+        assignments = _assign(entities_tensor, self.centroids, spherical=True)
+        self.perm = torch.argsort(assignments, stable=True)
+        self.inv_perm = torch.argsort(self.perm)
+        list_sizes = torch.bincount(assignments, minlength=self.nlist)
+        self.offsets = torch.zeros(self.nlist + 1, dtype=torch.long)
+        self.offsets[1:] = torch.cumsum(list_sizes, dim=0)
+        self.entities_tensor = entities_tensor[self.perm].contiguous()
+        logger.info('Build IVF index with {} lists over {} entities, nprobe={}'.format(
+            self.nlist, self.num_entities, self.nprobe))
+
+    @torch.no_grad()
+    def search(self, hr_vectors: torch.tensor, k: int) -> Tuple[torch.tensor, torch.tensor]:
+        hr_vectors = hr_vectors.float().cpu()
+        num_queries = hr_vectors.size(0)
+        k = min(k, self.num_entities)
+        # pad with -inf / -1 if the probed lists hold fewer than k entities
+        topk_scores = torch.full((num_queries, k), -math.inf)
+        topk_indices = torch.full((num_queries, k), -1, dtype=torch.long)
+
+        probe_lists = torch.mm(hr_vectors, self.centroids.t()).topk(self.nprobe, dim=1)[1]
+        for idx in range(num_queries):
+            slices = [torch.arange(self.offsets[c], self.offsets[c + 1]) for c in probe_lists[idx].tolist()]
+            positions = torch.cat(slices)
+            if positions.numel() == 0:
+                continue
+            scores = torch.mv(self.entities_tensor[positions], hr_vectors[idx])
+            cur_k = min(k, scores.size(0))
+            cur_scores, cur_positions = scores.topk(cur_k)
+            topk_scores[idx, :cur_k] = cur_scores
+            topk_indices[idx, :cur_k] = self.perm[positions[cur_positions]]
+        return topk_scores, topk_indices
+
+    def reconstruct(self, indices: torch.tensor) -> torch.tensor:
+        return self.entities_tensor[self.inv_perm[indices.cpu()]]
+
+
+class HNSWIndex(EntityIndex):
+    """Graph-based approximate search backed by faiss.IndexHNSWFlat (inner product metric).
+       A search runs with efSearch = max(ef_search, k), HNSW returns no more than efSearch results."""
+
+    def __init__(self, entities_tensor: torch.tensor, hnsw_m: int = 32, ef_search: int = 128,
+                 ef_construction: int = 200):
+        super().__init__(entities_tensor)
+        assert faiss is not None, 'HNSW index requires faiss, please install faiss-cpu'
+        self.index = faiss.IndexHNSWFlat(self.dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        self.index.hnsw.efConstruction = ef_construction
+        self.ef_search = ef_search
+        self.entities_tensor = entities_tensor.float().cpu().contiguous()
+        self.index.add(self.entities_tensor.numpy())
+        logger.info('Build HNSW index over {} entities, M={}, efSearch={}'.format(
+            self.num_entities, hnsw_m, ef_search))
+
+    @torch.no_grad()
+    def search(self, hr_vectors: torch.tensor, k: int) -> Tuple[torch.tensor, torch.tensor]:
+        k = min(k, self.num_entities)
+        # set for every search, a larger k never leaks into later searches
+        self.index.hnsw.efSearch = max(self.ef_search, k)
+        scores, indices = self.index.search(hr_vectors.float().cpu().contiguous().numpy(), k)
+        return torch.from_numpy(scores), torch.from_numpy(indices).long()
+
+    def reconstruct(self, indices: torch.tensor) -> torch.tensor:
+        return self.entities_tensor[indices.cpu()]
+
+
+class PQIndex(EntityIndex):
+    """Product quantization: every vector is split into pq_m sub-vectors, and each sub-vector is encoded as the id
+       of its nearest centroid among 256 per sub-space, so an entity costs pq_m bytes instead of 4 * hidden_size.
+
+       Queries are scored against the codes with per sub-space lookup tables (asymmetric distance computation),
+       then the best rerank_k candidates are re-scored exactly from the full-precision entity store,
+       which is usually a memory-mapped .npy file (see save_entity_store), so only the candidate rows are read."""
+
+    def __init__(self, entity_store: np.ndarray, pq_m: int = 96, rerank_k: int = 256,
+                 train_size: int = 65536, niter: int = 10, seed: int = 0, block_size: int = 65536):
+        self.num_entities, self.dim = entity_store.shape
+        assert self.dim % pq_m == 0, 'hidden size {} is not divisible by pq_m={}'.format(self.dim, pq_m)
+        self.entity_store = entity_store
+        self.pq_m = pq_m
+        self.sub_dim = self.dim // pq_m
+        self.rerank_k = rerank_k
+        self.block_size = block_size
+
+        # sorted sample ids keep reads from a memory-mapped store sequential
+        generator = torch.Generator().manual_seed(seed)
+        sample_ids = torch.randperm(self.num_entities, generator=generator)[:train_size].sort()[0].numpy()
+        train = self._load_rows(sample_ids)
+        num_centroids = min(256, train.size(0))
+        self.codebooks = torch.stack([kmeans(self._sub_vectors(train, j), num_centroids, niter=niter, seed=seed + j)
+                                      for j in range(pq_m)])
+
+        self.codes = torch.empty(self.num_entities, pq_m, dtype=torch.uint8)
+        for start in range(0, self.num_entities, block_size):
+            block = self._load_rows(slice(start, start + block_size))
+            for j in range(pq_m):
+                self.codes[start:start + block_size, j] = _assign(self._sub_vectors(block, j), self.codebooks[j],
+                                                                  spherical=False)
+        logger.info('Build PQ index over {} entities, {} bytes per entity, rerank_k={}'.format(
+            self.num_entities, pq_m, rerank_k))
+
+    def _sub_vectors(self, x: torch.tensor, j: int) -> torch.tensor:
+        return x[:, j * self.sub_dim:(j + 1) * self.sub_dim].contiguous()
+
+    def _load_rows(self, rows) -> torch.tensor:
+        return torch.from_numpy(np.asarray(self.entity_store[rows], dtype=np.float32))
+
+    @torch.no_grad()
+    def search(self, hr_vectors: torch.tensor, k: int) -> Tuple[torch.tensor, torch.tensor]:
+        hr_vectors = hr_vectors.float().cpu()
+        num_queries = hr_vectors.size(0)
+        k = min(k, self.num_entities)
+        num_candidates = min(max(self.rerank_k, k), self.num_entities)
+
+        # num_queries x pq_m x num_centroids
+        luts = torch.einsum('bmd,mkd->bmk', hr_vectors.view(num_queries, self.pq_m, self.sub_dim), self.codebooks)
+        cand_scores, cand_indices = None, None
+        for start in range(0, self.num_entities, self.block_size):
+            codes = self.codes[start:start + self.block_size].long()
+            block_score = torch.zeros(num_queries, codes.size(0))
+            for j in range(self.pq_m):
+                block_score += luts[:, j, codes[:, j]]
+            cand_scores, cand_indices = merge_topk(cand_scores, cand_indices, block_score, start, num_candidates)
+
+        # exact re-scoring from the full-precision store
+        cand_vectors = self.reconstruct(cand_indices.reshape(-1)).view(num_queries, num_candidates, self.dim)
+        exact_scores = torch.einsum('bd,bcd->bc', hr_vectors, cand_vectors)
+        topk_scores, topk_positions = exact_scores.topk(k, dim=1)
+        return topk_scores, torch.gather(cand_indices, 1, topk_positions)
+
+    def reconstruct(self, indices: torch.tensor) -> torch.tensor:
+        return self._load_rows(indices.cpu().numpy())
+
+
+class EntityShards:
+    """Entity embeddings stored as consecutive torch.save'd shard files. Shards are memory-mapped,
+       so iterating over them only pages in one shard at a time and the full tensor is never materialized."""
+
+    def __init__(self, shard_paths: List[str]):
+        self.shards = [torch.load(path, map_location='cpu', mmap=True) for path in shard_paths]
+        self.offsets = [0]
+        for shard in self.shards:
+            self.offsets.append(self.offsets[-1] + shard.size(0))
+        logger.info('Memory-map {} entity embeddings from {} shards'.format(self.offsets[-1], len(self.shards)))
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __iter__(self):
+        """Yield (offset of the first entity, shard tensor) pairs."""
+        return iter(zip(self.offsets[:-1], self.shards))
+
+    def reconstruct(self, indices: torch.tensor) -> torch.tensor:
+        indices = indices.cpu()
+        vectors = torch.empty(indices.size(0), self.shards[0].size(1), dtype=self.shards[0].dtype)
+        for shard_start, shard in self:
+            in_shard = (indices >= shard_start) & (indices < shard_start + shard.size(0))
+            vectors[in_shard] = shard[indices[in_shard] - shard_start]
+        return vectors
+
+
+def build_entity_index(entities_tensor: torch.tensor, index_type: str = 'exact', **kwargs) -> EntityIndex:
+    """Build a retrieval backend over the entity embeddings.
+    Relevant kwargs:
+        nlist, nprobe: number of inverted lists and lists probed per query ('ivf')
+        hnsw_m, ef_search: graph degree and search beam width ('hnsw')
+        pq_m, rerank_k: bytes per entity and number of exactly re-scored candidates ('pq')
+        store_path: if set, the full-precision store used by 'pq' is written there and memory-mapped
+    """
+    if index_type == 'hnsw' and faiss is None:
+        warnings.warn('faiss is not available, fall back to ivf index')
+        index_type = 'ivf'
+
+    if index_type == 'exact':
+        return ExactIndex(entities_tensor)
+    elif index_type == 'ivf':
+        return IVFIndex(entities_tensor, nlist=kwargs.get('nlist', 0), nprobe=kwargs.get('nprobe', 16))
+    elif index_type == 'hnsw':
+        return HNSWIndex(entities_tensor, hnsw_m=kwargs.get('hnsw_m', 32), ef_search=kwargs.get('ef_search', 128))
+    elif index_type == 'pq':
+        if kwargs.get('store_path'):
+            save_entity_store(entities_tensor, kwargs['store_path'])
+            entity_store = load_entity_store(kwargs['store_path'])
+        else:
+            entity_store = entities_tensor.float().cpu().numpy()
+        return PQIndex(entity_store, pq_m=kwargs.get('pq_m', 96), rerank_k=kwargs.get('rerank_k', 256))
+    else:
+        assert False, 'Unknown entity index type: {}'.format(index_type)
+
+
+def save_entity_store(entities_tensor: torch.tensor, path: str):
+    """Write entity embeddings as a float32 .npy file that load_entity_store can memory-map."""
+    np.save(path, entities_tensor.float().cpu().numpy())
+    logger.info('Save {} entity embeddings to {}'.format(entities_tensor.size(0), path))
+
+
+def load_entity_store(path: str) -> np.ndarray:
+    return np.load(path, mmap_mode='r')
+
+
+def merge_topk(topk_scores: torch.tensor, topk_indices: torch.tensor,
+               block_score: torch.tensor, offset: int, k: int) -> Tuple[torch.tensor, torch.tensor]:
+    """Merge the running per-row top-k with the scores of entities [offset, offset + block_score.size(1))."""
+    block_k = min(k, block_score.size(1))
+    block_topk_scores, block_topk_indices = block_score.topk(block_k, dim=1)
+    block_topk_indices += offset
+    if topk_scores is None:
+        return block_topk_scores, block_topk_indices
+    scores = torch.cat([topk_scores, block_topk_scores], dim=1)
+    indices = torch.cat([topk_indices, block_topk_indices], dim=1)
+    scores, positions = scores.topk(min(k, scores.size(1)), dim=1)
+    return scores, torch.gather(indices, 1, positions)
+
+
+def _assign(x: torch.tensor, centroids: torch.tensor, spherical: bool, batch_size: int = 65536) -> torch.tensor:
+    assignments = []
+    centroid_norms = (centroids * centroids).sum(dim=1)
+    for start in range(0, x.size(0), batch_size):
+        sim = torch.mm(x[start:start + batch_size], centroids.t())
+        if not spherical:
+            # argmin ||x - c||^2 == argmax (2 * x.c - ||c||^2)
+            sim = 2 * sim - centroid_norms
+        assignments.append(sim.argmax(dim=1))
+    return torch.cat(assignments)
+
+
+def kmeans(x: torch.tensor, num_clusters: int, niter: int = 10,
+           spherical: bool = False, seed: int = 0) -> torch.tensor:
+    """Lloyd's k-means on CPU, returns a (num_clusters x dim) centroid matrix.
+    With spherical=True, centroids are re-normalized and points are assigned by inner product."""
+    generator = torch.Generator().manual_seed(seed)
+    init = torch.randperm(x.size(0), generator=generator)[:num_clusters]
+    centroids = x[init].clone()
+    for _ in range(niter):
+        assignments = _assign(x, centroids, spherical=spherical)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, x)
+        counts = torch.bincount(assignments, minlength=num_clusters)
+        non_empty = counts > 0
+        # empty clusters keep their previous centroid
+        centroids[non_empty] = sums[non_empty] / counts[non_empty].unsqueeze(1).to(x.dtype)
+        if spherical:
+            centroids = torch.nn.functional.normalize(centroids, dim=1)
+    return centroids
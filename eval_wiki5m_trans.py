@@ -1,11 +1,12 @@
 import os
-import json
 import torch
+import numpy as np
 
 from config import args
 from predict import BertPredictor
 from dict_hub import get_entity_dict
-from evaluate import eval_single_direction
+from evaluate import eval_both_directions, write_metrics, metrics_index_type
+from entity_index import PQIndex, EntityShards, load_entity_store
 from logger_config import logger
 
 assert args.task == 'wiki5m_trans', 'This script is only used for wiki5m transductive setting'
@@ -30,26 +31,41 @@ def _dump_entity_embeddings(predictor: BertPredictor):
         logger.info('shard_id={}, from {} to {}'.format(shard_id, start, end))
         shard_entity_exs = entity_dict.entity_exs[start:end]
         shard_entity_tensor = predictor.predict_by_entities(shard_entity_exs)
-        torch.save(shard_entity_tensor, _get_shard_path(shard_id=shard_id))
+        torch.save(shard_entity_tensor.cpu(), _get_shard_path(shard_id=shard_id))
 
         logger.info('done for shard_id={}'.format(shard_id))
 
 
-def _load_entity_embeddings():
+def _load_entity_shards() -> EntityShards:
     assert os.path.exists(_get_shard_path())
 
-    shard_tensors = []
-    for start in range(0, len(entity_dict), SHARD_SIZE):
-        shard_id = start // SHARD_SIZE
-        shard_path = _get_shard_path(shard_id=shard_id)
-        shard_entity_tensor = torch.load(shard_path, map_location=lambda storage, loc: storage)
-        logger.info('Load {} entity embeddings from {}'.format(shard_entity_tensor.size(0), shard_path))
-        shard_tensors.append(shard_entity_tensor)
-
-    entity_tensor = torch.cat(shard_tensors, dim=0)
-    logger.info('{} entity embeddings in total'.format(entity_tensor.size(0)))
-    assert entity_tensor.size(0) == len(entity_dict.entity_exs)
-    return entity_tensor
+    shard_paths = [_get_shard_path(shard_id=start // SHARD_SIZE) for start in range(0, len(entity_dict), SHARD_SIZE)]
+    entity_shards = EntityShards(shard_paths)
+    assert len(entity_shards) == len(entity_dict.entity_exs)
+    return entity_shards
+
+
+def _build_entity_store() -> np.ndarray:
+    # copy shards one by one into a single memory-mapped store instead of concatenating them in memory
+    store_path = '{}/entity_store.npy'.format(args.model_dir)
+    if not os.path.exists(store_path):
+        entity_store = None
+        for start in range(0, len(entity_dict), SHARD_SIZE):
+            shard_path = _get_shard_path(shard_id=start // SHARD_SIZE)
+            shard_entity_tensor = torch.load(shard_path, map_location=lambda storage, loc: storage).float()
+            if entity_store is None:
+                entity_store = np.lib.format.open_memmap(store_path + '.tmp', mode='w+', dtype=np.float32,
+                                                         shape=(len(entity_dict), shard_entity_tensor.size(1)))
+            entity_store[start:(start + shard_entity_tensor.size(0))] = shard_entity_tensor.numpy()
+            logger.info('Copy {} entity embeddings from {} to entity store'.format(
+                shard_entity_tensor.size(0), shard_path))
+        entity_store.flush()
+        del entity_store
+        os.rename(store_path + '.tmp', store_path)
+
+    entity_store = load_entity_store(store_path)
+    assert entity_store.shape[0] == len(entity_dict.entity_exs)
+    return entity_store
 
 
 def predict_by_split():
@@ -62,24 +78,19 @@ def predict_by_split():
     predictor.load(ckt_path=args.eval_model_path, use_data_parallel=True)
     _dump_entity_embeddings(predictor)
 
-    entity_tensor = _load_entity_embeddings().cuda()
-    forward_metrics = eval_single_direction(predictor,
-                                            entity_tensor=entity_tensor,
-                                            eval_forward=True,
-                                            batch_size=32)
-    backward_metrics = eval_single_direction(predictor,
-                                             entity_tensor=entity_tensor,
-                                             eval_forward=False,
-                                             batch_size=32)
-    metrics = {k: round((forward_metrics[k] + backward_metrics[k]) / 2, 4) for k in forward_metrics}
-    logger.info('Averaged metrics: {}'.format(metrics))
-
-    prefix, basename = os.path.dirname(args.eval_model_path), os.path.basename(args.eval_model_path)
-    split = os.path.basename(args.valid_path)
-    with open('{}/metrics_{}_{}.json'.format(prefix, split, basename), 'w', encoding='utf-8') as writer:
-        writer.write('forward metrics: {}\n'.format(json.dumps(forward_metrics)))
-        writer.write('backward metrics: {}\n'.format(json.dumps(backward_metrics)))
-        writer.write('average metrics: {}\n'.format(json.dumps(metrics)))
+    # entity embeddings are either compressed with pq or streamed shard by shard,
+    # the full entity tensor is never materialized
+    entity_index, entity_shards = None, None
+    if args.entity_index == 'pq':
+        entity_index = PQIndex(_build_entity_store(), pq_m=args.pq_m, rerank_k=args.pq_rerank_k)
+    else:
+        entity_shards = _load_entity_shards()
+    forward_metrics, backward_metrics = eval_both_directions(predictor,
+                                                             entity_tensor=None,
+                                                             batch_size=256,
+                                                             entity_index=entity_index,
+                                                             entity_shards=entity_shards)
+    write_metrics(forward_metrics, backward_metrics, index_type=metrics_index_type(entity_index))
 
 
 if __name__ == '__main__':
@@ -1,42 +1,96 @@
 import os
+import glob
 import json
 import tqdm
 import torch
 
 from time import time
-from typing import List, Tuple
-from dataclasses import dataclass, asdict
+from typing import List, Tuple, Callable
 
 from config import args
 from doc import load_data, HRTExample
 from predict import BertPredictor
-from dict_hub import get_entity_dict, get_all_triplet_dict
-from triplet import EntityDict
-from rerank import rerank_by_graph
+from dict_hub import get_entity_dict, get_all_triplet_dict, get_context
+from triplet import EntityDict, TailCSR
+from rerank import rerank_by_graph, rerank_candidates, get_rerank_boost, RerankSetting
+from entity_index import EntityIndex, EntityShards, build_entity_index, merge_topk
+from prediction_writer import PredictionWriter
+from metrics_sink import get_metrics_sink
 from logger_config import logger
 
 
 def _setup_entity_dict() -> EntityDict:
     if args.task == 'wiki5m_ind':
-        return EntityDict(entity_dict_dir=os.path.dirname(args.valid_path),
-                          inductive_test_path=args.valid_path)
+        entity_dict_dir = os.path.dirname(args.valid_path)
+        return get_context().load_or_build(EntityDict, [os.path.join(entity_dict_dir, 'entities.json'), args.valid_path],
+                                           lambda: EntityDict(entity_dict_dir=entity_dict_dir,
+                                                              inductive_test_path=args.valid_path))
     return get_entity_dict()
 
 
-entity_dict = _setup_entity_dict()
-all_triplet_dict = get_all_triplet_dict()
+# built lazily once, then shared by both directions and repeated evaluations
+entity_dict: EntityDict = None
+tail_csr: TailCSR = None
 
 
-@dataclass
-class PredInfo:
-    head: str
-    relation: str
-    tail: str
-    pred_tail: str
-    pred_score: float
-    topk_score_info: str
-    rank: int
-    correct: bool
+def get_eval_entity_dict() -> EntityDict:
+    """Entities ranked by evaluation, the test entities only in the inductive setting."""
+    global entity_dict
+    if entity_dict is None:
+        entity_dict = _setup_entity_dict()
+    return entity_dict
+
+
+def _get_tail_csr() -> TailCSR:
+    global tail_csr
+    if tail_csr is None:
+        tail_csr = TailCSR(get_all_triplet_dict(), get_eval_entity_dict())
+    return tail_csr
+
+
+def rank_metrics(ranks: torch.tensor) -> dict:
+    """Mean rank, MRR and Hits@k for every k in args.hits_at, given 1-based ranks."""
+    ranks = ranks.double()
+    metrics = {'mean_rank': ranks.mean(), 'mrr': ranks.reciprocal().mean()}
+    for k in [int(k) for k in args.hits_at.split(',')]:
+        metrics['hit@{}'.format(k)] = (ranks <= k).double().mean()
+    return {k: round(v.item(), 4) for k, v in metrics.items()}
+
+
+def target_ranks(batch_score: torch.tensor, target_score: torch.tensor) -> torch.tensor:
+    """1-based ranks of target_score (batch_size x 1) within the rows of batch_score, which include the targets.
+    Ties are resolved pessimistically: other entities scoring the same as the target are ranked before it,
+    so a model that scores all entities alike ranks every target last."""
+    return (batch_score >= target_score).sum(dim=1)
+
+
+def _collect_outputs(topk_scores: List[torch.tensor],
+                     topk_indices: List[torch.tensor],
+                     ranks: List[torch.tensor],
+                     total: int) -> Tuple:
+    # per-block tensors are only synchronized and converted to lists once at the end,
+    # top-k lists are empty if they were handed to an on_block callback instead
+    ranks = torch.cat(ranks)
+    assert ranks.size(0) == total
+    metrics = rank_metrics(ranks)
+    if not topk_scores:
+        return [], [], metrics, ranks.tolist()
+    return torch.cat(topk_scores).tolist(), torch.cat(topk_indices).tolist(), metrics, ranks.tolist()
+
+
+def _append_block(start: int,
+                  batch_topk_scores: torch.tensor,
+                  batch_topk_indices: torch.tensor,
+                  batch_ranks: torch.tensor,
+                  topk_scores: List[torch.tensor],
+                  topk_indices: List[torch.tensor],
+                  on_block: Callable = None):
+    # hand the block over to a streaming consumer, or keep it until the end
+    if on_block is not None:
+        on_block(start, batch_topk_scores, batch_topk_indices, batch_ranks)
+    else:
+        topk_scores.append(batch_topk_scores)
+        topk_indices.append(batch_topk_indices)
 
 
 @torch.no_grad()
@@ -44,17 +98,19 @@ def compute_metrics(hr_tensor: torch.tensor,
                     entities_tensor: torch.tensor,
                     target: List[int],
                     examples: List[HRTExample],
-                    k=3, batch_size=256) -> Tuple:
+                    k=3, batch_size=256,
+                    filter_indices: Tuple[torch.tensor, torch.tensor] = None,
+                    on_block: Callable = None) -> Tuple:
+    entity_dict = get_eval_entity_dict()
     assert hr_tensor.size(1) == entities_tensor.size(1)
     total = hr_tensor.size(0)
     entity_cnt = len(entity_dict)
     assert entity_cnt == entities_tensor.size(0)
     target = torch.LongTensor(target).unsqueeze(-1).to(hr_tensor.device)
+    filter_indices = filter_indices or get_filter_indices(examples, target.squeeze(1))
     topk_scores, topk_indices = [], []
     ranks = []
 
-    mean_rank, mrr, hit1, hit3, hit10 = 0, 0, 0, 0, 0
-
     for start in tqdm.tqdm(range(0, total, batch_size)):
         end = start + batch_size
         # batch_size * entity_cnt
@@ -66,112 +122,479 @@ def compute_metrics(hr_tensor: torch.tensor,
         rerank_by_graph(batch_score, examples[start:end], entity_dict=entity_dict)
 
         # filter known triplets
-        for idx in range(batch_score.size(0)):
-            mask_indices = []
-            cur_ex = examples[start + idx]
-            gold_neighbor_ids = all_triplet_dict.get_neighbors(cur_ex.head_id, cur_ex.relation)
-            if len(gold_neighbor_ids) > 10000:
-                logger.debug('{} - {} has {} neighbors'.format(cur_ex.head_id, cur_ex.relation, len(gold_neighbor_ids)))
-            for e_id in gold_neighbor_ids:
-                if e_id == cur_ex.tail_id:
-                    continue
-                mask_indices.append(entity_dict.entity_to_idx(e_id))
-            mask_indices = torch.LongTensor(mask_indices).to(batch_score.device)
-            batch_score[idx].index_fill_(0, mask_indices, -1)
-
-        batch_sorted_score, batch_sorted_indices = torch.sort(batch_score, dim=-1, descending=True)
-        target_rank = torch.nonzero(batch_sorted_indices.eq(batch_target).long(), as_tuple=False)
-        assert target_rank.size(0) == batch_score.size(0)
-        for idx in range(batch_score.size(0)):
-            idx_rank = target_rank[idx].tolist()
-            assert idx_rank[0] == idx
-            cur_rank = idx_rank[1]
-
-            # 0-based -> 1-based
-            cur_rank += 1
-            mean_rank += cur_rank
-            mrr += 1.0 / cur_rank
-            hit1 += 1 if cur_rank <= 1 else 0
-            hit3 += 1 if cur_rank <= 3 else 0
-            hit10 += 1 if cur_rank <= 10 else 0
-            ranks.append(cur_rank)
-
-        topk_scores.extend(batch_sorted_score[:, :k].tolist())
-        topk_indices.extend(batch_sorted_indices[:, :k].tolist())
-
-    metrics = {'mean_rank': mean_rank, 'mrr': mrr, 'hit@1': hit1, 'hit@3': hit3, 'hit@10': hit10}
-    metrics = {k: round(v / total, 4) for k, v in metrics.items()}
-    assert len(topk_scores) == total
-    return topk_scores, topk_indices, metrics, ranks
+        filter_rows, filter_cols = _block_filter_indices(filter_indices, start, end)
+        batch_score[filter_rows.to(batch_score.device), filter_cols.to(batch_score.device)] = -1
+
+        # counting entities that score at least as high as the target needs no full sort
+        target_score = torch.gather(batch_score, 1, batch_target)
+        ranks.append(target_ranks(batch_score, target_score))
+
+        batch_topk_scores, batch_topk_indices = batch_score.topk(min(k, batch_score.size(1)), dim=1)
+        _append_block(start, batch_topk_scores, batch_topk_indices, ranks[-1], topk_scores, topk_indices, on_block)
+
+    return _collect_outputs(topk_scores, topk_indices, ranks, total)
+
+
+@torch.no_grad()
+def compute_candidate_metrics(hr_tensor: torch.tensor,
+                              entities_tensor: torch.tensor,
+                              target: List[int],
+                              examples: List[HRTExample],
+                              entity_index: EntityIndex,
+                              k=3, batch_size=256,
+                              filter_indices: Tuple[torch.tensor, torch.tensor] = None,
+                              on_block: Callable = None) -> Tuple:
+    """Approximate counterpart of compute_metrics: only the args.index_search_k candidates returned by
+    entity_index.search are re-ranked and filtered, and the target is ranked against them.
+    A target that the index fails to retrieve still gets its exact score, so its rank is a lower bound.
+    entities_tensor is not used, target vectors come from entity_index.reconstruct so that
+    indexes over a memory-mapped entity store never need the full tensor in memory."""
+    entity_dict = get_eval_entity_dict()
+    total = hr_tensor.size(0)
+    assert len(entity_dict) == len(entity_index)
+    target = torch.LongTensor(target)
+    filter_indices = filter_indices or get_filter_indices(examples, target)
+    topk_scores, topk_indices = [], []
+    ranks = []
+
+    for start in tqdm.tqdm(range(0, total, batch_size)):
+        end = start + batch_size
+        batch_hr = hr_tensor[start:end, :]
+        cand_scores, cand_indices = entity_index.search(batch_hr, k=max(args.index_search_k, k))
+        batch_target = target[start:end].to(cand_indices.device)
+        target_vectors = entity_index.reconstruct(batch_target).to(cand_scores.device)
+        target_scores = torch.sum(batch_hr.to(cand_scores.device) * target_vectors, dim=1)
+
+        # re-ranking based on topological structure
+        rerank_candidates(cand_scores, cand_indices, target_scores, batch_target,
+                          examples[start:end], entity_dict=entity_dict)
+
+        # filter known triplets, padded candidates (index -1) are filtered as well
+        filter_rows, filter_cols = _block_filter_indices(filter_indices, start, end)
+        num_cols = len(entity_dict) + 1
+        filter_keys = (filter_rows * num_cols + filter_cols).to(cand_indices.device)
+        row_offsets = torch.arange(cand_indices.size(0), device=cand_indices.device).unsqueeze(1) * num_cols
+        is_filtered = torch.isin(row_offsets + cand_indices, filter_keys) | (cand_indices < 0)
+        cand_scores.masked_fill_(is_filtered, -1)
+
+        # ties count against the target as in target_ranks, the target itself is never counted against itself
+        is_higher = (cand_scores >= target_scores.unsqueeze(1)) & (cand_indices != batch_target.unsqueeze(1))
+        ranks.append(is_higher.sum(dim=1) + 1)
+
+        batch_topk_scores, batch_topk_pos = cand_scores.topk(min(k, cand_scores.size(1)), dim=1)
+        _append_block(start, batch_topk_scores, torch.gather(cand_indices, 1, batch_topk_pos), ranks[-1],
+                      topk_scores, topk_indices, on_block)
+
+    return _collect_outputs(topk_scores, topk_indices, ranks, total)
+
+
+def get_filter_indices(examples: List[HRTExample], target: torch.tensor) -> Tuple[torch.tensor, torch.tensor]:
+    """(row, entity index) pairs of known triplets other than the target, these are filtered out.
+    Rows are sorted, computed once they can be passed as filter_indices to every evaluation of the same examples."""
+    entity_dict = get_eval_entity_dict()
+    csr = _get_tail_csr()
+    head_idxs = [entity_dict.entity2idx.get(ex.head_id, -1) for ex in examples]
+    relation_idxs = [csr.relation_to_idx(ex.relation) for ex in examples]
+    rows, cols = csr.lookup(head_idxs, relation_idxs)
+    rows, cols = torch.from_numpy(rows), torch.from_numpy(cols)
+    is_target = cols == target.cpu()[rows]
+    return rows[~is_target], cols[~is_target]
+
+
+def _block_filter_indices(filter_indices: Tuple[torch.tensor, torch.tensor],
+                          start: int, end: int) -> Tuple[torch.tensor, torch.tensor]:
+    # filter rows are sorted, so the pairs of query block [start, end) are one contiguous slice
+    rows, cols = filter_indices
+    lo, hi = torch.searchsorted(rows, torch.LongTensor([start, end])).tolist()
+    return rows[lo:hi] - start, cols[lo:hi]
+
+
+def _in_shard(cols: torch.tensor, shard_start: int, shard_end: int) -> torch.tensor:
+    return (cols >= shard_start) & (cols < shard_end)
+
+
+@torch.no_grad()
+def compute_sharded_metrics(hr_tensor: torch.tensor,
+                            entity_shards: EntityShards,
+                            target: List[int],
+                            examples: List[HRTExample],
+                            k=3, batch_size=256,
+                            filter_indices: Tuple[torch.tensor, torch.tensor] = None,
+                            on_block: Callable = None) -> Tuple:
+    """Out-of-core counterpart of compute_metrics that streams memory-mapped entity shards.
+    For each query block, the target score is computed first, then every shard is scored in turn:
+    re-ranking boosts and known-triplet filtering are applied to the columns of that shard,
+    entities scoring at least as high as the target are counted, and a running top-k is merged.
+    Peak memory is one shard plus one (batch_size x shard_size) score block.
+    Ties count against the target as in target_ranks, up to rounding differences between the products of
+    differently sized shards."""
+    entity_dict = get_eval_entity_dict()
+    total = hr_tensor.size(0)
+    entity_cnt = len(entity_dict)
+    assert entity_cnt == len(entity_shards)
+    device = hr_tensor.device
+    target = torch.LongTensor(target).to(device)
+    filter_indices = filter_indices or get_filter_indices(examples, target)
+    topk_scores, topk_indices = [], []
+    ranks = []
+
+    for start in tqdm.tqdm(range(0, total, batch_size)):
+        end = start + batch_size
+        batch_hr = hr_tensor[start:end, :]
+        batch_target = target[start:end]
+        batch_examples = examples[start:end]
+        row_indices = torch.arange(batch_hr.size(0), device=device)
+
+        target_vectors = entity_shards.reconstruct(batch_target).to(device=device, dtype=batch_hr.dtype)
+        # scored by torch.mm like the shards, so that ties with other entities are exact
+        target_scores = torch.mm(batch_hr, target_vectors.t()).diagonal().clone()
+        rerank_rows, rerank_cols, rerank_values = get_rerank_boost(batch_examples, entity_dict=entity_dict)
+        if rerank_rows is not None:
+            rerank_rows, rerank_cols = rerank_rows.to(device), rerank_cols.to(device)
+            rerank_values = rerank_values.to(device=device, dtype=target_scores.dtype)
+            is_target = rerank_cols == batch_target[rerank_rows]
+            target_scores.index_add_(0, rerank_rows[is_target], rerank_values[is_target])
+        filter_rows, filter_cols = _block_filter_indices(filter_indices, start, end)
+        filter_rows, filter_cols = filter_rows.to(device), filter_cols.to(device)
+
+        num_higher = torch.zeros(batch_hr.size(0), dtype=torch.long, device=device)
+        batch_topk_scores, batch_topk_indices = None, None
+        for shard_start, shard in entity_shards:
+            shard_end = shard_start + shard.size(0)
+            batch_score = torch.mm(batch_hr, shard.to(device=device, dtype=batch_hr.dtype).t())
+
+            # re-ranking based on topological structure
+            if rerank_rows is not None:
+                in_shard = _in_shard(rerank_cols, shard_start, shard_end)
+                batch_score.index_put_((rerank_rows[in_shard], rerank_cols[in_shard] - shard_start),
+                                       rerank_values[in_shard], accumulate=True)
+            # filter known triplets
+            in_shard = _in_shard(filter_cols, shard_start, shard_end)
+            batch_score[filter_rows[in_shard], filter_cols[in_shard] - shard_start] = -1
+
+            # ties count against the target as in target_ranks
+            num_higher += (batch_score >= target_scores.unsqueeze(1)).sum(dim=1)
+            # the target itself is never counted against itself
+            in_shard = (batch_target >= shard_start) & (batch_target < shard_end)
+            target_rows = row_indices[in_shard]
+            num_higher[target_rows] -= (batch_score[target_rows, batch_target[in_shard] - shard_start]
+                                        >= target_scores[target_rows]).long()
+
+            batch_topk_scores, batch_topk_indices = merge_topk(batch_topk_scores, batch_topk_indices,
+                                                               batch_score, shard_start, k)
+
+        ranks.append(num_higher + 1)
+        _append_block(start, batch_topk_scores, batch_topk_indices, ranks[-1], topk_scores, topk_indices, on_block)
+
+    return _collect_outputs(topk_scores, topk_indices, ranks, total)
+
+
+def _get_rerank_grid() -> List[RerankSetting]:
+    settings = []
+    for mode in args.sweep_rerank_modes.split(','):
+        for neighbor_weight in [float(w) for w in args.sweep_neighbor_weights.split(',')]:
+            # n_hop only matters for hop mode, and not at all without re-ranking
+            n_hops = [int(n) for n in args.sweep_n_hops.split(',')] if mode == 'hop' else [args.rerank_n_hop]
+            for n_hop in n_hops:
+                if neighbor_weight < 1e-6:
+                    setting = RerankSetting(mode='none', neighbor_weight=0.0, n_hop=0)
+                else:
+                    setting = RerankSetting(mode=mode, neighbor_weight=neighbor_weight, n_hop=n_hop)
+                if setting not in settings:
+                    settings.append(setting)
+    return settings
+
+
+@torch.no_grad()
+def sweep_rerank_ranks(hr_tensor: torch.tensor,
+                       entities_tensor: torch.tensor,
+                       target: List[int],
+                       examples: List[HRTExample],
+                       settings: List[RerankSetting],
+                       batch_size=256,
+                       filter_indices: Tuple[torch.tensor, torch.tensor] = None) -> List[torch.tensor]:
+    """1-based ranks under every re-ranking setting against the same raw scores: each query block is scored
+    with a single torch.mm and its filter mask is built once, only the sparse boosts differ per setting."""
+    entity_dict = get_eval_entity_dict()
+    total = hr_tensor.size(0)
+    assert len(entity_dict) == entities_tensor.size(0)
+    target = torch.LongTensor(target).unsqueeze(-1).to(hr_tensor.device)
+    filter_indices = filter_indices or get_filter_indices(examples, target.squeeze(1))
+    ranks = [[] for _ in settings]
+
+    for start in tqdm.tqdm(range(0, total, batch_size)):
+        end = start + batch_size
+        raw_score = torch.mm(hr_tensor[start:end, :], entities_tensor.t())
+        batch_target = target[start:end]
+        filter_rows, filter_cols = _block_filter_indices(filter_indices, start, end)
+        filter_rows, filter_cols = filter_rows.to(raw_score.device), filter_cols.to(raw_score.device)
+
+        for setting, setting_ranks in zip(settings, ranks):
+            batch_score = raw_score.clone()
+            rerank_by_graph(batch_score, examples[start:end], entity_dict=entity_dict, setting=setting)
+            batch_score[filter_rows, filter_cols] = -1
+            setting_ranks.append(target_ranks(batch_score, torch.gather(batch_score, 1, batch_target)))
+
+    return [torch.cat(setting_ranks).cpu() for setting_ranks in ranks]
+
+
+def sweep_by_split(predictor: BertPredictor, entity_tensor: torch.tensor):
+    """Evaluate the grid of re-ranking settings from --sweep-* in one pass and write a single table."""
+    entity_dict = get_eval_entity_dict()
+    settings = _get_rerank_grid()
+    logger.info('Sweep over {} re-ranking settings'.format(len(settings)))
+
+    examples = load_data(args.valid_path, add_forward_triplet=True, add_backward_triplet=True)
+    hr_tensor, _ = predictor.predict_by_examples(examples)
+    hr_tensor = hr_tensor.to(entity_tensor.device)
+    target = [entity_dict.entity_to_idx(ex.tail_id) for ex in examples]
+    setting_ranks = sweep_rerank_ranks(hr_tensor=hr_tensor, entities_tensor=entity_tensor,
+                                       target=target, examples=examples, settings=settings)
+
+    rows = []
+    for idx, setting in enumerate(settings):
+        forward_metrics, backward_metrics = [rank_metrics(ranks) for ranks in split_directions(setting_ranks[idx])]
+        row = {'mode': setting.mode, 'neighbor_weight': setting.neighbor_weight, 'n_hop': setting.n_hop}
+        row.update({k: round((forward_metrics[k] + backward_metrics[k]) / 2, 4) for k in forward_metrics})
+        row.update({'forward_{}'.format(k): v for k, v in forward_metrics.items()})
+        row.update({'backward_{}'.format(k): v for k, v in backward_metrics.items()})
+        logger.info('Sweep {}'.format(json.dumps(row)))
+        rows.append(row)
+
+    prefix, basename = os.path.dirname(args.eval_model_path), os.path.basename(args.eval_model_path)
+    split = os.path.basename(args.valid_path)
+    with open('{}/rerank_sweep_{}_{}.tsv'.format(prefix, split, basename), 'w', encoding='utf-8') as writer:
+        writer.write('\t'.join(rows[0].keys()) + '\n')
+        for row in rows:
+            writer.write('\t'.join(str(v) for v in row.values()) + '\n')
+
+
+def split_directions(items: List) -> Tuple[List, List]:
+    """Forward and backward items, load_data with both directions interleaves the examples of every triplet."""
+    return items[0::2], items[1::2]
 
 
 def predict_by_split():
     assert os.path.exists(args.valid_path)
     assert os.path.exists(args.train_path)
+    entity_dict = get_eval_entity_dict()
 
+    start_time = time()
     predictor = BertPredictor()
     predictor.load(ckt_path=args.eval_model_path)
     entity_tensor = predictor.predict_by_entities(entity_dict.entity_exs)
+    if args.rerank_sweep:
+        sweep_by_split(predictor, entity_tensor)
+        return
+    entity_index = _build_entity_index(entity_tensor)
+    forward_metrics, backward_metrics = eval_both_directions(predictor,
+                                                             entity_tensor=entity_tensor,
+                                                             entity_index=entity_index)
+    write_metrics(forward_metrics, backward_metrics, eval_secs=time() - start_time,
+                  index_type=metrics_index_type(entity_index))
+
+
+def _build_entity_index(entity_tensor: torch.tensor) -> EntityIndex:
+    if args.entity_index == 'exact':
+        return None
+    basename = os.path.basename(args.eval_model_path)
+    return build_entity_index(entity_tensor, index_type=args.entity_index,
+                              nlist=args.index_nlist, nprobe=args.index_nprobe,
+                              pq_m=args.pq_m, rerank_k=args.pq_rerank_k,
+                              store_path='{}/entity_store_{}.npy'.format(args.model_dir, basename))
+
+
+def metrics_index_type(entity_index: EntityIndex = None) -> str:
+    """'exact' if targets are ranked against all entities, otherwise the --entity-index type, whose metrics are
+    approximate: targets are only ranked against the retrieved candidates, so ranks are optimistic."""
+    return 'exact' if entity_index is None or entity_index.exact else args.entity_index
+
+
+def predict_by_checkpoints():
+    """Evaluate every checkpoint matching args.eval_model_glob in one process. Data structures,
+    tokenized entity and query batches and filter indices are built once, for each checkpoint
+    only the weights are swapped before re-encoding and scoring."""
+    entity_dict = get_eval_entity_dict()
+    ckt_paths = sorted(glob.glob(args.eval_model_glob))
+    assert ckt_paths, 'No checkpoint matches {}'.format(args.eval_model_glob)
+    assert os.path.exists(args.valid_path)
+    logger.info('Evaluate {} checkpoints: {}'.format(len(ckt_paths), ckt_paths))
+
+    predictor = BertPredictor()
+    predictor.load(ckt_path=ckt_paths[0])
+    examples = load_data(args.valid_path, add_forward_triplet=True, add_backward_triplet=True)
+    target = [entity_dict.entity_to_idx(ex.tail_id) for ex in examples]
+    entity_batches = list(predictor.build_entity_loader(entity_dict.entity_exs))
+    query_batches = list(predictor.build_example_loader(examples))
+    filter_indices = get_filter_indices(examples, torch.LongTensor(target))
+
+    rows = []
+    for ckt_path in ckt_paths:
+        start_time = time()
+        if ckt_path != ckt_paths[0]:
+            predictor.load_weights(ckt_path)
+        # per-checkpoint outputs are named after args.eval_model_path
+        args.eval_model_path = ckt_path
+        entity_tensor = predictor.predict_entities_by_batches(entity_batches)
+        hr_tensor, _ = predictor.predict_by_batches(query_batches)
+        entity_index = _build_entity_index(entity_tensor)
+        forward_metrics, backward_metrics = score_both_directions(examples, hr_tensor.to(entity_tensor.device),
+                                                                  entity_tensor=entity_tensor,
+                                                                  entity_index=entity_index,
+                                                                  filter_indices=filter_indices)
+        index_type = metrics_index_type(entity_index)
+        write_metrics(forward_metrics, backward_metrics, eval_secs=time() - start_time, index_type=index_type)
+        logger.info('Evaluation of {} takes {} seconds'.format(ckt_path, round(time() - start_time, 3)))
+
+        row = {'checkpoint': os.path.basename(ckt_path), 'index_type': index_type}
+        row.update({k: round((forward_metrics[k] + backward_metrics[k]) / 2, 4) for k in forward_metrics})
+        row.update({'forward_{}'.format(k): v for k, v in forward_metrics.items()})
+        row.update({'backward_{}'.format(k): v for k, v in backward_metrics.items()})
+        rows.append(row)
+
+    best_row = max(rows, key=lambda row: row['mrr'])
+    logger.info('Best checkpoint by mrr: {}'.format(json.dumps(best_row)))
+    split = os.path.basename(args.valid_path)
+    report_path = '{}/metrics_{}_checkpoints.tsv'.format(os.path.dirname(ckt_paths[0]), split)
+    with open(report_path, 'w', encoding='utf-8') as writer:
+        writer.write('\t'.join(rows[0].keys()) + '\n')
+        for row in rows:
+            writer.write('\t'.join(str(v) for v in row.values()) + '\n')
+    logger.info('Write checkpoint comparison to {}'.format(report_path))
 
-    forward_metrics = eval_single_direction(predictor,
-                                            entity_tensor=entity_tensor,
-                                            eval_forward=True)
-    backward_metrics = eval_single_direction(predictor,
-                                             entity_tensor=entity_tensor,
-                                             eval_forward=False)
+
+def write_metrics(forward_metrics: dict, backward_metrics: dict, eval_secs: float = None, index_type: str = 'exact'):
+    """index_type (see metrics_index_type) is written along with the metrics, anything but 'exact' is approximate."""
     metrics = {k: round((forward_metrics[k] + backward_metrics[k]) / 2, 4) for k in forward_metrics}
-    logger.info('Averaged metrics: {}'.format(metrics))
+    if index_type == 'exact':
+        logger.info('Averaged metrics: {}'.format(metrics))
+    else:
+        logger.warning('Approximate averaged metrics of the {} index, targets are only ranked against '
+                       'retrieved candidates, ranks are optimistic: {}'.format(index_type, metrics))
 
     prefix, basename = os.path.dirname(args.eval_model_path), os.path.basename(args.eval_model_path)
     split = os.path.basename(args.valid_path)
+    all_metrics = {'index_type': index_type, 'forward': forward_metrics, 'backward': backward_metrics, 'average': metrics}
     with open('{}/metrics_{}_{}.json'.format(prefix, split, basename), 'w', encoding='utf-8') as writer:
-        writer.write('forward metrics: {}\n'.format(json.dumps(forward_metrics)))
-        writer.write('backward metrics: {}\n'.format(json.dumps(backward_metrics)))
-        writer.write('average metrics: {}\n'.format(json.dumps(metrics)))
+        json.dump(all_metrics, writer, indent=4)
 
+    record = {'checkpoint': basename, 'split': split, **all_metrics}
+    if eval_secs is not None:
+        record['eval_secs'] = round(eval_secs, 3)
+    get_metrics_sink().write('eval', **record)
 
-def eval_single_direction(predictor: BertPredictor,
-                          entity_tensor: torch.tensor,
-                          eval_forward=True,
-                          batch_size=256) -> dict:
+
+def eval_both_directions(predictor: BertPredictor,
+                         entity_tensor: torch.tensor,
+                         batch_size=256,
+                         entity_index: EntityIndex = None,
+                         entity_shards: EntityShards = None) -> Tuple[dict, dict]:
+    """Forward and backward examples are loaded, encoded and scored together in one pass,
+    they are only split by direction for metrics and prediction files. Returns (forward, backward) metrics."""
     start_time = time()
-    examples = load_data(args.valid_path, add_forward_triplet=eval_forward, add_backward_triplet=not eval_forward)
+    examples = load_data(args.valid_path, add_forward_triplet=True, add_backward_triplet=True)
 
     hr_tensor, _ = predictor.predict_by_examples(examples)
-    hr_tensor = hr_tensor.to(entity_tensor.device)
-    target = [entity_dict.entity_to_idx(ex.tail_id) for ex in examples]
+    if entity_tensor is not None:
+        hr_tensor = hr_tensor.to(entity_tensor.device)
     logger.info('predict tensor done, compute metrics...')
 
-    topk_scores, topk_indices, metrics, ranks = compute_metrics(hr_tensor=hr_tensor, entities_tensor=entity_tensor,
-                                                                target=target, examples=examples,
-                                                                batch_size=batch_size)
-    eval_dir = 'forward' if eval_forward else 'backward'
-    logger.info('{} metrics: {}'.format(eval_dir, json.dumps(metrics)))
-
-    pred_infos = []
-    for idx, ex in enumerate(examples):
-        cur_topk_scores = topk_scores[idx]
-        cur_topk_indices = topk_indices[idx]
-        pred_idx = cur_topk_indices[0]
-        cur_score_info = {entity_dict.get_entity_by_idx(topk_idx).entity: round(topk_score, 3)
-                          for topk_score, topk_idx in zip(cur_topk_scores, cur_topk_indices)}
-
-        pred_info = PredInfo(head=ex.head, relation=ex.relation,
-                             tail=ex.tail, pred_tail=entity_dict.get_entity_by_idx(pred_idx).entity,
-                             pred_score=round(cur_topk_scores[0], 4),
-                             topk_score_info=json.dumps(cur_score_info),
-                             rank=ranks[idx],
-                             correct=pred_idx == target[idx])
-        pred_infos.append(pred_info)
+    metrics = score_both_directions(examples, hr_tensor, entity_tensor=entity_tensor, batch_size=batch_size,
+                                    entity_index=entity_index, entity_shards=entity_shards)
+    logger.info('Evaluation takes {} seconds'.format(round(time() - start_time, 3)))
+    return metrics
+
+
+def score_both_directions(examples: List[HRTExample],
+                          hr_tensor: torch.tensor,
+                          entity_tensor: torch.tensor,
+                          batch_size=256,
+                          entity_index: EntityIndex = None,
+                          entity_shards: EntityShards = None,
+                          filter_indices: Tuple[torch.tensor, torch.tensor] = None) -> Tuple[dict, dict]:
+    entity_dict = get_eval_entity_dict()
+    target = [entity_dict.entity_to_idx(ex.tail_id) for ex in examples]
 
+    writers = _open_prediction_writers()
+    on_block = _stream_to_writers(writers, examples, target)
+    if entity_shards is not None:
+        _, _, _, ranks = compute_sharded_metrics(hr_tensor=hr_tensor, entity_shards=entity_shards,
+                                                 target=target, examples=examples,
+                                                 k=args.pred_topk, batch_size=batch_size,
+                                                 filter_indices=filter_indices, on_block=on_block)
+    elif entity_index is None or entity_index.exact:
+        _, _, _, ranks = compute_metrics(hr_tensor=hr_tensor, entities_tensor=entity_tensor,
+                                         target=target, examples=examples,
+                                         k=args.pred_topk, batch_size=batch_size,
+                                         filter_indices=filter_indices, on_block=on_block)
+    else:
+        _, _, _, ranks = compute_candidate_metrics(hr_tensor=hr_tensor, entities_tensor=entity_tensor,
+                                                   target=target, examples=examples, entity_index=entity_index,
+                                                   k=args.pred_topk, batch_size=batch_size,
+                                                   filter_indices=filter_indices, on_block=on_block)
+        if args.index_compare_exact and entity_tensor is not None:
+            _, _, _, exact_ranks = compute_metrics(hr_tensor=hr_tensor, entities_tensor=entity_tensor,
+                                                   target=target, examples=examples, k=1, batch_size=batch_size,
+                                                   filter_indices=filter_indices, on_block=lambda *_: None)
+            for eval_dir, approx_dir_ranks, exact_dir_ranks in zip(['forward', 'backward'],
+                                                                   split_directions(ranks),
+                                                                   split_directions(exact_ranks)):
+                approx_metrics = rank_metrics(torch.LongTensor(approx_dir_ranks))
+                exact_metrics = rank_metrics(torch.LongTensor(exact_dir_ranks))
+                delta = {k: round(approx_metrics[k] - exact_metrics[k], 4) for k in approx_metrics}
+                logger.info('{} {} index metrics minus exact metrics: {}'.format(
+                    eval_dir, args.entity_index, json.dumps(delta)))
+    for writer in writers:
+        writer.close()
+
+    direction_metrics = []
+    index_type = 'exact' if entity_shards is not None else metrics_index_type(entity_index)
+    for eval_dir, dir_ranks in zip(['forward', 'backward'], split_directions(ranks)):
+        metrics = rank_metrics(torch.LongTensor(dir_ranks))
+        if index_type == 'exact':
+            logger.info('{} metrics: {}'.format(eval_dir, json.dumps(metrics)))
+        else:
+            logger.warning('{} approximate metrics of the {} index: {}'.format(eval_dir, index_type, json.dumps(metrics)))
+        direction_metrics.append(metrics)
+
+    return direction_metrics[0], direction_metrics[1]
+
+
+def _open_prediction_writers() -> List[PredictionWriter]:
+    # [forward writer, backward writer], or no writers at all with --pred-format none
+    if args.pred_format == 'none':
+        return []
+    entity_dict = get_eval_entity_dict()
     prefix, basename = os.path.dirname(args.eval_model_path), os.path.basename(args.eval_model_path)
     split = os.path.basename(args.valid_path)
-    with open('{}/eval_{}_{}_{}.json'.format(prefix, split, eval_dir, basename), 'w', encoding='utf-8') as writer:
-        writer.write(json.dumps([asdict(info) for info in pred_infos], ensure_ascii=False, indent=4))
+    fields = args.pred_fields.split(',') if args.pred_fields else None
+    return [PredictionWriter('{}/eval_{}_{}_{}.{}'.format(prefix, split, eval_dir, basename, args.pred_format),
+                             entity_dict=entity_dict, fmt=args.pred_format, fields=fields)
+            for eval_dir in ['forward', 'backward']]
 
-    logger.info('Evaluation takes {} seconds'.format(round(time() - start_time, 3)))
-    return metrics
+
+def _stream_to_writers(writers: List[PredictionWriter], examples: List[HRTExample], target: List[int]) -> Callable:
+    """on_block callback that writes every scored query block to the writer of its direction,
+    forward and backward examples alternate (see split_directions)."""
+
+    def _write_block(start: int, batch_topk_scores: torch.tensor, batch_topk_indices: torch.tensor,
+                     batch_ranks: torch.tensor):
+        if not writers:
+            return
+        batch_topk_scores, batch_topk_indices = batch_topk_scores.tolist(), batch_topk_indices.tolist()
+        batch_ranks = batch_ranks.tolist()
+        end = start + len(batch_ranks)
+        for direction, writer in enumerate(writers):
+            first = start + (direction - start) % 2
+            rows = slice(first - start, None, 2)
+            writer.write(examples[first:end:2], batch_topk_scores[rows], batch_topk_indices[rows],
+                         batch_ranks[rows], target[first:end:2])
+
+    return _write_block
 
 
 if __name__ == '__main__':
-    predict_by_split()
+    if args.eval_model_glob:
+        predict_by_checkpoints()
+    else:
+        predict_by_split()
@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import types
+import torch
+import torch.utils.data
+
+import numpy as np
+
+from time import time
+from typing import List
+from collections import OrderedDict, deque
+
+from config import args
+from triplet import EntityDict, TripletDict, LinkGraph, TailCSR
+from dict_hub import get_context
+from logger_config import logger
+
+SMAPS_FIELDS = ['Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty', 'Swap']
+
+
+def deep_sizeof(obj, seen: set = None) -> int:
+    """Bytes used by obj and everything reachable from it through containers and instance attributes,
+    every object counted once. Tensors and arrays count their data buffers, modules, classes and functions
+    are not followed. Iterative, so deeply nested structures do not hit the recursion limit."""
+    seen = set() if seen is None else seen
+    size = 0
+    stack = [obj]
+    while stack:
+        cur = stack.pop()
+        if id(cur) in seen or isinstance(cur, (type, types.ModuleType, types.FunctionType, types.MethodType)):
+            continue
+        seen.add(id(cur))
+        size += sys.getsizeof(cur)
+        if isinstance(cur, torch.Tensor):
+            size += cur.untyped_storage().nbytes()
+            continue
+        if isinstance(cur, np.ndarray):
+            # getsizeof already includes the buffer of arrays that own their data
+            if cur.base is not None:
+                stack.append(cur.base)
+            continue
+        if isinstance(cur, dict):
+            stack.extend(cur.keys())
+            stack.extend(cur.values())
+        elif isinstance(cur, (list, tuple, set, frozenset, deque)):
+            stack.extend(cur)
+        if hasattr(cur, '__dict__'):
+            stack.append(cur.__dict__)
+        for slot in getattr(type(cur), '__slots__', ()):
+            if hasattr(cur, slot):
+                stack.append(getattr(cur, slot))
+    return size
+
+
+def _element_counts(obj) -> dict:
+    if isinstance(obj, EntityDict):
+        return {'entities': len(obj)}
+    if isinstance(obj, TripletDict):
+        return {'hr_keys': len(obj), 'tails': len(obj.tails), 'triplets': obj.triplet_cnt, 'relations': len(obj.relations)}
+    if isinstance(obj, LinkGraph):
+        return {'nodes': len(obj), 'edges': len(obj.neighbors)}
+    if isinstance(obj, TailCSR):
+        return {'hr_keys': len(obj.keys), 'tails': len(obj.tails)}
+    if hasattr(obj, '__len__'):
+        return {'items': len(obj)}
+    return {}
+
+
+def hub_memory_report(examples: List = None, extra: dict = None) -> OrderedDict:
+    """Deep size in MB and element counts of the data structures of the default RuntimeContext, the example list
+    and any extra named objects. Structures that were not built yet are reported as None and are not built by this call.
+    Objects are measured independently, so memory shared between them is counted for each of them."""
+    ctx = get_context()
+    objects = OrderedDict((name, ctx.get_loaded(name))
+                          for name in ['entity_dict', 'train_triplet_dict', 'all_triplet_dict', 'link_graph'])
+    if examples is not None:
+        objects['examples'] = examples
+    objects.update(extra or {})
+
+    start_time = time()
+    report = OrderedDict()
+    for name, obj in objects.items():
+        if obj is None:
+            report[name] = None
+            continue
+        report[name] = {'type': type(obj).__name__,
+                        'deep_size_mb': round(deep_sizeof(obj) / 1024 ** 2, 1),
+                        **_element_counts(obj)}
+    report['total_mb'] = round(sum(item['deep_size_mb'] for item in report.values() if item), 1)
+    report['secs'] = round(time() - start_time, 3)
+    return report
+
+
+def process_memory(pid: int) -> dict:
+    """Memory of a process in MB from /proc/<pid>/smaps_rollup. Pss splits shared pages among the processes
+    sharing them, Private_Dirty of a forked worker is what it copied on write from its parent."""
+    memory = {}
+    path = '/proc/{}/smaps_rollup'.format(pid)
+    if os.path.exists(path):
+        with open(path, 'r') as reader:
+            for line in reader:
+                key, _, value = line.partition(':')
+                if key in SMAPS_FIELDS:
+                    memory[key.lower() + '_mb'] = round(int(value.split()[0]) / 1024, 1)
+    else:
+        # kernels before 4.14 have no smaps_rollup, only the resident set size is available
+        with open('/proc/{}/status'.format(pid), 'r') as reader:
+            for line in reader:
+                if line.startswith('VmRSS:'):
+                    memory['rss_mb'] = round(int(line.split()[1]) / 1024, 1)
+    return memory
+
+
+def child_pids(pid: int = None) -> List[int]:
+    """Direct child processes of pid (this process by default), e.g. DataLoader workers."""
+    pid = pid or os.getpid()
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name), 'r') as reader:
+                stat = reader.read()
+        except OSError:
+            # the process exited in the meantime
+            continue
+        # the command name in parentheses may contain spaces, the parent pid is the second field after it
+        if int(stat[stat.rfind(')') + 2:].split()[1]) == pid:
+            children.append(int(name))
+    return sorted(children)
+
+
+def worker_memory_report() -> OrderedDict:
+    """Memory of this process and of its children. Workers only exist while a DataLoader iterator is alive,
+    total_pss_mb is the memory actually used by all of them together, unlike the sum of their Rss."""
+    report = OrderedDict(main=process_memory(os.getpid()))
+    report['workers'] = OrderedDict()
+    for pid in child_pids():
+        try:
+            report['workers'][str(pid)] = process_memory(pid)
+        except OSError:
+            continue
+    processes = [report['main']] + list(report['workers'].values())
+    if all('pss_mb' in memory for memory in processes):
+        report['total_pss_mb'] = round(sum(memory['pss_mb'] for memory in processes), 1)
+    return report
+
+
+def main():
+    # takes the usual training arguments, builds the data structures and reports their memory,
+    # then reports worker memory after print_freq batches of the training DataLoader
+    from doc import Dataset, collate, preload_for_workers
+
+    preload_for_workers()
+    get_context().preload('all_triplet_dict')
+    train_dataset = Dataset(path=args.train_path, task=args.task)
+    logger.info('Data structures: {}'.format(json.dumps(hub_memory_report(examples=train_dataset.examples), indent=4)))
+
+    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True,
+                                               collate_fn=collate, num_workers=args.workers)
+    for i, _ in enumerate(train_loader):
+        if i + 1 >= args.print_freq:
+            logger.info('Processes after {} batches: {}'.format(i + 1, json.dumps(worker_memory_report(), indent=4)))
+            break
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import os
+import re
+import json
+import time
+import torch
+import resource
+
+from config import args
+
+
+class MetricsSink:
+    """Structured time series of a training or evaluation run. Every record is one JSON line
+    {"time": ..., "kind": ..., **values} appended to path. If prometheus_path is set, the latest numeric
+    value of every metric is also exported there as gauges in the Prometheus text-file format,
+    e.g. simkgc_train_step_examples_per_sec{run="..."}."""
+
+    def __init__(self, path: str = '', prometheus_path: str = '', run: str = ''):
+        self.writer = open(path, 'a', encoding='utf-8') if path else None
+        self.prometheus_path = prometheus_path
+        self.run = run
+        self.gauges = {}
+
+    def write(self, kind: str, **values):
+        if self.writer is not None:
+            record = {'time': round(time.time(), 3), 'kind': kind}
+            record.update(values)
+            self.writer.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.writer.flush()
+        if self.prometheus_path:
+            for key, value in _flatten(values).items():
+                self.gauges['simkgc_{}_{}'.format(_sanitize(kind), _sanitize(key))] = value
+            self._export_prometheus()
+
+    def _export_prometheus(self):
+        lines = []
+        for name, value in sorted(self.gauges.items()):
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{}{{run="{}"}} {}'.format(name, self.run, value))
+        # node exporters may read the file at any time, so it is replaced atomically
+        with open(self.prometheus_path + '.tmp', 'w', encoding='utf-8') as writer:
+            writer.write('\n'.join(lines) + '\n')
+        os.replace(self.prometheus_path + '.tmp', self.prometheus_path)
+
+
+def _flatten(values: dict, prefix: str = '') -> dict:
+    # numeric leaves of nested dicts, keyed by their joined path
+    flat = {}
+    for key, value in values.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, prefix='{}{}_'.format(prefix, key)))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def _sanitize(name: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name).lower()
+
+
+def memory_high_water() -> dict:
+    """Peak resident set size of this process and peak CUDA memory allocated by torch, in MB."""
+    # ru_maxrss is in kilobytes on Linux
+    memory = {'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    if torch.cuda.is_available():
+        memory['cuda_max_allocated_mb'] = round(torch.cuda.max_memory_allocated() / 1024 ** 2, 1)
+    return memory
+
+
+metrics_sink: MetricsSink = None
+
+
+def get_metrics_sink() -> MetricsSink:
+    global metrics_sink
+    if metrics_sink is None:
+        path = os.path.join(args.model_dir, args.metrics_file) if args.metrics_file else ''
+        metrics_sink = MetricsSink(path=path, prometheus_path=args.prometheus_file,
+                                   run=os.path.basename(os.path.normpath(args.model_dir)))
+    return metrics_sink
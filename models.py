@@ -7,7 +7,7 @@ import torch.nn as nn
 from dataclasses import dataclass
 from transformers import AutoModel, AutoConfig
 
-from triplet_mask import construct_mask
+from triplet_mask import construct_mask_by_indices
 
 from huggingface_hub import PyTorchModelHubMixin
 
@@ -98,7 +98,9 @@ class CustomBertModel(nn.Module,
         # The offset, which is used to keep track of the current position in the pre-batch vectors
         # The pre-batch vectors are updated in a circular manner, reusing the buffer over time
         self.offset = 0
-        self.pre_batch_exs = [None for _ in range(num_pre_batch_vectors)]
+        # entity_dict indices of the tails of the pre-batch vectors, -1 until the buffer is filled,
+        # kept on the CPU where the pre-batch triplet mask is constructed
+        self.pre_batch_tail_idxs = torch.full((num_pre_batch_vectors,), -1, dtype=torch.long)
 
         # Load the pretrained model, once for the hr encoder, and once for the tail encoder
         self.hr_bert = AutoModel.from_pretrained(args.pretrained_model)
@@ -208,17 +210,18 @@ class CustomBertModel(nn.Module,
                                   tail_vector: torch.tensor,
                                   batch_dict: dict) -> torch.tensor:
         assert tail_vector.size(0) == self.batch_size
-        batch_exs = batch_dict['batch_data']
+        tail_idxs = batch_dict['tail_idxs'].cpu()
         # batch_size x num_neg
         pre_batch_logits = hr_vector.mm(self.pre_batch_vectors.clone().t())
         pre_batch_logits *= self.log_inv_t.exp() * self.args.pre_batch_weight
-        if self.pre_batch_exs[-1] is not None:
-            pre_triplet_mask = construct_mask(batch_exs, self.pre_batch_exs).to(hr_vector.device)
-            pre_batch_logits.masked_fill_(~pre_triplet_mask, -1e4)
+        if self.pre_batch_tail_idxs[-1] >= 0:
+            pre_triplet_mask = construct_mask_by_indices(batch_dict['head_idxs'].cpu(), batch_dict['relation_idxs'].cpu(),
+                                                         tail_idxs, col_tail_idxs=self.pre_batch_tail_idxs)
+            pre_batch_logits.masked_fill_(~pre_triplet_mask.to(hr_vector.device), -1e4)
 
         self.pre_batch_vectors[self.offset:(self.offset + self.batch_size)] = tail_vector.data.clone()
-        self.pre_batch_exs[self.offset:(self.offset + self.batch_size)] = batch_exs
-        self.offset = (self.offset + self.batch_size) % len(self.pre_batch_exs)
+        self.pre_batch_tail_idxs[self.offset:(self.offset + self.batch_size)] = tail_idxs
+        self.offset = (self.offset + self.batch_size) % len(self.pre_batch_tail_idxs)
 
         return pre_batch_logits
 
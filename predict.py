@@ -7,7 +7,7 @@ import torch.utils.data
 from typing import List
 from collections import OrderedDict
 
-from doc import collate, HRTExample, Dataset
+from doc import collate, HRTExample, Dataset, preload_for_workers
 from config import args
 from models import build_model
 from utils import AttrDict, move_to_cuda
@@ -35,15 +35,7 @@ class BertPredictor:
         self.model = build_model(self.train_args)
 
         # if there is a model checkpoint (?), we load in the state dict
-
-        # DataParallel will introduce 'module.' prefix
-        state_dict = ckt_dict['state_dict']
-        new_state_dict = OrderedDict()
-        for k, v in state_dict.items():
-            if k.startswith('module.'):
-                k = k[len('module.'):]
-            new_state_dict[k] = v
-        self.model.load_state_dict(new_state_dict, strict=True)
+        self._load_state_dict(ckt_dict['state_dict'])
         self.model.eval()
 
         if use_data_parallel and torch.cuda.device_count() > 1:
@@ -55,6 +47,28 @@ class BertPredictor:
             self.use_cuda = True
         logger.info('Load model from {} successfully'.format(ckt_path))
 
+    def load_weights(self, ckt_path):
+        """Swap in the weights of another checkpoint of the same training run, the model,
+        tokenizer and args are kept from the first load."""
+        assert self.model is not None, 'load must be called first'
+        assert os.path.exists(ckt_path)
+        ckt_dict = torch.load(ckt_path, map_location=lambda storage, loc: storage)
+        for key in ['pretrained_model', 'pooling', 'max_num_tokens', 'use_link_graph']:
+            assert ckt_dict['args'].get(key) == self.train_args.__dict__.get(key), \
+                'Checkpoint {} differs in {} from the loaded model'.format(ckt_path, key)
+        self._load_state_dict(ckt_dict['state_dict'])
+        logger.info('Load weights from {} successfully'.format(ckt_path))
+
+    def _load_state_dict(self, state_dict: dict):
+        # DataParallel will introduce 'module.' prefix
+        new_state_dict = OrderedDict()
+        for k, v in state_dict.items():
+            if k.startswith('module.'):
+                k = k[len('module.'):]
+            new_state_dict[k] = v
+        model = self.model.module if isinstance(self.model, torch.nn.DataParallel) else self.model
+        model.load_state_dict(new_state_dict, strict=True)
+
     def _setup_args(self):
         # pull args into self.train_args, but don't override ones specified in the model checkpoint
         for k, v in args.__dict__.items():
@@ -66,17 +80,38 @@ class BertPredictor:
         args.use_link_graph = self.train_args.use_link_graph
         args.is_test = True
 
-    @torch.no_grad()
-    def predict_by_examples(self, examples: List[HRTExample]):
-        data_loader = torch.utils.data.DataLoader(
+    def build_example_loader(self, examples: List[HRTExample]) -> torch.utils.data.DataLoader:
+        preload_for_workers()
+        return torch.utils.data.DataLoader(
             Dataset(path='', examples=examples, task=args.task),
             num_workers=1,
             batch_size=max(args.batch_size, 512),
             collate_fn=collate,
             shuffle=False)
 
+    def build_entity_loader(self, entity_exs) -> torch.utils.data.DataLoader:
+        preload_for_workers()
+        examples = []
+        for entity_ex in entity_exs:
+            examples.append(HRTExample(head_id='', relation='',
+                                    tail_id=entity_ex.entity_id))
+        return torch.utils.data.DataLoader(
+            Dataset(path='', examples=examples, task=args.task),
+            num_workers=2,
+            batch_size=max(args.batch_size, 1024),
+            collate_fn=collate,
+            shuffle=False)
+
+    @torch.no_grad()
+    def predict_by_examples(self, examples: List[HRTExample]):
+        return self.predict_by_batches(self.build_example_loader(examples))
+
+    @torch.no_grad()
+    def predict_by_batches(self, batches):
+        """batches is a DataLoader from build_example_loader or a list of its collated batches,
+        which can be kept to encode the same examples with several checkpoints."""
         hr_tensor_list, tail_tensor_list = [], []
-        for idx, batch_dict in enumerate(data_loader):
+        for idx, batch_dict in enumerate(batches):
             if self.use_cuda:
                 batch_dict = move_to_cuda(batch_dict)
             outputs = self.model(**batch_dict)
@@ -87,19 +122,12 @@ class BertPredictor:
 
     @torch.no_grad()
     def predict_by_entities(self, entity_exs) -> torch.tensor:
-        examples = []
-        for entity_ex in entity_exs:
-            examples.append(HRTExample(head_id='', relation='',
-                                    tail_id=entity_ex.entity_id))
-        data_loader = torch.utils.data.DataLoader(
-            Dataset(path='', examples=examples, task=args.task),
-            num_workers=2,
-            batch_size=max(args.batch_size, 1024),
-            collate_fn=collate,
-            shuffle=False)
+        return self.predict_entities_by_batches(self.build_entity_loader(entity_exs))
 
+    @torch.no_grad()
+    def predict_entities_by_batches(self, batches) -> torch.tensor:
         ent_tensor_list = []
-        for idx, batch_dict in enumerate(tqdm.tqdm(data_loader)):
+        for idx, batch_dict in enumerate(tqdm.tqdm(batches)):
             batch_dict['only_ent_embedding'] = True
             if self.use_cuda:
                 batch_dict = move_to_cuda(batch_dict)
@@ -109,19 +137,23 @@ class BertPredictor:
         return torch.cat(ent_tensor_list, dim=0)
 
 if __name__ == '__main__':
-    from dict_hub import entity_dict
+    from dict_hub import get_entity_dict
+
+    entity_dict = get_entity_dict()
     
     predictor = BertPredictor()
     predictor.load(ckt_path=args.eval_model_path)
     
     entities = EntityDict(entity_dict_json = args.entities_json)
 
-    entity_tensor = predictor.predict_by_entities(entities.entity_exs)
-    for idx, entity_ex in enumerate(entities.entity_exs):
+    # entity_exs creates new objects on access, keep them in a list to fill in embeddings
+    entity_exs = list(entities.entity_exs)
+    entity_tensor = predictor.predict_by_entities(entity_exs)
+    for idx, entity_ex in enumerate(entity_exs):
         # we need to get it from the GPU as a list of float
         entity_ex.embedding = entity_tensor[idx].cpu().tolist()
 
-    entities.dump_json(args.entities_json.replace('.json', '_embedded.json'))
+    entities.dump_json(args.entities_json.replace('.json', '_embedded.json'), entity_exs=entity_exs)
 
     # # create a new json file with the embeddings called entities_embedded.json
     # with open(args.entities_json.replace('.json', '_embedded.json'), 'w') as f:
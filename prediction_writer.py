@@ -0,0 +1,86 @@
+import os
+import json
+
+from typing import List
+from dataclasses import dataclass, fields
+
+from doc import HRTExample
+from triplet import EntityDict
+
+
+@dataclass
+class PredInfo:
+    head: str
+    relation: str
+    tail: str
+    pred_tail: str
+    pred_score: float
+    topk_score_info: str
+    rank: int
+    correct: bool
+
+
+PRED_FIELDS = [field.name for field in fields(PredInfo)]
+
+
+class PredictionWriter:
+    """Streams the prediction records of one direction to disk, one block of queries at a time,
+    so memory does not grow with the number of test triplets.
+    fmt is 'jsonl' (one record per line) or 'json' (a JSON array, one record per line);
+    fields selects a subset of PredInfo fields, all of them by default.
+    The file is written under a temporary name and renamed on close."""
+
+    def __init__(self, path: str, entity_dict: EntityDict, fmt: str = 'jsonl', fields: List[str] = None):
+        assert fmt in ['jsonl', 'json'], 'Unsupported prediction format: {}'.format(fmt)
+        self.fields = fields or PRED_FIELDS
+        assert all(field in PRED_FIELDS for field in self.fields), 'Unknown prediction fields: {}'.format(self.fields)
+        self.path = path
+        self.fmt = fmt
+        self.entity_dict = entity_dict
+        self.num_records = 0
+        self.writer = open(path + '.tmp', 'w', encoding='utf-8')
+        if fmt == 'json':
+            self.writer.write('[')
+
+    def write(self,
+              examples: List[HRTExample],
+              topk_scores: List[List[float]],
+              topk_indices: List[List[int]],
+              ranks: List[int],
+              target: List[int]):
+        lines = []
+        for ex, cur_topk_scores, cur_topk_indices, rank, cur_target in zip(
+                examples, topk_scores, topk_indices, ranks, target):
+            pred_idx = cur_topk_indices[0]
+            record = {'head': ex.head, 'relation': ex.relation, 'tail': ex.tail,
+                      'pred_tail': self.entity_dict.get_entity_by_idx(pred_idx).entity,
+                      'pred_score': round(cur_topk_scores[0], 4),
+                      'rank': rank, 'correct': pred_idx == cur_target}
+            if 'topk_score_info' in self.fields:
+                score_info = {self.entity_dict.get_entity_by_idx(topk_idx).entity: round(topk_score, 3)
+                              for topk_score, topk_idx in zip(cur_topk_scores, cur_topk_indices)}
+                record['topk_score_info'] = json.dumps(score_info)
+            lines.append(json.dumps({field: record[field] for field in self.fields}, ensure_ascii=False))
+
+        if not lines:
+            return
+        if self.fmt == 'json':
+            self.writer.write(('\n' if self.num_records == 0 else ',\n') + ',\n'.join(lines))
+        else:
+            self.writer.write('\n'.join(lines) + '\n')
+        self.num_records += len(lines)
+
+    def close(self):
+        if self.fmt == 'json':
+            self.writer.write('\n]\n')
+        self.writer.close()
+        os.replace(self.path + '.tmp', self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.writer.close()
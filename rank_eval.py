@@ -0,0 +1,138 @@
+import json
+import random
+import torch
+import torch.nn as nn
+import torch.utils.data
+
+from time import time
+
+from config import args
+from doc import Dataset, HRTExample, collate, load_data
+from triplet import EntityDict
+from dict_hub import get_entity_dict
+from utils import move_to_cuda
+from evaluate import get_eval_entity_dict, compute_metrics, rank_metrics, get_filter_indices, split_directions
+from logger_config import logger
+
+
+class EntityEmbeddingCache:
+    """Entity embeddings from the tail encoder, kept across evaluations during training.
+    The first refresh encodes every entity. Later refreshes re-encode the entities touched by training
+    batches since the previous refresh, then the least recently encoded remaining entities until
+    budget_secs is used up. All embeddings drift as the shared encoder is trained, the budget bounds
+    how stale the untouched ones get."""
+
+    def __init__(self, entity_dict: EntityDict, budget_secs: float, batch_size: int):
+        self.entity_dict = entity_dict
+        self.budget_secs = budget_secs
+        self.batch_size = batch_size
+        self.vectors: torch.tensor = None
+        self.touched = torch.zeros(len(entity_dict), dtype=torch.bool)
+        # refresh round in which every entity was last encoded, -1 for never
+        self.last_refresh = torch.full((len(entity_dict),), -1, dtype=torch.long)
+        self.num_refreshes = 0
+        # indices of the training entity_dict in this one, if they differ, e.g. for wiki5m_ind
+        self._idx_map: torch.tensor = None
+
+    def mark_touched(self, entity_idxs: torch.tensor):
+        """Mark the entities of training batches, given as indices of the default entity_dict, -1 are ignored."""
+        train_entity_dict = get_entity_dict()
+        if self.entity_dict is not train_entity_dict:
+            if self._idx_map is None:
+                entity2idx = self.entity_dict.entity2idx
+                self._idx_map = torch.LongTensor([entity2idx.get(entity_id, -1)
+                                                  for entity_id in train_entity_dict.ids.to_list()])
+            entity_idxs = torch.where(entity_idxs >= 0, self._idx_map[entity_idxs.clamp(min=0)], -1)
+        self.touched[entity_idxs[entity_idxs >= 0]] = True
+
+    @torch.no_grad()
+    def refresh(self, model: nn.Module) -> torch.tensor:
+        start_time = time()
+        if self.vectors is None:
+            order, num_required = torch.arange(len(self.entity_dict)), len(self.entity_dict)
+        else:
+            touched = self.touched.nonzero().squeeze(1)
+            stale = (~self.touched).nonzero().squeeze(1)
+            stale = stale[torch.argsort(self.last_refresh[stale], stable=True)]
+            order, num_required = torch.cat([touched, stale]), touched.numel()
+
+        examples = [HRTExample(head_id='', relation='', tail_id=self.entity_dict.get_entity_by_idx(idx).entity_id)
+                    for idx in order.tolist()]
+        data_loader = torch.utils.data.DataLoader(
+            Dataset(path='', examples=examples, task=args.task),
+            num_workers=args.workers,
+            batch_size=self.batch_size,
+            collate_fn=collate,
+            shuffle=False)
+
+        model.eval()
+        num_encoded = 0
+        for batch_dict in data_loader:
+            if num_encoded >= num_required and time() - start_time > self.budget_secs:
+                break
+            batch_dict['only_ent_embedding'] = True
+            if torch.cuda.is_available():
+                batch_dict = move_to_cuda(batch_dict)
+            ent_vectors = model(**batch_dict)['ent_vectors']
+            if self.vectors is None:
+                self.vectors = ent_vectors.new_zeros(len(self.entity_dict), ent_vectors.size(1))
+            batch_idxs = order[num_encoded:(num_encoded + ent_vectors.size(0))]
+            self.vectors[batch_idxs.to(self.vectors.device)] = ent_vectors
+            self.last_refresh[batch_idxs] = self.num_refreshes
+            num_encoded += batch_idxs.numel()
+
+        self.touched.fill_(False)
+        self.num_refreshes += 1
+        logger.info('Refresh {} of {} entity embeddings ({} touched) takes {} seconds'.format(
+            num_encoded, len(self.entity_dict), num_required, round(time() - start_time, 3)))
+        return self.vectors
+
+
+class SampledRankEvaluator:
+    """Filtered MRR / Hits@k over all entities for a fixed random sample of validation triplets,
+    in both directions, scored against an EntityEmbeddingCache. Queries and filter indices are
+    prepared once and reused by every evaluation."""
+
+    def __init__(self, valid_path: str, sample_size: int, seed: int, batch_size: int):
+        entity_dict = get_eval_entity_dict()
+        examples = load_data(valid_path, add_forward_triplet=True, add_backward_triplet=True)
+        num_triplets = len(examples) // 2
+        triplet_ids = sorted(random.Random(seed).sample(range(num_triplets), min(sample_size, num_triplets)))
+        # keep forward and backward examples interleaved, see evaluate.split_directions
+        self.examples = [examples[2 * triplet_id + direction] for triplet_id in triplet_ids for direction in [0, 1]]
+        self.target = [entity_dict.entity_to_idx(ex.tail_id) for ex in self.examples]
+        self.filter_indices = get_filter_indices(self.examples, torch.LongTensor(self.target))
+        self.query_batches = list(torch.utils.data.DataLoader(
+            Dataset(path='', examples=self.examples, task=args.task),
+            num_workers=args.workers,
+            batch_size=batch_size,
+            collate_fn=collate,
+            shuffle=False,
+            pin_memory=True))
+        self.entity_cache = EntityEmbeddingCache(entity_dict, budget_secs=args.entity_cache_budget_secs,
+                                                 batch_size=batch_size)
+        logger.info('Sample {} of {} validation triplets for full ranking evaluation'.format(
+            len(triplet_ids), num_triplets))
+
+    @torch.no_grad()
+    def evaluate(self, model: nn.Module) -> dict:
+        start_time = time()
+        entity_tensor = self.entity_cache.refresh(model)
+
+        model.eval()
+        hr_vectors = []
+        for batch_dict in self.query_batches:
+            if torch.cuda.is_available():
+                batch_dict = move_to_cuda(batch_dict)
+            hr_vectors.append(model(**batch_dict)['hr_vector'])
+        hr_tensor = torch.cat(hr_vectors, dim=0).to(entity_tensor.device)
+
+        _, _, _, ranks = compute_metrics(hr_tensor=hr_tensor, entities_tensor=entity_tensor,
+                                         target=self.target, examples=self.examples, k=1,
+                                         filter_indices=self.filter_indices, on_block=lambda *_: None)
+        forward_metrics, backward_metrics = [rank_metrics(torch.LongTensor(dir_ranks))
+                                             for dir_ranks in split_directions(ranks)]
+        metrics = {k: round((forward_metrics[k] + backward_metrics[k]) / 2, 4) for k in forward_metrics}
+        logger.info('Sampled full ranking metrics: {}, takes {} seconds'.format(
+            json.dumps(metrics), round(time() - start_time, 3)))
+        return metrics
@@ -1,6 +1,8 @@
 import torch
 
-from typing import List
+from typing import List, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass
 
 from config import args
 from triplet import EntityDict
@@ -8,37 +10,223 @@ from dict_hub import get_link_graph
 from doc import HRTExample
 
 
+@dataclass
+class RerankSetting:
+    """One re-ranking configuration, defaults to the command line values (see default_rerank_setting)."""
+    mode: str
+    neighbor_weight: float
+    n_hop: int
+
+
+def default_rerank_setting() -> RerankSetting:
+    return RerankSetting(mode=args.rerank_mode, neighbor_weight=args.neighbor_weight, n_hop=args.rerank_n_hop)
+
+
+class NeighborhoodCache:
+    """LRU cache of n-hop neighbourhoods: (head_id, n_hop) -> LongTensor of entity indices.
+    A head that appears in many test triplets only runs its BFS once; the least recently used entries
+    are evicted once the cached indices exceed max_bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.entity_dict = None
+        self.cache = OrderedDict()
+
+    def get(self, head_id: str, n_hop: int, entity_dict: EntityDict) -> torch.tensor:
+        # cached indices are only valid for the entity dict they were computed with
+        if entity_dict is not self.entity_dict:
+            self.clear()
+            self.entity_dict = entity_dict
+
+        key = (head_id, n_hop)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        n_hop_indices = get_link_graph().get_n_hop_entity_indices(head_id, entity_dict=entity_dict, n_hop=n_hop)
+        n_hop_indices = torch.LongTensor(sorted(n_hop_indices))
+        self.cache[key] = n_hop_indices
+        self.num_bytes += n_hop_indices.numel() * n_hop_indices.element_size()
+        while self.num_bytes > self.max_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.num_bytes -= evicted.numel() * evicted.element_size()
+        return n_hop_indices
+
+    def clear(self):
+        self.cache.clear()
+        self.num_bytes = 0
+
+
+neighborhood_cache: NeighborhoodCache = None
+
+
+def _get_neighborhood_cache() -> NeighborhoodCache:
+    global neighborhood_cache
+    if neighborhood_cache is None:
+        neighborhood_cache = NeighborhoodCache(max_bytes=args.rerank_cache_mb * 1024 * 1024)
+    return neighborhood_cache
+
+
+class RandomWalkGraph:
+    """Row-normalized adjacency of the link graph in entity index space, stored as CSR tensors.
+    At most max_degree neighbours are kept per node (the first ones in sorted id order, as in
+    LinkGraph.get_neighbor_ids), so one propagation step costs at most max_degree operations
+    per non-zero entry, regardless of how large a hub's neighbourhood is."""
+
+    def __init__(self, entity_dict: EntityDict, max_degree: int):
+        link_graph = get_link_graph()
+        indptr, indices = [0], []
+        for entity_ex in entity_dict.entity_exs:
+            neighbor_ids = link_graph.get_neighbor_ids(entity_ex.entity_id, max_to_keep=max_degree)
+            indices += [entity_dict.entity_to_idx(n_id) for n_id in neighbor_ids if n_id in entity_dict.entity2idx]
+            indptr.append(len(indices))
+        self.entity_dict = entity_dict
+        self.num_nodes = len(entity_dict)
+        self.indptr = torch.LongTensor(indptr)
+        self.indices = torch.LongTensor(indices)
+        self.degree = self.indptr[1:] - self.indptr[:-1]
+
+    def propagate(self, rows: torch.tensor, nodes: torch.tensor, mass: torch.tensor) -> Tuple:
+        """One random walk step for a block of sparse (row, node, mass) distributions, mass on nodes
+        without neighbours is dropped."""
+        degree = self.degree[nodes]
+        has_neighbors = degree > 0
+        rows, nodes, mass, degree = rows[has_neighbors], nodes[has_neighbors], mass[has_neighbors], degree[has_neighbors]
+        within = torch.arange(int(degree.sum())) - torch.repeat_interleave(torch.cumsum(degree, 0) - degree, degree)
+        new_nodes = self.indices[torch.repeat_interleave(self.indptr[nodes], degree) + within]
+        return (torch.repeat_interleave(rows, degree), new_nodes,
+                torch.repeat_interleave(mass / degree, degree))
+
+    def coalesce(self, rows: torch.tensor, nodes: torch.tensor, mass: torch.tensor) -> Tuple:
+        keys, inverse = torch.unique(rows * self.num_nodes + nodes, return_inverse=True)
+        mass = torch.zeros(keys.size(0), dtype=mass.dtype).index_add_(0, inverse, mass)
+        return keys // self.num_nodes, keys % self.num_nodes, mass
+
+
+def _prune(rows: torch.tensor, nodes: torch.tensor, mass: torch.tensor, topk: int) -> Tuple:
+    # keep the topk largest entries of every row
+    order = torch.argsort(mass, descending=True, stable=True)
+    rows, nodes, mass = rows[order], nodes[order], mass[order]
+    order = torch.argsort(rows, stable=True)
+    rows, nodes, mass = rows[order], nodes[order], mass[order]
+    rank_in_row = torch.arange(rows.size(0)) - torch.searchsorted(rows, rows)
+    keep = rank_in_row < topk
+    return rows[keep], nodes[keep], mass[keep]
+
+
+random_walk_graph: RandomWalkGraph = None
+
+
+def _get_random_walk_graph(entity_dict: EntityDict) -> RandomWalkGraph:
+    global random_walk_graph
+    if random_walk_graph is None or random_walk_graph.entity_dict is not entity_dict:
+        random_walk_graph = RandomWalkGraph(entity_dict, max_degree=args.ppr_max_degree)
+    return random_walk_graph
+
+
+def personalized_pagerank(head_idxs: torch.tensor, entity_dict: EntityDict) -> Tuple:
+    """Truncated personalized PageRank for a block of heads at once:
+        alpha * sum_{t=0..ppr_iters} ((1 - alpha) * P)^t e_head
+    where P is the degree-normalized random walk. After every step only the args.ppr_topk largest entries
+    per head are kept, so the cost per query is bounded by ppr_iters * ppr_topk * ppr_max_degree.
+    Returns sparse (row, entity index, score) triples; heads with index -1 get no scores."""
+    graph = _get_random_walk_graph(entity_dict)
+    alpha = args.ppr_alpha
+    is_valid = head_idxs >= 0
+    rows, nodes = torch.arange(head_idxs.size(0))[is_valid], head_idxs[is_valid]
+    mass = torch.ones(rows.size(0), dtype=torch.float)
+
+    ppr_rows, ppr_nodes, ppr_mass = [rows], [nodes], [alpha * mass]
+    for _ in range(args.ppr_iters):
+        rows, nodes, mass = graph.propagate(rows, nodes, (1 - alpha) * mass)
+        rows, nodes, mass = _prune(*graph.coalesce(rows, nodes, mass), topk=args.ppr_topk)
+        ppr_rows.append(rows)
+        ppr_nodes.append(nodes)
+        ppr_mass.append(alpha * mass)
+    return graph.coalesce(torch.cat(ppr_rows), torch.cat(ppr_nodes), torch.cat(ppr_mass))
+
+
+def get_rerank_boost(examples: List[HRTExample],
+                     entity_dict: EntityDict,
+                     setting: RerankSetting = None) -> Tuple[torch.tensor, torch.tensor, torch.tensor]:
+    """Sparse (row, entity index, boost) triples that re-ranking adds to the scores of a query block.
+    With mode 'hop', every entity within n_hop hops of the head gets neighbor_weight;
+    with 'ppr', the boost is neighbor_weight times the personalized PageRank score relative to the row maximum.
+    Returns (None, None, None) if re-ranking is off."""
+    setting = setting or default_rerank_setting()
+
+    if args.task == 'wiki5m_ind':
+        assert setting.neighbor_weight < 1e-6, 'Inductive setting can not use re-rank strategy'
+
+    if setting.neighbor_weight < 1e-6:
+        return None, None, None
+
+    if setting.mode == 'ppr':
+        head_idxs = torch.LongTensor([entity_dict.entity2idx.get(ex.head_id, -1) for ex in examples])
+        rows, cols, scores = personalized_pagerank(head_idxs, entity_dict=entity_dict)
+        row_max = torch.zeros(len(examples)).scatter_reduce_(0, rows, scores, reduce='amax')
+        return rows, cols, setting.neighbor_weight * scores / row_max[rows]
+
+    cache = _get_neighborhood_cache()
+    n_hop_indices = [cache.get(ex.head_id, n_hop=setting.n_hop, entity_dict=entity_dict)
+                     for ex in examples]
+    counts = torch.LongTensor([indices.numel() for indices in n_hop_indices])
+    rows = torch.repeat_interleave(torch.arange(len(examples)), counts)
+    cols = torch.cat(n_hop_indices) if n_hop_indices else torch.LongTensor([])
+    return rows, cols, torch.full((rows.size(0),), setting.neighbor_weight)
+
+
 def rerank_by_graph(batch_score: torch.tensor,
                     examples: List[HRTExample],
-                    entity_dict: EntityDict):
+                    entity_dict: EntityDict,
+                    setting: RerankSetting = None):
+    """Boost the scores of entities near the head with one sparse (batch_size x entity_cnt) add."""
+    rows, cols, values = get_rerank_boost(examples, entity_dict=entity_dict, setting=setting)
+    if rows is None:
+        return
+
+    boost = torch.sparse_coo_tensor(torch.stack([rows, cols]), values.to(batch_score.dtype),
+                                    size=batch_score.size(), check_invariants=False)
+    batch_score.add_(boost.to(batch_score.device))
+
+    # The test set of FB15k237 removes triples that are connected in train set,
+    # so any two entities that are connected in train set will not appear in test,
+    # however, this is not a trick that could generalize.
+    # by default, we do not use this piece of code .
+
+    # if args.task == 'FB15k237':
+    #     n_hop_indices = get_link_graph().get_n_hop_entity_indices(cur_ex.head_id,
+    #                                                               entity_dict=entity_dict,
+    #                                                               n_hop=1)
+    #     n_hop_indices.remove(entity_dict.entity_to_idx(cur_ex.head_id))
+    #     delta = torch.tensor([-0.5 for _ in n_hop_indices]).to(batch_score.device)
+    #     n_hop_indices = torch.LongTensor(list(n_hop_indices)).to(batch_score.device)
+    #
+    #     batch_score[idx].index_add_(0, n_hop_indices, delta)
 
-    if args.task == 'wiki5m_ind':
-        assert args.neighbor_weight < 1e-6, 'Inductive setting can not use re-rank strategy'
 
-    if args.neighbor_weight < 1e-6:
+def rerank_candidates(cand_scores: torch.tensor,
+                      cand_indices: torch.tensor,
+                      target_scores: torch.tensor,
+                      target: torch.tensor,
+                      examples: List[HRTExample],
+                      entity_dict: EntityDict):
+    """Same boost as rerank_by_graph, but applied in-place to the candidates retrieved by an entity index
+    (batch_size x num_candidates) and to the target scores (batch_size), instead of a full score matrix."""
+    rows, cols, values = get_rerank_boost(examples, entity_dict=entity_dict)
+    if rows is None or rows.size(0) == 0:
         return
 
-    for idx in range(batch_score.size(0)):
-        cur_ex = examples[idx]
-        n_hop_indices = get_link_graph().get_n_hop_entity_indices(cur_ex.head_id,
-                                                                  entity_dict=entity_dict,
-                                                                  n_hop=args.rerank_n_hop)
-        delta = torch.tensor([args.neighbor_weight for _ in n_hop_indices]).to(batch_score.device)
-        n_hop_indices = torch.LongTensor(list(n_hop_indices)).to(batch_score.device)
-
-        batch_score[idx].index_add_(0, n_hop_indices, delta)
-
-        # The test set of FB15k237 removes triples that are connected in train set,
-        # so any two entities that are connected in train set will not appear in test,
-        # however, this is not a trick that could generalize.
-        # by default, we do not use this piece of code .
-
-        # if args.task == 'FB15k237':
-        #     n_hop_indices = get_link_graph().get_n_hop_entity_indices(cur_ex.head_id,
-        #                                                               entity_dict=entity_dict,
-        #                                                               n_hop=1)
-        #     n_hop_indices.remove(entity_dict.entity_to_idx(cur_ex.head_id))
-        #     delta = torch.tensor([-0.5 for _ in n_hop_indices]).to(batch_score.device)
-        #     n_hop_indices = torch.LongTensor(list(n_hop_indices)).to(batch_score.device)
-        #
-        #     batch_score[idx].index_add_(0, n_hop_indices, delta)
+    device = cand_indices.device
+    rows, cols, values = rows.to(device), cols.to(device), values.to(device=device, dtype=cand_scores.dtype)
+    # look up the boost of every candidate through sorted (row, entity) keys
+    num_cols = len(entity_dict) + 1
+    boost_keys, order = torch.sort(rows * num_cols + cols)
+    values = values[order]
+    cand_keys = torch.arange(cand_indices.size(0), device=device).unsqueeze(1) * num_cols + cand_indices
+    positions = torch.searchsorted(boost_keys, cand_keys).clamp_(max=boost_keys.size(0) - 1)
+    is_boosted = boost_keys[positions] == cand_keys
+    cand_scores += torch.where(is_boosted, values[positions], torch.zeros_like(cand_scores))
+    is_target = cols == target.to(device)[rows]
+    target_scores.index_add_(0, rows[is_target], values[is_target])
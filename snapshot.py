@@ -0,0 +1,137 @@
+import gc
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+
+from typing import List, Callable
+
+from logger_config import logger
+
+SNAPSHOT_FORMAT = 1
+
+
+def encode_strings(strings: List[str]) -> dict:
+    """String table of UTF-8 bytes: strings[i] is blob[offsets[i]:offsets[i + 1]]."""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+    return {'offsets': offsets, 'blob': np.frombuffer(b''.join(encoded), dtype=np.uint8)}
+
+
+def decode_strings(offsets: np.ndarray, blob: np.ndarray) -> List[str]:
+    data = blob.tobytes()
+    offsets = offsets.tolist()
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as reader:
+        for chunk in iter(lambda: reader.read(1 << 24), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _source_stat(path: str) -> dict:
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def snapshot_path(cls: type, source_paths: List[str], snapshot_dir: str = '') -> str:
+    """Snapshots are kept in <directory of the first source>/.snapshots unless snapshot_dir is given,
+    one directory per class and list of sources."""
+    snapshot_dir = snapshot_dir or os.path.join(os.path.dirname(os.path.abspath(source_paths[0])), '.snapshots')
+    key = hashlib.blake2b('\n'.join(os.path.abspath(path) for path in source_paths).encode('utf-8'),
+                          digest_size=8).hexdigest()
+    return os.path.join(snapshot_dir, '{}-{}'.format(cls.__name__, key))
+
+
+def _is_fresh(path: str, meta: dict, cls: type, source_paths: List[str]) -> bool:
+    if meta.get('format') != SNAPSHOT_FORMAT or meta.get('version') != cls.snapshot_version \
+            or len(meta['sources']) != len(source_paths):
+        return False
+    touched = False
+    for source, source_path in zip(meta['sources'], source_paths):
+        stat = _source_stat(source_path)
+        if stat['path'] != source['path'] or stat['size'] != source['size']:
+            return False
+        if stat['mtime_ns'] != source['mtime_ns']:
+            # e.g. copied or touched, the content hash decides
+            if file_digest(source_path) != source['digest']:
+                return False
+            source['mtime_ns'] = stat['mtime_ns']
+            touched = True
+    if touched:
+        try:
+            _write_meta(path, meta)
+        except OSError:
+            pass
+    return True
+
+
+def _write_meta(path: str, meta: dict):
+    with open(os.path.join(path, 'meta.json.tmp'), 'w', encoding='utf-8') as writer:
+        json.dump(meta, writer, indent=4)
+    os.replace(os.path.join(path, 'meta.json.tmp'), os.path.join(path, 'meta.json'))
+
+
+def load_snapshot(path: str) -> dict:
+    """Arrays of a snapshot directory, memory-mapped read-only."""
+    with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as reader:
+        meta = json.load(reader)
+    return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in meta['arrays']}
+
+
+def save_snapshot(path: str, arrays: dict, cls: type, source_paths: List[str]):
+    """Write arrays and the fingerprints of their sources to a temporary directory, then move it into place,
+    so readers never see a partial snapshot."""
+    # digests are taken before the arrays are written, a source changed meanwhile makes the snapshot stale
+    sources = [dict(_source_stat(source_path), digest=file_digest(source_path)) for source_path in source_paths]
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), array)
+    _write_meta(tmp_path, {'format': SNAPSHOT_FORMAT, 'class': cls.__name__, 'version': cls.snapshot_version,
+                           'sources': sources, 'arrays': sorted(arrays.keys())})
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def load_or_build(cls: type, source_paths: List[str], build: Callable, snapshot_dir: str = '',
+                  enabled: bool = True):
+    """cls.from_arrays() of a fresh snapshot of source_paths, otherwise build() and save its to_arrays().
+    A snapshot is fresh if every source has the recorded size and either the recorded mtime or content hash.
+    Failing to write a snapshot, e.g. to a read-only data directory, only logs a warning.
+    Without any source there is nothing to key a snapshot on, build() is returned without caching."""
+    if not enabled or not source_paths:
+        return build()
+
+    path = snapshot_path(cls, source_paths, snapshot_dir)
+    meta_path = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as reader:
+            meta = json.load(reader)
+        if _is_fresh(path, meta, cls, source_paths):
+            logger.info('Load {} snapshot from {}'.format(cls.__name__, path))
+            # the rebuilt containers only hold strings and cannot form cycles,
+            # garbage collections triggered by their millions of allocations would only cost time
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                return cls.from_arrays(load_snapshot(path))
+            finally:
+                if gc_enabled:
+                    gc.enable()
+        logger.info('{} snapshot in {} is stale, rebuild it'.format(cls.__name__, path))
+
+    obj = build()
+    try:
+        save_snapshot(path, obj.to_arrays(), cls, source_paths)
+        logger.info('Save {} snapshot to {}'.format(cls.__name__, path))
+    except OSError as e:
+        logger.warning('Failed to save {} snapshot to {}: {}'.format(cls.__name__, path, e))
+    return obj
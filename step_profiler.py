@@ -0,0 +1,108 @@
+import json
+import torch
+
+from time import time
+from collections import OrderedDict
+
+from logger_config import logger
+
+
+class StepProfiler:
+    """Wall-clock time per phase of the training step. mark(phase) closes the current phase; with
+    device synchronization, so that asynchronous CUDA kernels are charged to the phase that launched them.
+    'data' is the time the training loop waits for the next batch. 'collate' and 'mask' are measured inside
+    collate, by the DataLoader workers if there are any, so they overlap with training in that case.
+    Disabled profilers cost nothing beyond a function call per phase.
+
+    A torch.profiler trace of global steps [trace_start, trace_end) is exported to trace_dir if trace_end > 0.
+    A trace starts at the first step inside that range, e.g. after --resume, and close() exports a trace
+    that is still open when an epoch or training ends first, the file name gives the steps actually traced."""
+
+    PHASES = ['data', 'collate', 'mask', 'h2d', 'forward', 'backward', 'optimizer', 'other']
+
+    def __init__(self, enabled: bool, trace_start: int = 0, trace_end: int = 0, trace_dir: str = ''):
+        self.enabled = enabled
+        self.sync = torch.cuda.is_available()
+        self.trace_start, self.trace_end, self.trace_dir = trace_start, trace_end, trace_dir
+        self.trace = None
+        self.trace_first_step, self.trace_last_step = None, None
+        self.last_time = None
+        self.reset()
+
+    def reset(self):
+        self.totals = OrderedDict((phase, 0.0) for phase in self.PHASES)
+        self.num_steps = 0
+        self.num_examples = 0
+        self.num_tokens = 0
+        self.num_padded_tokens = 0
+
+    def start(self):
+        if self.enabled:
+            self._synchronize()
+            self.last_time = time()
+
+    def mark(self, phase: str):
+        if not self.enabled:
+            return
+        self._synchronize()
+        now = time()
+        self.totals[phase] += now - self.last_time
+        self.last_time = now
+
+    def add_batch(self, batch_dict: dict):
+        if not self.enabled:
+            return
+        self.num_steps += 1
+        self.num_examples += batch_dict['hr_token_ids'].size(0)
+        self.totals['collate'] += float(batch_dict.get('collate_secs', 0.0))
+        self.totals['mask'] += float(batch_dict.get('mask_secs', 0.0))
+        # hr, tail and head sequences are all encoded
+        for key in ['hr_mask', 'tail_mask', 'head_mask']:
+            self.num_tokens += int(batch_dict[key].sum())
+            self.num_padded_tokens += batch_dict[key].numel()
+
+    def summary(self) -> dict:
+        step_secs = sum(secs for phase, secs in self.totals.items() if phase not in ['collate', 'mask'])
+        num_steps = max(self.num_steps, 1)
+        return {
+            'examples_per_sec': round(self.num_examples / max(step_secs, 1e-9), 1),
+            'tokens_per_sec': round(self.num_tokens / max(step_secs, 1e-9), 1),
+            'padding_ratio': round(1 - self.num_tokens / max(self.num_padded_tokens, 1), 4),
+            'ms_per_step': {phase: round(1000 * secs / num_steps, 2) for phase, secs in self.totals.items()},
+        }
+
+    def log(self, prefix: str = ''):
+        if self.enabled:
+            logger.info('{}step profile: {}'.format(prefix, json.dumps(self.summary())))
+
+    def step_begin(self, global_step: int):
+        if self.trace is None and self.trace_start <= global_step < self.trace_end:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.trace.__enter__()
+            self.trace_first_step = global_step
+
+    def step_end(self, global_step: int):
+        if self.trace is None:
+            return
+        self.trace_last_step = global_step
+        if global_step + 1 >= self.trace_end:
+            self.close()
+
+    def close(self):
+        """Exit and export the open trace, if any."""
+        if self.trace is None:
+            return
+        self.trace.__exit__(None, None, None)
+        if self.trace_last_step is not None:
+            path = '{}/trace_steps{}-{}.json'.format(self.trace_dir, self.trace_first_step, self.trace_last_step + 1)
+            self.trace.export_chrome_trace(path)
+            logger.info('Export torch.profiler trace to {}'.format(path))
+        self.trace = None
+        self.trace_first_step, self.trace_last_step = None, None
+
+    def _synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize()
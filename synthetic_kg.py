@@ -0,0 +1,167 @@
+import os
+import json
+import argparse
+
+import numpy as np
+
+from typing import List
+
+from logger_config import logger
+
+
+def kg_vocab(num_words: int, num_relations: int) -> List[str]:
+    """Words used in entity names, descriptions and relations of a generated graph,
+    e.g. to build the vocabulary of a tokenizer for it."""
+    return ['w{}'.format(i) for i in range(num_words)] + ['r{}'.format(i) for i in range(num_relations)]
+
+
+def _power_law(size: int, alpha: float, rng: np.random.Generator) -> np.ndarray:
+    # zipf-like probabilities over a random permutation, so that popular ids are spread over the index space
+    probs = np.arange(1, size + 1, dtype=np.float64) ** -alpha
+    return (probs / probs.sum())[rng.permutation(size)]
+
+
+def _sample_triplets(num_triplets: int, num_entities: int, num_relations: int,
+                     alpha: float, multi_tail_ratio: float, max_fanout: int,
+                     rng: np.random.Generator) -> np.ndarray:
+    head_probs = _power_law(num_entities, alpha, rng)
+    tail_probs = _power_law(num_entities, alpha, rng)
+    relation_probs = _power_law(num_relations, 1.0, rng)
+    # mean number of tails per (head, relation) for every relation, 1 for one-to-one relations
+    fanout = np.where(rng.random(num_relations) < multi_tail_ratio,
+                      rng.integers(2, max_fanout + 1, size=num_relations), 1)
+
+    keys = np.zeros(0, dtype=np.int64)
+    while len(keys) < num_triplets:
+        num_groups = max(1024, (num_triplets - len(keys)) // 2)
+        heads = rng.choice(num_entities, size=num_groups, p=head_probs)
+        relations = rng.choice(num_relations, size=num_groups, p=relation_probs)
+        sizes = np.minimum(rng.geometric(1.0 / fanout[relations]), max_fanout)
+        heads, relations = np.repeat(heads, sizes), np.repeat(relations, sizes)
+        tails = rng.choice(num_entities, size=len(heads), p=tail_probs)
+        valid = heads != tails
+        new_keys = (heads[valid] * num_relations + relations[valid]) * num_entities + tails[valid]
+        keys = np.unique(np.concatenate([keys, new_keys]))
+
+    keys = rng.permutation(keys)[:num_triplets]
+    heads, rest = np.divmod(keys, num_relations * num_entities)
+    relations, tails = np.divmod(rest, num_entities)
+    return np.stack([heads, relations, tails], axis=1)
+
+
+def _random_texts(num_texts: int, min_words: int, max_words: int, word_probs: np.ndarray,
+                  rng: np.random.Generator) -> List[str]:
+    lengths = rng.integers(min_words, max_words + 1, size=num_texts)
+    words = rng.choice(len(word_probs), size=int(lengths.sum()), p=word_probs)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    words = ['w{}'.format(word) for word in words.tolist()]
+    return [' '.join(words[offsets[i]:offsets[i + 1]]) for i in range(num_texts)]
+
+
+def _write_json_list(path: str, objs, chunk_size: int = 100000):
+    # records are streamed one chunk at a time, the same layout as json.dump of a list
+    with open(path, 'w', encoding='utf-8') as writer:
+        writer.write('[')
+        chunk = []
+        is_first = True
+        for obj in objs:
+            chunk.append(json.dumps(obj, ensure_ascii=False))
+            if len(chunk) >= chunk_size:
+                writer.write(('\n' if is_first else ',\n') + ',\n'.join(chunk))
+                chunk, is_first = [], False
+        if chunk:
+            writer.write(('\n' if is_first else ',\n') + ',\n'.join(chunk))
+        writer.write('\n]\n')
+
+
+def generate_kg(out_dir: str,
+                num_triplets: int,
+                num_entities: int = 0,
+                num_relations: int = 50,
+                alpha: float = 1.0,
+                multi_tail_ratio: float = 0.3,
+                max_fanout: int = 20,
+                num_words: int = 5000,
+                min_desc_words: int = 0,
+                max_desc_words: int = 40,
+                valid_ratio: float = 0.05,
+                test_ratio: float = 0.05,
+                seed: int = 0) -> dict:
+    """Write entities.json, train.txt.json, valid.txt.json and test.txt.json of a random knowledge graph
+    to out_dir, in the same format as the preprocessed datasets.
+
+    Heads and tails are drawn from power-law distributions over entities, so degrees are heavy-tailed.
+    A multi_tail_ratio fraction of relations is one-to-many: every sampled (head, relation) gets a geometric
+    number of tails, up to max_fanout, and popular heads are sampled repeatedly, so fan-outs are heavy-tailed too.
+    Names and descriptions are random words w0, w1, ... with zipf frequencies.
+    num_entities defaults to num_triplets // 5. Returns statistics of the graph, also saved as stats.json."""
+    rng = np.random.default_rng(seed)
+    num_entities = num_entities or max(100, num_triplets // 5)
+    os.makedirs(out_dir, exist_ok=True)
+
+    triplets = _sample_triplets(num_triplets, num_entities, num_relations, alpha=alpha,
+                                multi_tail_ratio=multi_tail_ratio, max_fanout=max_fanout, rng=rng)
+    word_probs = _power_law(num_words, 1.0, rng)
+    names = _random_texts(num_entities, 1, 3, word_probs, rng)
+    descs = _random_texts(num_entities, min_desc_words, max_desc_words, word_probs, rng)
+    entity_ids = ['SYN:{}'.format(i) for i in range(num_entities)]
+
+    _write_json_list(os.path.join(out_dir, 'entities.json'),
+                     ({'entity_id': entity_id, 'entity': name, 'entity_desc': desc}
+                      for entity_id, name, desc in zip(entity_ids, names, descs)))
+
+    num_valid, num_test = int(len(triplets) * valid_ratio), int(len(triplets) * test_ratio)
+    splits = {'valid': triplets[:num_valid],
+              'test': triplets[num_valid:(num_valid + num_test)],
+              'train': triplets[(num_valid + num_test):]}
+    for split, split_triplets in splits.items():
+        _write_json_list(os.path.join(out_dir, '{}.txt.json'.format(split)),
+                         ({'head_id': entity_ids[h], 'head': names[h], 'relation': 'r{}'.format(r),
+                           'tail_id': entity_ids[t], 'tail': names[t]}
+                          for h, r, t in split_triplets.tolist()))
+
+    degrees = np.bincount(triplets[:, [0, 2]].ravel(), minlength=num_entities)
+    _, fanouts = np.unique(triplets[:, 0] * num_relations + triplets[:, 1], return_counts=True)
+    stats = {'num_triplets': int(len(triplets)), 'num_entities': num_entities, 'num_relations': num_relations,
+             'num_train': len(splits['train']), 'num_valid': num_valid, 'num_test': num_test,
+             'max_degree': int(degrees.max()), 'median_degree': float(np.median(degrees)),
+             'max_tails_per_hr': int(fanouts.max()), 'multi_tail_hr_ratio': round(float((fanouts > 1).mean()), 4),
+             'num_words': num_words, 'seed': seed}
+    with open(os.path.join(out_dir, 'stats.json'), 'w', encoding='utf-8') as writer:
+        json.dump(stats, writer, indent=4)
+    logger.info('Generate synthetic graph in {}: {}'.format(out_dir, json.dumps(stats)))
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='generate a synthetic knowledge graph dataset')
+    parser.add_argument('--out-dir', required=True, type=str,
+                        help='output directory for entities.json and train / valid / test .txt.json')
+    parser.add_argument('--num-triplets', default=100000, type=int,
+                        help='number of triplets over all splits')
+    parser.add_argument('--num-entities', default=0, type=int,
+                        help='number of entities, 0 means num_triplets / 5')
+    parser.add_argument('--num-relations', default=50, type=int,
+                        help='number of relations')
+    parser.add_argument('--alpha', default=1.0, type=float,
+                        help='exponent of the power-law head and tail distributions')
+    parser.add_argument('--multi-tail-ratio', default=0.3, type=float,
+                        help='fraction of one-to-many relations')
+    parser.add_argument('--max-fanout', default=20, type=int,
+                        help='maximum number of tails drawn at once for a (head, relation) of one-to-many relations')
+    parser.add_argument('--num-words', default=5000, type=int,
+                        help='vocabulary size of names and descriptions')
+    parser.add_argument('--max-desc-words', default=40, type=int,
+                        help='maximum number of words per entity description')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='random seed')
+    args = parser.parse_args()
+
+    generate_kg(args.out_dir, args.num_triplets, num_entities=args.num_entities,
+                num_relations=args.num_relations, alpha=args.alpha, multi_tail_ratio=args.multi_tail_ratio,
+                max_fanout=args.max_fanout, num_words=args.num_words, max_desc_words=args.max_desc_words,
+                seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
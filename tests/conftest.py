@@ -0,0 +1,81 @@
+import os
+import json
+import random
+
+import pytest
+
+import rerank
+import evaluate
+import metrics_sink
+
+from config import parse_args
+from dict_hub import RuntimeContext, set_context
+
+NUM_ENTITIES = 30
+RELATIONS = ['part of', 'has phenotype', 'interacts with']
+
+
+def _triplet(head: int, relation: str, tail: int) -> dict:
+    return {'head_id': 'E{}'.format(head), 'head': 'entity {}'.format(head), 'relation': relation,
+            'tail_id': 'E{}'.format(tail), 'tail': 'entity {}'.format(tail)}
+
+
+def write_kg(data_dir: str, seed: int = 0) -> str:
+    """Small graph in the layout of the real datasets: entities.json and train / valid / test .txt.json.
+    E0 and E4 have keys with several tails, E7 is its own neighbor, the last entity has no triplet at all."""
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    entities = [{'entity_id': 'E{}'.format(i), 'entity': 'entity {}'.format(i),
+                 'entity_desc': 'description of entity {}'.format(i)} for i in range(NUM_ENTITIES)]
+    # a few keys with several tails, then random triplets among all but the last entity
+    train = [_triplet(0, RELATIONS[0], tail) for tail in [1, 2, 3]] + [_triplet(4, RELATIONS[1], tail) for tail in [5, 6]]
+    train += [_triplet(7, RELATIONS[2], 7), _triplet(7, RELATIONS[2], 8)]
+    train += [_triplet(rng.randrange(NUM_ENTITIES - 1), rng.choice(RELATIONS), rng.randrange(NUM_ENTITIES - 1))
+              for _ in range(60)]
+    splits = {'train.txt.json': train,
+              'valid.txt.json': [_triplet(rng.randrange(NUM_ENTITIES - 1), rng.choice(RELATIONS),
+                                          rng.randrange(NUM_ENTITIES - 1)) for _ in range(12)] + train[:4],
+              'test.txt.json': [_triplet(rng.randrange(NUM_ENTITIES - 1), rng.choice(RELATIONS),
+                                         rng.randrange(NUM_ENTITIES - 1)) for _ in range(12)]}
+    with open(os.path.join(data_dir, 'entities.json'), 'w', encoding='utf-8') as writer:
+        json.dump(entities, writer)
+    for name, triplets in splits.items():
+        with open(os.path.join(data_dir, name), 'w', encoding='utf-8') as writer:
+            json.dump(triplets, writer)
+    return data_dir
+
+
+def _reset_module_caches():
+    evaluate.entity_dict, evaluate.tail_csr = None, None
+    rerank.neighborhood_cache, rerank.random_walk_graph = None, None
+    metrics_sink.metrics_sink = None
+
+
+@pytest.fixture
+def kg_dir(tmp_path) -> str:
+    return write_kg(str(tmp_path / 'data'))
+
+
+@pytest.fixture
+def make_context(tmp_path):
+    """Factory of default RuntimeContexts over a data directory, module level caches of other contexts are dropped."""
+
+    def _make_context(data_dir: str, *argv: str) -> RuntimeContext:
+        _reset_module_caches()
+        args = parse_args(['--task', 'synthetic',
+                           '--train-path', os.path.join(data_dir, 'train.txt.json'),
+                           '--valid-path', os.path.join(data_dir, 'valid.txt.json'),
+                           '--model-dir', str(tmp_path / 'model'),
+                           '--snapshot-dir', str(tmp_path / 'snapshots'), *argv])
+        ctx = RuntimeContext(args=args)
+        set_context(ctx)
+        return ctx
+
+    yield _make_context
+    set_context(None)
+    _reset_module_caches()
+
+
+@pytest.fixture
+def kg_context(kg_dir, make_context) -> RuntimeContext:
+    return make_context(kg_dir)
@@ -0,0 +1,63 @@
+import torch
+import pytest
+
+from doc import load_data
+from evaluate import target_ranks, compute_metrics, compute_sharded_metrics, get_eval_entity_dict
+from entity_index import EntityShards
+
+
+def test_target_ranks_distinct_scores():
+    batch_score = torch.tensor([[0.1, 0.9, 0.5, 0.3],
+                                [0.8, 0.2, 0.4, 0.6]])
+    target = torch.LongTensor([[2], [0]])
+    assert target_ranks(batch_score, torch.gather(batch_score, 1, target)).tolist() == [2, 1]
+
+
+def test_target_ranks_ties_count_against_target():
+    batch_score = torch.tensor([[0.5, 0.9, 0.5, 0.5],
+                                [0.3, 0.3, 0.3, 0.3],
+                                [0.7, 0.7, -1.0, 0.1]])
+    target = torch.LongTensor([[2], [0], [1]])
+    # 0.9 and the two other 0.5 rank before the target, a collapsed row ranks its target last
+    assert target_ranks(batch_score, torch.gather(batch_score, 1, target)).tolist() == [4, 4, 2]
+
+
+def test_compute_metrics_k_larger_than_entity_count(kg_context):
+    examples = load_data(kg_context.args.valid_path)
+    entity_dict = get_eval_entity_dict()
+    generator = torch.Generator().manual_seed(0)
+    hr_tensor = torch.randn(len(examples), 8, generator=generator)
+    entities_tensor = torch.randn(len(entity_dict), 8, generator=generator)
+    target = [entity_dict.entity_to_idx(ex.tail_id) for ex in examples]
+
+    topk_scores, topk_indices, _, ranks = compute_metrics(hr_tensor, entities_tensor, target, examples,
+                                                          k=len(entity_dict) + 10)
+    assert [len(indices) for indices in topk_indices] == [len(entity_dict)] * len(examples)
+    assert all(1 <= rank <= len(entity_dict) for rank in ranks)
+
+
+def _random_inputs(examples, num_entities: int, dim: int = 8):
+    generator = torch.Generator().manual_seed(0)
+    return torch.randn(len(examples), dim, generator=generator), torch.randn(num_entities, dim, generator=generator)
+
+
+@pytest.mark.parametrize('neighbor_weight', [0.0, 0.05, 0.5])
+def test_sharded_metrics_match_in_memory(kg_context, tmp_path, neighbor_weight):
+    kg_context.args.neighbor_weight = neighbor_weight
+    examples = load_data(kg_context.args.valid_path)
+    entity_dict = get_eval_entity_dict()
+    hr_tensor, entities_tensor = _random_inputs(examples, len(entity_dict))
+    target = [entity_dict.entity_to_idx(ex.tail_id) for ex in examples]
+
+    # uneven shards, one of them a single entity
+    shard_paths = []
+    for i, (start, end) in enumerate([(0, 7), (7, 8), (8, 19), (19, len(entity_dict))]):
+        shard_paths.append(str(tmp_path / 'shard_{}'.format(i)))
+        torch.save(entities_tensor[start:end].clone(), shard_paths[-1])
+
+    expected = compute_metrics(hr_tensor, entities_tensor, target, examples, k=5, batch_size=7)
+    actual = compute_sharded_metrics(hr_tensor, EntityShards(shard_paths), target, examples, k=5, batch_size=7)
+    assert actual[3] == expected[3]
+    assert actual[1] == expected[1]
+    assert torch.allclose(torch.tensor(actual[0]), torch.tensor(expected[0]))
+    assert actual[2] == expected[2]
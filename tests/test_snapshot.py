@@ -0,0 +1,125 @@
+import os
+import json
+
+import numpy as np
+import pytest
+
+from snapshot import load_or_build, snapshot_path
+from triplet import EntityDict, TripletDict, LinkGraph
+
+
+class _CountingBuild:
+    # build callable of load_or_build that records whether the snapshot was bypassed
+
+    def __init__(self, build):
+        self.build = build
+        self.num_calls = 0
+
+    def __call__(self):
+        self.num_calls += 1
+        return self.build()
+
+
+def _load(cls, source_paths, build, snapshot_dir):
+    counting_build = _CountingBuild(build)
+    obj = load_or_build(cls, source_paths, counting_build, snapshot_dir=snapshot_dir)
+    return obj, counting_build.num_calls
+
+
+def _assert_same_triplet_dict(actual: TripletDict, expected: TripletDict):
+    assert actual.entity_ids == expected.entity_ids
+    assert actual.relations == expected.relations
+    assert actual.triplet_cnt == expected.triplet_cnt
+    for name in ['keys', 'offsets', 'tails']:
+        assert np.array_equal(getattr(actual, name), getattr(expected, name))
+
+
+@pytest.fixture
+def train_path(kg_dir) -> str:
+    return os.path.join(kg_dir, 'train.txt.json')
+
+
+def test_round_trip(kg_dir, train_path, tmp_path):
+    snapshot_dir = str(tmp_path / 'snapshots')
+    entities_path = os.path.join(kg_dir, 'entities.json')
+    builds = [(EntityDict, [entities_path], lambda: EntityDict(entity_dict_dir=kg_dir)),
+              (TripletDict, [train_path], lambda: TripletDict(path_list=[train_path])),
+              (LinkGraph, [train_path], lambda: LinkGraph(train_path=train_path))]
+    for cls, source_paths, build in builds:
+        built, num_calls = _load(cls, source_paths, build, snapshot_dir)
+        assert num_calls == 1
+        loaded, num_calls = _load(cls, source_paths, build, snapshot_dir)
+        assert num_calls == 0
+        assert type(loaded) is cls
+
+        if cls is EntityDict:
+            assert [ex.__dict__ for ex in loaded.entity_exs] == [ex.__dict__ for ex in built.entity_exs]
+            assert loaded.entity2idx == built.entity2idx
+        elif cls is TripletDict:
+            _assert_same_triplet_dict(loaded, built)
+        else:
+            assert loaded.node2idx == built.node2idx
+            for entity_id in built.node2idx:
+                assert loaded.get_neighbor_ids(entity_id, max_to_keep=100) == built.get_neighbor_ids(entity_id, max_to_keep=100)
+
+
+def test_touched_source_reuses_snapshot(train_path, tmp_path):
+    snapshot_dir = str(tmp_path / 'snapshots')
+    build = lambda: TripletDict(path_list=[train_path])
+    built, _ = _load(TripletDict, [train_path], build, snapshot_dir)
+
+    stat = os.stat(train_path)
+    os.utime(train_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 10))
+    loaded, num_calls = _load(TripletDict, [train_path], build, snapshot_dir)
+    assert num_calls == 0
+    _assert_same_triplet_dict(loaded, built)
+
+    # the new mtime is recorded, so the content is not hashed again
+    with open(os.path.join(snapshot_path(TripletDict, [train_path], snapshot_dir), 'meta.json')) as reader:
+        assert json.load(reader)['sources'][0]['mtime_ns'] == os.stat(train_path).st_mtime_ns
+
+
+def test_same_size_different_content_rebuilds(train_path, tmp_path):
+    snapshot_dir = str(tmp_path / 'snapshots')
+    build = lambda: TripletDict(path_list=[train_path])
+    _load(TripletDict, [train_path], build, snapshot_dir)
+
+    with open(train_path, 'r', encoding='utf-8') as reader:
+        content = reader.read()
+    stat = os.stat(train_path)
+    # the first triplet E0 -> E1 becomes E0 -> E9, same number of bytes
+    with open(train_path, 'w', encoding='utf-8') as writer:
+        writer.write(content.replace('"tail_id": "E1"', '"tail_id": "E9"', 1))
+    os.utime(train_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 10))
+    assert os.stat(train_path).st_size == stat.st_size
+
+    loaded, num_calls = _load(TripletDict, [train_path], build, snapshot_dir)
+    assert num_calls == 1
+    assert 'E9' in loaded.get_neighbors('E0', 'part of')
+    _assert_same_triplet_dict(_load(TripletDict, [train_path], build, snapshot_dir)[0], loaded)
+
+
+def test_resized_source_rebuilds(train_path, tmp_path):
+    snapshot_dir = str(tmp_path / 'snapshots')
+    build = lambda: TripletDict(path_list=[train_path])
+    _load(TripletDict, [train_path], build, snapshot_dir)
+
+    with open(train_path, 'r', encoding='utf-8') as reader:
+        triplets = json.load(reader)
+    with open(train_path, 'w', encoding='utf-8') as writer:
+        json.dump(triplets[:-1], writer)
+
+    loaded, num_calls = _load(TripletDict, [train_path], build, snapshot_dir)
+    assert num_calls == 1
+    assert loaded.triplet_cnt == 2 * (len(triplets) - 1)
+
+
+def test_unwritable_snapshot_dir_falls_back_to_build(train_path, tmp_path):
+    # a snapshot directory below a regular file can not be created, whatever the permissions
+    blocker = tmp_path / 'blocker'
+    blocker.write_text('')
+    snapshot_dir = str(blocker / 'snapshots')
+
+    loaded, num_calls = _load(TripletDict, [train_path], lambda: TripletDict(path_list=[train_path]), snapshot_dir)
+    assert num_calls == 1
+    assert loaded.triplet_cnt > 0
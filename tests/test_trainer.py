@@ -0,0 +1,67 @@
+import os
+import shutil
+
+import pytest
+import torch
+
+transformers = pytest.importorskip('transformers')
+if not hasattr(transformers, 'AdamW'):
+    pytest.skip('trainer imports transformers.AdamW, which this transformers release no longer has',
+                allow_module_level=True)
+
+from trainer import Trainer
+
+
+@pytest.fixture
+def tiny_bert(tmp_path) -> str:
+    # a randomly initialized two layer BERT with a word level vocabulary of the synthetic graph
+    bert_dir = str(tmp_path / 'tiny_bert')
+    os.makedirs(bert_dir)
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', ':', 'inverse', 'part', 'of', 'has', 'phenotype',
+             'interacts', 'with', 'entity', 'description'] + [str(i) for i in range(30)]
+    with open(os.path.join(bert_dir, 'vocab.txt'), 'w', encoding='utf-8') as writer:
+        writer.write('\n'.join(vocab) + '\n')
+    config = transformers.BertConfig(vocab_size=len(vocab), hidden_size=32, num_hidden_layers=2,
+                                     num_attention_heads=2, intermediate_size=64, max_position_embeddings=64)
+    transformers.BertModel(config).save_pretrained(bert_dir)
+    transformers.BertTokenizer(os.path.join(bert_dir, 'vocab.txt')).save_pretrained(bert_dir)
+    return bert_dir
+
+
+def test_resume_continues_from_saved_position(kg_dir, tiny_bert, make_context, tmp_path):
+    # 134 training examples make 16 batches per epoch, the state written by the last evaluation
+    # of epoch 0 after step 15 is resumed from, half way through the pre-batch ring
+    ctx = make_context(kg_dir, '--pretrained-model', tiny_bert, '--batch-size', '8', '--epochs', '2',
+                       '--eval-every-n-step', '5', '--print-freq', '1000', '--pre-batch', '2',
+                       '--use-self-negative', '--finetune-t', '--workers', '0', '--seed', '3')
+    args = ctx.args
+    state_path = os.path.join(args.model_dir, 'training_state.pt')
+
+    uninterrupted = Trainer(args, ngpus_per_node=0)
+    uninterrupted.train_epoch(0)
+    uninterrupted.checkpoint_writer.wait()
+    shutil.copy(state_path, str(tmp_path / 'saved_state.pt'))
+    uninterrupted.train_epoch(1)
+    uninterrupted.checkpoint_writer.wait()
+    expected_rng_state = torch.get_rng_state()
+    shutil.copy(str(tmp_path / 'saved_state.pt'), state_path)
+
+    resumed = Trainer(args, ngpus_per_node=0)
+    resumed._load_training_state()
+    assert (resumed.start_epoch, resumed.start_step) == (0, 15)
+    resumed.train_epoch(0)
+    resumed.train_epoch(1)
+    resumed.checkpoint_writer.wait()
+
+    expected, actual = uninterrupted.model.state_dict(), resumed.model.state_dict()
+    assert expected.keys() == actual.keys()
+    for name in expected:
+        assert torch.equal(expected[name], actual[name]), name
+
+    assert uninterrupted.scheduler.state_dict() == resumed.scheduler.state_dict()
+    expected_optimizer, actual_optimizer = uninterrupted.optimizer.state_dict(), resumed.optimizer.state_dict()
+    assert expected_optimizer['param_groups'] == actual_optimizer['param_groups']
+    for idx, param_state in expected_optimizer['state'].items():
+        for key, value in param_state.items():
+            assert torch.equal(torch.as_tensor(value), torch.as_tensor(actual_optimizer['state'][idx][key]))
+    assert torch.equal(torch.get_rng_state(), expected_rng_state)
@@ -0,0 +1,137 @@
+import json
+import random
+import torch
+
+import numpy as np
+
+from collections import defaultdict
+
+from doc import HRTExample, load_data
+from triplet import TripletDict, TailCSR
+from triplet_mask import example_indices, construct_mask, construct_mask_by_indices, \
+    construct_self_negative_mask, construct_self_negative_mask_by_indices
+
+
+def _reference_neighbors(path_list) -> dict:
+    # (head_id, relation) -> set of tail ids, with the reversed triplets
+    neighbors = defaultdict(set)
+    for path in path_list:
+        for ex in json.load(open(path, 'r', encoding='utf-8')):
+            neighbors[(ex['head_id'], ex['relation'])].add(ex['tail_id'])
+            neighbors[(ex['tail_id'], 'inverse {}'.format(ex['relation']))].add(ex['head_id'])
+    return neighbors
+
+
+def _queries(triplet_dict: TripletDict, reference: dict) -> list:
+    # every known key, plus keys with an unknown head, an unknown relation or an unknown combination
+    queries = sorted(reference.keys())
+    queries += [('E29', 'part of'), ('unknown', 'part of'), ('E0', 'unknown relation')]
+    queries += [(entity_id, relation) for entity_id in triplet_dict.entity_ids[:5] for relation in triplet_dict.relations]
+    return queries
+
+
+def _query_indices(triplet_dict: TripletDict, queries: list) -> tuple:
+    return (np.array([triplet_dict.entity_to_idx(h) for h, _ in queries], dtype=np.int64),
+            np.array([triplet_dict.relation_to_idx(r) for _, r in queries], dtype=np.int64))
+
+
+def test_triplet_dict_matches_reference(kg_context):
+    path_list = [kg_context.args.train_path, kg_context.args.valid_path]
+    triplet_dict = TripletDict(path_list=path_list)
+    reference = _reference_neighbors(path_list)
+    queries = _queries(triplet_dict, reference)
+    head_idxs, relation_idxs = _query_indices(triplet_dict, queries)
+    assert (head_idxs == -1).any() and (relation_idxs == -1).any()
+    assert any(len(tails) > 1 for tails in reference.values())
+
+    assert len(triplet_dict) == len(reference)
+    for h, r in queries:
+        assert triplet_dict.get_neighbors(h, r) == reference.get((h, r), set())
+
+    expected_counts = [len(reference.get(query, ())) for query in queries]
+    assert triplet_dict.count_tails(head_idxs, relation_idxs).tolist() == expected_counts
+
+    rows, tails = triplet_dict.lookup(head_idxs, relation_idxs)
+    looked_up = defaultdict(set)
+    for row, tail in zip(rows.tolist(), tails.tolist()):
+        looked_up[queries[row]].add(triplet_dict.entity_ids[tail])
+    assert looked_up == {query: reference[query] for query in queries if query in reference}
+
+    # the first and last keys of the sorted key array
+    for key in [triplet_dict.keys[0], triplet_dict.keys[-1]]:
+        h, r = triplet_dict.entity_ids[key // triplet_dict.num_relations], triplet_dict.relations[key % triplet_dict.num_relations]
+        tails = triplet_dict.get_tail_indices(triplet_dict.entity_to_idx(h), triplet_dict.relation_to_idx(r))
+        assert set(triplet_dict.entity_ids[t] for t in tails.tolist()) == reference[(h, r)]
+
+
+def test_triplet_dict_contains(kg_context):
+    path_list = [kg_context.args.train_path]
+    triplet_dict = TripletDict(path_list=path_list)
+    reference = _reference_neighbors(path_list)
+    entity_ids = triplet_dict.entity_ids + ['unknown']
+    rng = random.Random(0)
+
+    triplets = [(h, r, t) for (h, r), tails in sorted(reference.items()) for t in sorted(tails)]
+    triplets += [(rng.choice(entity_ids), rng.choice(triplet_dict.relations + ['unknown relation']), rng.choice(entity_ids))
+                 for _ in range(2000)]
+    head_idxs, relation_idxs = _query_indices(triplet_dict, [(h, r) for h, r, _ in triplets])
+    tail_idxs = np.array([triplet_dict.entity_to_idx(t) for _, _, t in triplets], dtype=np.int64)
+    expected = [t in reference.get((h, r), ()) for h, r, t in triplets]
+    assert triplet_dict.contains(head_idxs, relation_idxs, tail_idxs).tolist() == expected
+    assert any(not found for found in expected)
+
+
+def test_tail_csr_matches_reference(kg_context):
+    entity_dict = kg_context.entity_dict
+    triplet_dict = kg_context.all_triplet_dict
+    reference = _reference_neighbors(triplet_dict.path_list)
+    csr = TailCSR(triplet_dict, entity_dict)
+    queries = _queries(triplet_dict, reference)
+
+    head_idxs = [entity_dict.entity2idx.get(h, -1) for h, _ in queries]
+    relation_idxs = [csr.relation_to_idx(r) for _, r in queries]
+    rows, tails = csr.lookup(head_idxs, relation_idxs)
+    looked_up = defaultdict(set)
+    for row, tail in zip(rows.tolist(), tails.tolist()):
+        looked_up[queries[row]].add(entity_dict.get_entity_by_idx(tail).entity_id)
+    assert looked_up == {query: reference[query] for query in queries if query in reference}
+
+
+def _reference_mask(row_exs, col_exs, reference: dict) -> torch.tensor:
+    # the loop of the original construct_mask over the train neighbors of every row
+    positive_on_diagonal = col_exs is None
+    col_exs = row_exs if col_exs is None else col_exs
+    mask = torch.tensor([[row.tail_id != col.tail_id for col in col_exs] for row in row_exs])
+    if positive_on_diagonal:
+        mask.fill_diagonal_(True)
+    for i, row in enumerate(row_exs):
+        neighbor_ids = reference.get((row.head_id, row.relation), set())
+        if len(neighbor_ids) <= 1:
+            continue
+        for j, col in enumerate(col_exs):
+            if not (i == j and positive_on_diagonal) and col.tail_id in neighbor_ids:
+                mask[i][j] = False
+    return mask
+
+
+def test_masks_match_reference(kg_context):
+    reference = _reference_neighbors([kg_context.args.train_path])
+    examples = load_data(kg_context.args.train_path)
+    # heads and relations without training triplets, and a head with several tails
+    row_exs = examples[:24] + [HRTExample(head_id='E29', relation='part of', tail_id='E1'),
+                               HRTExample(head_id='E0', relation='unknown relation', tail_id='E2'),
+                               HRTExample(head_id='E0', relation='part of', tail_id='E0')]
+    col_exs = examples[24:40] + load_data(kg_context.args.valid_path)
+
+    assert torch.equal(construct_mask(row_exs), _reference_mask(row_exs, None, reference))
+    assert torch.equal(construct_mask(row_exs, col_exs), _reference_mask(row_exs, col_exs, reference))
+
+    head_idxs, relation_idxs, tail_idxs = example_indices(row_exs)
+    col_tail_idxs = example_indices(col_exs)[2]
+    assert torch.equal(construct_mask_by_indices(head_idxs, relation_idxs, tail_idxs, col_tail_idxs=col_tail_idxs),
+                       _reference_mask(row_exs, col_exs, reference))
+
+    expected = torch.tensor([ex.head_id not in reference.get((ex.head_id, ex.relation), set()) for ex in row_exs])
+    assert not expected.all()
+    assert torch.equal(construct_self_negative_mask(row_exs), expected)
+    assert torch.equal(construct_self_negative_mask_by_indices(head_idxs, relation_idxs), expected)
@@ -0,0 +1,30 @@
+import pytest
+
+from utils import ResumableRandomSampler
+
+
+@pytest.mark.parametrize('start', [0, 1, 17, 36, 37])
+def test_resumed_sampler_yields_tail_of_epoch(start):
+    sampler = ResumableRandomSampler(37, seed=5)
+    for epoch in [0, 3]:
+        sampler.set_epoch(epoch)
+        full_epoch = list(sampler)
+        assert sorted(full_epoch) == list(range(37))
+
+        sampler.set_epoch(epoch, start=start)
+        assert list(sampler) == full_epoch[start:]
+        assert len(sampler) == 37 - start
+
+        # a new sampler with the same seed, as after a restart
+        resumed = ResumableRandomSampler(37, seed=5)
+        resumed.set_epoch(epoch, start=start)
+        assert list(resumed) == full_epoch[start:]
+
+
+def test_sampler_shuffles_every_epoch():
+    sampler = ResumableRandomSampler(37, seed=5)
+    permutations = []
+    for epoch in range(3):
+        sampler.set_epoch(epoch)
+        permutations.append(list(sampler))
+    assert permutations[0] != permutations[1] != permutations[2]
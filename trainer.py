@@ -1,8 +1,13 @@
 import glob
 import json
 import torch
+import random
 import shutil
 
+import numpy as np
+
+from time import time
+
 import torch.nn as nn
 import torch.utils.data
 
@@ -10,10 +15,14 @@ from typing import Dict
 from transformers import get_linear_schedule_with_warmup, get_cosine_schedule_with_warmup
 from transformers import AdamW
 
-from doc import Dataset, collate
-from utils import AverageMeter, ProgressMeter
-from utils import save_checkpoint, delete_old_ckt, report_num_trainable_parameters, move_to_cuda, get_model_obj
+from doc import Dataset, BATCH_CPU_KEYS, collate, preload_for_workers
+from utils import AverageMeter, ProgressMeter, ResumableRandomSampler
+from utils import CheckpointWriter, delete_old_ckt, report_num_trainable_parameters, move_to_cuda, get_model_obj
 from metric import accuracy
+from step_profiler import StepProfiler
+from rank_eval import SampledRankEvaluator
+from metrics_sink import get_metrics_sink, memory_high_water
+from memory_report import hub_memory_report, worker_memory_report
 from models import build_model, ModelOutput
 from dict_hub import build_tokenizer
 from logger_config import logger, logger_add_file_handler
@@ -83,59 +92,160 @@ class Trainer:
                                weight_decay=args.weight_decay)
         report_num_trainable_parameters(self.model)
 
+        preload_for_workers()
         train_dataset = Dataset(path=args.train_path, task=args.task)
         valid_dataset = Dataset(path=args.valid_path, task=args.task) if args.valid_path else None
+        if args.memory_report:
+            self._write_memory_report('memory_hub', hub_memory_report(examples=train_dataset.examples))
         num_training_steps = args.epochs * len(train_dataset) // max(args.batch_size, 1)
         args.warmup = min(args.warmup, num_training_steps // 10)
         logger.info('Total training steps: {}, warmup steps: {}'.format(num_training_steps, args.warmup))
         self.scheduler = self._create_lr_scheduler(num_training_steps)
+        self.scaler = torch.cuda.amp.GradScaler() if args.use_amp else None
         self.best_metric = None
-
+        self.checkpoint_writer = CheckpointWriter()
+        trace_steps = [int(step) for step in args.profile_trace_steps.split(',')] if args.profile_trace_steps else [0, 0]
+        self.step_profiler = StepProfiler(enabled=args.profile, trace_start=trace_steps[0], trace_end=trace_steps[1],
+                                          trace_dir=args.model_dir)
+
+        # the shuffling order is a function of (sampler_seed, epoch) and the loader has its own generator,
+        # so that a resumed run sees the same batches and global RNG draws as an uninterrupted one
+        self.sampler_seed = args.seed if args.seed is not None else random.randrange(2 ** 31)
+        self.train_sampler = ResumableRandomSampler(len(train_dataset), seed=self.sampler_seed)
+        self.num_batches_per_epoch = len(train_dataset) // args.batch_size
         self.train_loader = torch.utils.data.DataLoader(
             train_dataset,
             batch_size=args.batch_size,
-            shuffle=True,
+            sampler=self.train_sampler,
             collate_fn=collate,
             num_workers=args.workers,
             pin_memory=True,
-            drop_last=True)
+            drop_last=True,
+            generator=torch.Generator())
+        # position to continue training from, moved by --resume
+        self.start_epoch, self.start_step = 0, 0
+
+        self.rank_evaluator = None
+        if valid_dataset and args.eval_rank_sample > 0:
+            self.rank_evaluator = SampledRankEvaluator(args.valid_path, sample_size=args.eval_rank_sample,
+                                                       seed=args.seed or 0, batch_size=args.batch_size * 2)
 
         self.valid_loader = None
+        # collated (and pinned) once on the first evaluation, then replayed in the same order
+        self.valid_batches = None
         if valid_dataset:
             self.valid_loader = torch.utils.data.DataLoader(
                 valid_dataset,
                 batch_size=args.batch_size * 2,
-                shuffle=True,
+                shuffle=False,
                 collate_fn=collate,
                 num_workers=args.workers,
-                pin_memory=True)
+                pin_memory=True,
+                generator=torch.Generator())
 
-    def train_loop(self):
-        if self.args.use_amp:
-            self.scaler = torch.cuda.amp.GradScaler()
+        if args.resume:
+            self._load_training_state()
 
-        for epoch in range(self.args.epochs):
-            # train for one epoch
-            self.train_epoch(epoch)
-            self._run_eval(epoch=epoch)
+    def train_loop(self):
+        try:
+            for epoch in range(self.start_epoch, self.args.epochs):
+                # train for one epoch
+                self.train_epoch(epoch)
+                self._run_eval(epoch=epoch)
+        finally:
+            # a trace still open when training ends or fails is exported as far as it got
+            self.step_profiler.close()
+        self.checkpoint_writer.wait()
 
     @torch.no_grad()
     def _run_eval(self, epoch, step=0):
+        start_time = time()
         metric_dict = self.eval_epoch(epoch)
-        is_best = self.valid_loader and (self.best_metric is None or metric_dict['Acc@1'] > self.best_metric['Acc@1'])
+        if self.rank_evaluator:
+            metric_dict.update(self.rank_evaluator.evaluate(self.model))
+        get_metrics_sink().write('valid', epoch=epoch, step=step, metrics=metric_dict,
+                                 eval_secs=round(time() - start_time, 3), memory=memory_high_water())
+        is_best = self.valid_loader and (self.best_metric is None or self._is_better(metric_dict, self.best_metric))
         if is_best:
             self.best_metric = metric_dict
 
         filename = '{}/checkpoint_{}_{}.mdl'.format(self.args.model_dir, epoch, step)
         if step == 0:
             filename = '{}/checkpoint_epoch{}.mdl'.format(self.args.model_dir, epoch)
-        save_checkpoint({
+        # best / last are hardlinks to the checkpoint, which outlive its rotation
+        link_names = ['{}/model_last.mdl'.format(self.args.model_dir)]
+        if is_best:
+            link_names.append('{}/model_best.mdl'.format(self.args.model_dir))
+        # step == 0 means the epoch is complete
+        training_state = self._training_state(epoch=epoch + 1 if step == 0 else epoch, step=step)
+        path_pattern = '{}/checkpoint_*.mdl'.format(self.args.model_dir)
+        self.checkpoint_writer.save([({'epoch': epoch,
+                                       'args': self.args.__dict__,
+                                       'state_dict': self.model.state_dict()}, filename, link_names),
+                                     (training_state, self._training_state_path(), [])],
+                                    after_write=lambda: delete_old_ckt(path_pattern=path_pattern,
+                                                                       keep=self.args.max_to_keep))
+
+    def _training_state_path(self) -> str:
+        return '{}/training_state.pt'.format(self.args.model_dir)
+
+    def _training_state(self, epoch: int, step: int) -> dict:
+        """Everything needed to continue training at batch step of epoch, see --resume."""
+        model = get_model_obj(self.model)
+        state = {
             'epoch': epoch,
+            'step': step,
             'args': self.args.__dict__,
-            'state_dict': self.model.state_dict(),
-        }, is_best=is_best, filename=filename)
-        delete_old_ckt(path_pattern='{}/checkpoint_*.mdl'.format(self.args.model_dir),
-                       keep=self.args.max_to_keep)
+            'state_dict': model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict(),
+            'scaler': self.scaler.state_dict() if self.scaler else None,
+            'best_metric': self.best_metric,
+            'sampler_seed': self.sampler_seed,
+            'pre_batch': {'vectors': model.pre_batch_vectors,
+                          'offset': model.offset,
+                          'tail_idxs': model.pre_batch_tail_idxs},
+            'rng': {'python': random.getstate(),
+                    'numpy': np.random.get_state(),
+                    'torch': torch.get_rng_state(),
+                    'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None},
+        }
+        return state
+
+    def _load_training_state(self):
+        path = self._training_state_path()
+        assert os.path.exists(path), 'No training state to resume from: {}'.format(path)
+        state = torch.load(path, map_location=lambda storage, loc: storage, weights_only=False)
+
+        model = get_model_obj(self.model)
+        model.load_state_dict(state['state_dict'], strict=True)
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.scheduler.load_state_dict(state['scheduler'])
+        if self.scaler and state['scaler']:
+            self.scaler.load_state_dict(state['scaler'])
+        self.best_metric = state['best_metric']
+        self.sampler_seed = state['sampler_seed']
+        self.train_sampler.seed = self.sampler_seed
+
+        pre_batch = state['pre_batch']
+        model.pre_batch_vectors.copy_(pre_batch['vectors'])
+        model.offset = pre_batch['offset']
+        model.pre_batch_tail_idxs.copy_(pre_batch['tail_idxs'])
+
+        random.setstate(state['rng']['python'])
+        np.random.set_state(state['rng']['numpy'])
+        torch.set_rng_state(state['rng']['torch'])
+        if torch.cuda.is_available() and state['rng']['cuda'] is not None:
+            torch.cuda.set_rng_state_all(state['rng']['cuda'])
+
+        self.start_epoch, self.start_step = state['epoch'], state['step']
+        logger.info('Resume training from {} at epoch {}, step {}'.format(path, self.start_epoch, self.start_step))
+
+    def _is_better(self, metric_dict: Dict, best_metric: Dict) -> bool:
+        key = self.args.best_metric
+        if key == 'mean_rank':
+            return metric_dict[key] < best_metric[key]
+        return metric_dict[key] > best_metric[key]
 
     @torch.no_grad()
     def eval_epoch(self, epoch) -> Dict:
@@ -146,23 +256,25 @@ class Trainer:
         top1 = AverageMeter('Acc@1', ':6.2f')
         top3 = AverageMeter('Acc@3', ':6.2f')
 
-        for i, batch_dict in enumerate(self.valid_loader):
+        if self.valid_batches is None:
+            self.valid_batches = list(self.valid_loader)
+        for i, batch_dict in enumerate(self.valid_batches):
             self.model.eval()
 
             if torch.cuda.is_available():
-                batch_dict = move_to_cuda(batch_dict)
-            batch_size = len(batch_dict['batch_data'])
+                batch_dict = move_to_cuda(batch_dict, cpu_keys=BATCH_CPU_KEYS)
+            batch_size = batch_dict['hr_token_ids'].size(0)
 
             outputs = self.model(**batch_dict)
             outputs = get_model_obj(self.model).compute_logits(output_dict=outputs, batch_dict=batch_dict)
             outputs = ModelOutput(**outputs)
             logits, labels = outputs.logits, outputs.labels
             loss = self.criterion(logits, labels)
-            losses.update(loss.item(), batch_size)
+            losses.update(loss, batch_size)
 
             acc1, acc3 = accuracy(logits, labels, topk=(1, 3))
-            top1.update(acc1.item(), batch_size)
-            top3.update(acc3.item(), batch_size)
+            top1.update(acc1, batch_size)
+            top3.update(acc3, batch_size)
 
         metric_dict = {'Acc@1': round(top1.avg, 3),
                        'Acc@3': round(top3.avg, 3),
@@ -176,17 +288,31 @@ class Trainer:
         top3 = AverageMeter('Acc@3', ':6.2f')
         inv_t = AverageMeter('InvT', ':6.2f')
         progress = ProgressMeter(
-            len(self.train_loader),
+            self.num_batches_per_epoch,
             [losses, inv_t, top1, top3],
             prefix="Epoch: [{}]".format(epoch))
 
-        for i, batch_dict in enumerate(self.train_loader):
+        # only the first epoch after --resume starts in the middle
+        start_step = self.start_step if epoch == self.start_epoch else 0
+        self.train_sampler.set_epoch(epoch, start=start_step * self.args.batch_size)
+        profiler = self.step_profiler
+        profiler.reset()
+        profiler.start()
+        for i, batch_dict in enumerate(self.train_loader, start=start_step):
+            global_step = epoch * self.num_batches_per_epoch + i
+            profiler.step_begin(global_step)
+            profiler.mark('data')
+            profiler.add_batch(batch_dict)
             # switch to train mode
             self.model.train()
+            if self.rank_evaluator:
+                self.rank_evaluator.entity_cache.mark_touched(
+                    torch.cat([batch_dict['head_idxs'], batch_dict['tail_idxs']]))
 
             if torch.cuda.is_available():
-                batch_dict = move_to_cuda(batch_dict)
-            batch_size = len(batch_dict['batch_data'])
+                batch_dict = move_to_cuda(batch_dict, cpu_keys=BATCH_CPU_KEYS)
+            batch_size = batch_dict['hr_token_ids'].size(0)
+            profiler.mark('h2d')
 
             # compute output
             if self.args.use_amp:
@@ -202,34 +328,65 @@ class Trainer:
             loss = self.criterion(logits, labels)
             # tail -> head + relation
             loss += self.criterion(logits[:, :batch_size].t(), labels)
+            profiler.mark('forward')
 
+            # meters keep device tensors, they are only synchronized at print frequency
             acc1, acc3 = accuracy(logits, labels, topk=(1, 3))
-            top1.update(acc1.item(), batch_size)
-            top3.update(acc3.item(), batch_size)
+            top1.update(acc1, batch_size)
+            top3.update(acc3, batch_size)
 
             inv_t.update(outputs.inv_t, 1)
-            losses.update(loss.item(), batch_size)
+            losses.update(loss, batch_size)
+            profiler.mark('other')
 
             # compute gradient and do SGD step
             self.optimizer.zero_grad()
             if self.args.use_amp:
                 self.scaler.scale(loss).backward()
+            else:
+                loss.backward()
+            profiler.mark('backward')
+            if self.args.use_amp:
                 self.scaler.unscale_(self.optimizer)
                 torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.args.grad_clip)
                 self.scaler.step(self.optimizer)
                 self.scaler.update()
             else:
-                loss.backward()
                 torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.args.grad_clip)
                 self.optimizer.step()
             self.scheduler.step()
+            profiler.mark('optimizer')
+            profiler.step_end(global_step)
 
             if i % self.args.print_freq == 0:
                 progress.display(i)
+                self._write_step_metrics(epoch, i, global_step, losses, top1, top3, inv_t)
+                if self.args.memory_report:
+                    # DataLoader workers are alive while the epoch is iterated
+                    self._write_memory_report('memory_workers', worker_memory_report())
+                profiler.log(prefix='Epoch: [{}][{}] '.format(epoch, i))
+                profiler.reset()
             if (i + 1) % self.args.eval_every_n_step == 0:
                 self._run_eval(epoch=epoch, step=i + 1)
+            # evaluation and logging are not charged to the next step
+            profiler.start()
+        # the end-of-epoch evaluation is not traced, the next epoch starts a new trace if still in range
+        profiler.close()
         logger.info('Learning rate: {}'.format(self.scheduler.get_last_lr()[0]))
 
+    def _write_step_metrics(self, epoch: int, step: int, global_step: int,
+                            losses: AverageMeter, top1: AverageMeter, top3: AverageMeter, inv_t: AverageMeter):
+        record = {'epoch': epoch, 'step': step, 'global_step': global_step,
+                  'loss': losses.avg, 'Acc@1': top1.avg, 'Acc@3': top3.avg, 'inv_t': inv_t.val,
+                  'lr': self.scheduler.get_last_lr()[0], 'memory': memory_high_water()}
+        if self.step_profiler.enabled:
+            record['profile'] = self.step_profiler.summary()
+        get_metrics_sink().write('train_step', **record)
+
+    def _write_memory_report(self, kind: str, report: dict):
+        logger.info('{}: {}'.format(kind, json.dumps(report)))
+        get_metrics_sink().write(kind, **report)
+
     def _setup_training(self):
         if torch.cuda.device_count() > 1:
             self.model = torch.nn.DataParallel(self.model).cuda()
@@ -4,10 +4,12 @@ import json
 from typing import List
 from dataclasses import dataclass
 from collections import deque
+from collections.abc import Sequence
 
 from logger_config import logger
+from snapshot import encode_strings, decode_strings
 
-import pandas as pd
+import numpy as np
 
 
 
@@ -24,12 +26,50 @@ class EntityExample:
     embedding: List[float] = None
 
 
+class StringTable:
+    """Strings in one contiguous UTF-8 buffer, strings[i] is blob[offsets[i]:offsets[i + 1]].
+       Reading a string decodes a new str and touches no per-string Python objects, so a table built
+       (or memory-mapped from a snapshot) before DataLoader workers are forked stays shared with them
+       instead of being copied on write page by page."""
+
+    def __init__(self, offsets: np.ndarray, blob: np.ndarray):
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def from_strings(cls, strings: List[str]):
+        table = encode_strings(strings)
+        return cls(table['offsets'], table['blob'])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('string table index {} out of range'.format(idx))
+        return self.blob[int(self.offsets[idx]):int(self.offsets[idx + 1])].tobytes().decode('utf-8')
+
+    def to_list(self) -> List[str]:
+        return decode_strings(self.offsets, self.blob)
+
+
 class TripletDict:
-    """TripeletDict.hr2tails: {(head_id, relation): {tail_id1, tail_id2, ...}}
+    """Known tails of every (head, relation) of the triplets in a list of files, including the reversed triplets.
        Initialize with TripletDict(path_list=["file1.json", "file2.json", ...])
        
        Where file1.json looks like:
-       [ {"head_id": "HGNC:6483", "head": "LAMA3", "relation": "subclass of", "tail_id": "SO:0000704", "tail": "gene"}, ... ]"""
+       [ {"head_id": "HGNC:6483", "head": "LAMA3", "relation": "subclass of", "tail_id": "SO:0000704", "tail": "gene"}, ... ]
+
+       Entity ids and relations are interned: entity_ids[i] is the id of entity index i, relations[r] the name of
+       relation index r. Keys are sorted int64 composites head_idx * num_relations + relation_idx, and
+       tails[offsets[i]:offsets[i + 1]] are the sorted tail indices of keys[i], the same layout as TailCSR.
+       Lookups by id go through entity_to_idx / relation_to_idx, bulk lookups and membership tests
+       take index arrays, unknown ids map to -1 and have no tails."""
+
+    # bumped whenever to_arrays changes, older snapshots are rebuilt
+    snapshot_version = 2
 
     def __init__(self, path_list: List[str]):
         """path_list: list of paths to the triplet files. Each file should be a list of dictionaries,
@@ -37,50 +77,164 @@ class TripletDict:
         
         Example:
         [{"head_id": "HGNC:6483", "head": "LAMA3", "relation": "subclass of", "tail_id": "SO:0000704", "tail": "gene"}, ...]
-
-        The dictionary is built as a dictionary where each key is a tuple (head_id, relation) and the value is a set of tail ids.
-        These are used along with the entity dictionary represent the graph structure.
         """
 
         self.path_list = path_list
         logger.info('Triplets path: {}'.format(self.path_list))
-        self.relations = set()
-        self.hr2tails = {}
+        self.entity2idx = {}
+        relation2idx = {}
+        heads, relations, tails = [], [], []
         self.triplet_cnt = 0
 
         for path in self.path_list:
-            self._load(path)
+            examples = json.load(open(path, 'r', encoding='utf-8'))
+            for ex in examples:
+                head_idx = self.entity2idx.setdefault(ex['head_id'], len(self.entity2idx))
+                tail_idx = self.entity2idx.setdefault(ex['tail_id'], len(self.entity2idx))
+                relation = ex['relation']
+                # the reversed triplet, as in reverse_triplet
+                heads += [head_idx, tail_idx]
+                relations += [relation2idx.setdefault(relation, len(relation2idx)),
+                              relation2idx.setdefault('inverse {}'.format(relation), len(relation2idx))]
+                tails += [tail_idx, head_idx]
+            self.triplet_cnt = 2 * len(examples)
+
+        self.entity_ids = list(self.entity2idx)
+        # relation indices follow the sorted relation names
+        self.relations = sorted(relation2idx)
+        self.relation2idx = {relation: i for i, relation in enumerate(self.relations)}
+        self.num_relations = max(1, len(self.relations))
+        relation_map = np.array([self.relation2idx[relation] for relation in relation2idx], dtype=np.int64)
+
+        keys = np.array(heads, dtype=np.int64) * self.num_relations + relation_map[np.array(relations, dtype=np.int64)]
+        self.keys, self.offsets, self.tails = _build_csr(keys, np.array(tails, dtype=np.int64))
         logger.info('Triplet statistics: {} relations, {} triplets'.format(len(self.relations), self.triplet_cnt))
 
-    def _load(self, path: str):
-        """Load triplets from a file and build hr2tails dictionary.
-        hr2tails: {(head_id, relation): {tail_id1, tail_id2, ...}}"""
-        examples = json.load(open(path, 'r', encoding='utf-8'))
-        examples += [reverse_triplet(obj) for obj in examples]
-        for ex in examples:
-            self.relations.add(ex['relation'])
-            key = (ex['head_id'], ex['relation'])
-            if key not in self.hr2tails:
-                self.hr2tails[key] = set()
-            self.hr2tails[key].add(ex['tail_id'])
-        self.triplet_cnt = len(examples)
+    def entity_to_idx(self, entity_id: str) -> int:
+        """Index of an entity, -1 if it never occurs in the triplets."""
+        return self.entity2idx.get(entity_id, -1)
+
+    def relation_to_idx(self, relation: str) -> int:
+        """Index of a relation, -1 if it never occurs in the triplets."""
+        return self.relation2idx.get(relation, -1)
+
+    def __len__(self):
+        """Number of (head, relation) keys."""
+        return len(self.keys)
 
     def get_neighbors(self, h: str, r: str) -> set:
-        """Get neighbors of a head entity given a relation."""
-        return self.hr2tails.get((h, r), set())
+        """Get neighbors of a head entity given a relation, as a set of tail ids."""
+        return set(self.entity_ids[idx] for idx in self.get_tail_indices(self.entity_to_idx(h), self.relation_to_idx(r)).tolist())
+
+    def get_tail_indices(self, head_idx: int, relation_idx: int) -> np.ndarray:
+        _, tails = self.lookup(np.array([head_idx]), np.array([relation_idx]))
+        return tails
+
+    def count_tails(self, head_idxs: np.ndarray, relation_idxs: np.ndarray) -> np.ndarray:
+        """Number of known tails of every query."""
+        starts, ends = _csr_ranges(self.keys, self.offsets, self.num_relations, head_idxs, relation_idxs)
+        return ends - starts
+
+    def lookup(self, head_idxs: np.ndarray, relation_idxs: np.ndarray) -> tuple:
+        """Bulk lookup for a block of queries, see TailCSR.lookup."""
+        return _csr_lookup(self.keys, self.offsets, self.tails, self.num_relations, head_idxs, relation_idxs)
+
+    def contains(self, head_idxs: np.ndarray, relation_idxs: np.ndarray, tail_idxs: np.ndarray) -> np.ndarray:
+        """Batched membership test: whether (head_idxs[i], relation_idxs[i], tail_idxs[i]) is a known triplet."""
+        starts, ends = _csr_ranges(self.keys, self.offsets, self.num_relations, head_idxs, relation_idxs)
+        tail_idxs = np.asarray(tail_idxs, dtype=np.int64)
+        # binary search of every tail inside the sorted tail slice of its own query, all queries at once
+        lo, hi = starts.copy(), ends.copy()
+        active = lo < hi
+        while active.any():
+            mid = (lo + hi) // 2
+            go_right = active & (self.tails[np.minimum(mid, len(self.tails) - 1)] < tail_idxs)
+            lo = np.where(go_right, mid + 1, lo)
+            hi = np.where(active & ~go_right, mid, hi)
+            active = lo < hi
+        found = lo < ends
+        found[found] = self.tails[lo[found]] == tail_idxs[found]
+        return found & (tail_idxs >= 0)
+
+    def to_arrays(self) -> dict:
+        """CSR arrays and string tables of entity ids and relations, see snapshot.load_or_build."""
+        arrays = {'keys': self.keys, 'offsets': self.offsets, 'tails': self.tails,
+                  'triplet_cnt': np.array(self.triplet_cnt, dtype=np.int64)}
+        for name, strings in [('entity_ids', self.entity_ids), ('relations', self.relations), ('path_list', self.path_list)]:
+            table = encode_strings(strings)
+            arrays[name + '_offsets'], arrays[name + '_blob'] = table['offsets'], table['blob']
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: dict):
+        """The CSR arrays stay memory-mapped, only the string tables are decoded."""
+        triplet_dict = cls.__new__(cls)
+        triplet_dict.entity_ids = decode_strings(arrays['entity_ids_offsets'], arrays['entity_ids_blob'])
+        triplet_dict.entity2idx = {entity_id: i for i, entity_id in enumerate(triplet_dict.entity_ids)}
+        triplet_dict.relations = decode_strings(arrays['relations_offsets'], arrays['relations_blob'])
+        triplet_dict.relation2idx = {relation: i for i, relation in enumerate(triplet_dict.relations)}
+        triplet_dict.num_relations = max(1, len(triplet_dict.relations))
+        triplet_dict.path_list = decode_strings(arrays['path_list_offsets'], arrays['path_list_blob'])
+        triplet_dict.triplet_cnt = int(arrays['triplet_cnt'])
+        triplet_dict.keys, triplet_dict.offsets, triplet_dict.tails = arrays['keys'], arrays['offsets'], arrays['tails']
+        logger.info('Triplet statistics: {} relations, {} triplets'.format(len(triplet_dict.relations),
+                                                                             triplet_dict.triplet_cnt))
+        return triplet_dict
+
+
+def _build_csr(keys: np.ndarray, tails: np.ndarray) -> tuple:
+    # unique sorted keys, offsets and per-key sorted unique tails of (key, tail) pairs
+    order = np.lexsort((tails, keys))
+    keys, tails = keys[order], tails[order]
+    if len(keys) > 0:
+        is_new = np.ones(len(keys), dtype=bool)
+        is_new[1:] = (keys[1:] != keys[:-1]) | (tails[1:] != tails[:-1])
+        keys, tails = keys[is_new], tails[is_new]
+    unique_keys, counts = np.unique(keys, return_counts=True)
+    offsets = np.zeros(len(unique_keys) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    return unique_keys, offsets, tails
+
+
+def _csr_ranges(keys: np.ndarray, offsets: np.ndarray, num_relations: int,
+                head_idxs: np.ndarray, relation_idxs: np.ndarray) -> tuple:
+    # start and end offsets of the tails of every query, empty for unknown queries
+    head_idxs, relation_idxs = np.asarray(head_idxs, dtype=np.int64), np.asarray(relation_idxs, dtype=np.int64)
+    if len(keys) == 0:
+        return np.zeros(len(head_idxs), dtype=np.int64), np.zeros(len(head_idxs), dtype=np.int64)
+    query_keys = head_idxs * num_relations + relation_idxs
+    positions = np.minimum(np.searchsorted(keys, query_keys), len(keys) - 1)
+    found = (head_idxs >= 0) & (relation_idxs >= 0) & (keys[positions] == query_keys)
+    starts = np.where(found, offsets[positions], 0)
+    return starts, np.where(found, offsets[positions + 1], 0)
+
+
+def _csr_lookup(keys: np.ndarray, offsets: np.ndarray, tails: np.ndarray, num_relations: int,
+                head_idxs: np.ndarray, relation_idxs: np.ndarray) -> tuple:
+    starts, ends = _csr_ranges(keys, offsets, num_relations, head_idxs, relation_idxs)
+    counts = ends - starts
+    rows = np.repeat(np.arange(len(counts)), counts)
+    # position of every output element inside its own query's tail slice
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, tails[np.repeat(starts, counts) + within]
 
 
 class EntityDict:
-    """EntityDict.entity_exs is a list of EntityExample objects.
+    """EntityDict.entity_exs is a sequence of EntityExample objects.
        Allows lookup of entities by id, index, or value (EntityExample object).
        
        EntityExample is a dataclass with fields entity_id, entity, entity_desc.
+       Ids, names and descriptions are kept in the string tables ids, names and descs,
+       EntityExample objects are created on access and changes to them are not kept.
        
        Initialize as EntityDict(entity_dict_dir=<directory containing 'entities.json' file>) OR
 
        
        Example of 'entities.json': [{"entity_id": "MONDO:0002974", "entity": "cervical cancer", "entity_desc": "A primary or metastatic malignant neoplasm involving the cervix."}, ...]"""
 
+    # bumped whenever to_arrays changes, older snapshots are rebuilt
+    snapshot_version = 1
+
     def __init__(self, entity_dict_dir: str = None, entity_dict_json: str = None, inductive_test_path: str = None):
         """entity_dict_dir: directory containing 'entities.json' file describing entities.
         Each entity should have 'entity_id', 'entity', 'entity_desc' keys.
@@ -98,7 +252,7 @@ class EntityDict:
             path = os.path.join(entity_dict_dir, 'entities.json')
 
         assert os.path.exists(path)
-        self.entity_exs = [EntityExample(**obj) for obj in json.load(open(path, 'r', encoding='utf-8'))]
+        objs = json.load(open(path, 'r', encoding='utf-8'))
 
 
         if inductive_test_path:
@@ -107,13 +261,40 @@ class EntityDict:
             for ex in examples:
                 valid_entity_ids.add(ex['head_id'])
                 valid_entity_ids.add(ex['tail_id'])
-            self.entity_exs = [ex for ex in self.entity_exs if ex.entity_id in valid_entity_ids]
-
-        # build index
-        # entity_id -> entity_example
-        self.id2entity = {ex.entity_id: ex for ex in self.entity_exs}
-        self.entity2idx = {ex.entity_id: i for i, ex in enumerate(self.entity_exs)}
-        logger.info('Load {} entities from {}'.format(len(self.id2entity), path))
+            objs = [obj for obj in objs if obj['entity_id'] in valid_entity_ids]
+
+        # a very small fraction of entities in wiki5m have no name, stored as empty strings
+        self.ids = StringTable.from_strings([obj['entity_id'] for obj in objs])
+        self.names = StringTable.from_strings([obj['entity'] or '' for obj in objs])
+        self.descs = StringTable.from_strings([obj.get('entity_desc') or '' for obj in objs])
+        del objs
+        self._build_index()
+        logger.info('Load {} entities from {}'.format(len(self), path))
+
+    def _build_index(self):
+        # entity_id -> index, the only per-entity Python objects
+        self.entity2idx = {entity_id: i for i, entity_id in enumerate(self.ids.to_list())}
+
+    def to_arrays(self) -> dict:
+        """String tables of entity ids, names and descriptions, see snapshot.load_or_build."""
+        arrays = {}
+        for field, table in [('entity_id', self.ids), ('entity', self.names), ('entity_desc', self.descs)]:
+            arrays[field + '_offsets'], arrays[field + '_blob'] = table.offsets, table.blob
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: dict):
+        """The string tables stay memory-mapped, only the ids are decoded for the index."""
+        entity_dict = cls.__new__(cls)
+        entity_dict.ids, entity_dict.names, entity_dict.descs = [
+            StringTable(arrays[field + '_offsets'], arrays[field + '_blob']) for field in ['entity_id', 'entity', 'entity_desc']]
+        entity_dict._build_index()
+        logger.info('Load {} entities from snapshot'.format(len(entity_dict)))
+        return entity_dict
+
+    @property
+    def entity_exs(self) -> Sequence:
+        return _EntityExamples(self)
 
     def entity_to_idx(self, entity_id: str) -> int:
         """Get the index of an entity given its id from the dictionary."""
@@ -121,31 +302,100 @@ class EntityDict:
 
     def get_entity_by_id(self, entity_id: str) -> EntityExample:
         """Get an entity given its id from the dictionary."""
-        return self.id2entity[entity_id]
+        return self.get_entity_by_idx(self.entity2idx[entity_id])
 
 
     def get_entity_by_idx(self, idx: int) -> EntityExample:
         """Get an entity given its index from the dictionary."""
-        return self.entity_exs[idx]
+        return EntityExample(entity_id=self.ids[idx], entity=self.names[idx], entity_desc=self.descs[idx])
 
     def __len__(self):
-        return len(self.entity_exs)
+        return len(self.ids)
     
     def to_pandas(self):
+        # pandas is slow to import and only needed here
+        import pandas as pd
         return pd.DataFrame([ex.__dict__ for ex in self.entity_exs])
     
-    def dump_json(self, path):
+    def dump_json(self, path, entity_exs: List[EntityExample] = None):
+        """entity_exs defaults to the entities of this dictionary, pass a list to keep changes made to them."""
+        entity_exs = self.entity_exs if entity_exs is None else entity_exs
         with open(path, 'w', encoding='utf-8') as f:
-            json.dump([ex.__dict__ for ex in self.entity_exs], f, ensure_ascii=False, indent=4)
+            json.dump([ex.__dict__ for ex in entity_exs], f, ensure_ascii=False, indent=4)
+
+
+class _EntityExamples(Sequence):
+    # read-only view of the entities of an EntityDict, slices are lists
+
+    def __init__(self, entity_dict: EntityDict):
+        self.entity_dict = entity_dict
+
+    def __len__(self):
+        return len(self.entity_dict)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.entity_dict.get_entity_by_idx(i) for i in range(*idx.indices(len(self)))]
+        return self.entity_dict.get_entity_by_idx(idx)
+
+    def __iter__(self):
+        return (self.entity_dict.get_entity_by_idx(i) for i in range(len(self)))
+
+
+class TailCSR:
+    """Compressed sparse row view of a TripletDict in the index space of an EntityDict:
+       for every (head_idx, relation_idx) key, the entity indices of all known tails.
+
+       Keys are sorted int64 composites head_idx * num_relations + relation_idx, and
+       tails[offsets[i]:offsets[i + 1]] are the tail indices of keys[i].
+       Entities that are not in the EntityDict (e.g. in the inductive setting) are skipped.
+
+       Initialize with TailCSR(triplet_dict, entity_dict); build it once and reuse it for both
+       evaluation directions, since TripletDict already holds the reversed triplets."""
+
+    def __init__(self, triplet_dict: TripletDict, entity_dict: EntityDict):
+        self.relation2idx = triplet_dict.relation2idx
+        self.num_relations = triplet_dict.num_relations
+
+        # triplet dict entity index -> entity dict index, -1 if missing
+        entity_map = np.array([entity_dict.entity2idx.get(entity_id, -1) for entity_id in triplet_dict.entity_ids],
+                              dtype=np.int64)
+        counts = np.diff(triplet_dict.offsets)
+        heads = np.repeat(triplet_dict.keys // self.num_relations, counts)
+        relations = np.repeat(triplet_dict.keys % self.num_relations, counts)
+        heads, tails = entity_map[heads], entity_map[np.asarray(triplet_dict.tails)]
+        valid = (heads >= 0) & (tails >= 0)
+
+        self.keys, self.offsets, self.tails = _build_csr(heads[valid] * self.num_relations + relations[valid], tails[valid])
+        logger.info('Build tail CSR with {} (head, relation) keys and {} tails'.format(len(self.keys), len(self.tails)))
+
+    def relation_to_idx(self, relation: str) -> int:
+        """Index of a relation, -1 if it never occurs in the triplets."""
+        return self.relation2idx.get(relation, -1)
+
+    def get_tail_indices(self, head_idx: int, relation_idx: int) -> np.ndarray:
+        _, tails = self.lookup(np.array([head_idx]), np.array([relation_idx]))
+        return tails
+
+    def lookup(self, head_idxs: np.ndarray, relation_idxs: np.ndarray) -> tuple:
+        """Bulk lookup for a block of queries. Returns (rows, tails), where tails[i] is a known tail
+        of query rows[i]; queries with a negative head or relation index have no tails."""
+        return _csr_lookup(self.keys, self.offsets, self.tails, self.num_relations, head_idxs, relation_idxs)
 
 
 class LinkGraph:
-    """LinkGraph.graph looks like {"HGNC:6483": {"SO:0000704", ...}, "SO:0000704": {"HGNC:6483", ...}, ...}
+    """Undirected neighbors of every entity in the training triplets.
     
        Initialize with LinkGraph(train_path="file.json")
        
        Where 'file.json' looks like:
-       [{"head_id": "HGNC:6483", "head": "LAMA3", "relation": "subclass of", "tail_id": "SO:0000704", "tail": "gene"}, ...]"""
+       [{"head_id": "HGNC:6483", "head": "LAMA3", "relation": "subclass of", "tail_id": "SO:0000704", "tail": "gene"}, ...]
+
+       Node ids are kept in the string table node_ids with the index node2idx, and
+       neighbors[offsets[i]:offsets[i + 1]] are the node indices of the neighbors of node i in sorted id order."""
+
+    # bumped whenever to_arrays changes, older snapshots are rebuilt
+    snapshot_version = 2
 
     def __init__(self, train_path: str):
         """train_path: path to a file containing triplets.
@@ -153,34 +403,56 @@ class LinkGraph:
         
         Example:
         [{"head_id": "HGNC:6483", "head": "LAMA3", "relation": "subclass of", "tail_id": "SO:0000704", "tail": "gene"}, ...]
-        
-        The graph is built as a dictionary where each key is an entity id and the value is a set of neighbor entity ids. Example:
-        {
-            "HGNC:6483": {"SO:0000704", ...},
-            "SO:0000704": {"HGNC:6483", ...},
-            ...
-        }
         """
         logger.info('Start to build link graph from {}'.format(train_path))
-        # id -> set(id)
-        self.graph = {}
+        self.node2idx = {}
+        heads, tails = [], []
         examples = json.load(open(train_path, 'r', encoding='utf-8'))
         for ex in examples:
-            head_id, tail_id = ex['head_id'], ex['tail_id']
-            if head_id not in self.graph:
-                self.graph[head_id] = set()
-            self.graph[head_id].add(tail_id)
-            if tail_id not in self.graph:
-                self.graph[tail_id] = set()
-            self.graph[tail_id].add(head_id)
-        logger.info('Done build link graph with {} nodes'.format(len(self.graph)))
+            heads.append(self.node2idx.setdefault(ex['head_id'], len(self.node2idx)))
+            tails.append(self.node2idx.setdefault(ex['tail_id'], len(self.node2idx)))
+        del examples
+        node_ids = list(self.node2idx)
+        self.node_ids = StringTable.from_strings(node_ids)
+
+        # neighbors are sorted by the rank of their ids, so that get_neighbor_ids returns the first ones without sorting
+        by_rank = np.array(sorted(range(len(node_ids)), key=node_ids.__getitem__), dtype=np.int64)
+        ranks = np.zeros(len(node_ids), dtype=np.int64)
+        ranks[by_rank] = np.arange(len(node_ids))
+        heads, tails = np.array(heads, dtype=np.int64), np.array(tails, dtype=np.int64)
+        # every node has a neighbor, so the CSR keys are all node indices
+        _, self.offsets, neighbor_ranks = _build_csr(np.concatenate([heads, tails]), ranks[np.concatenate([tails, heads])])
+        self.neighbors = by_rank[neighbor_ranks]
+        logger.info('Done build link graph with {} nodes'.format(len(self)))
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def to_arrays(self) -> dict:
+        """CSR arrays and the string table of node ids, see snapshot.load_or_build."""
+        return {'node_ids_offsets': self.node_ids.offsets, 'node_ids_blob': self.node_ids.blob,
+                'neighbors': self.neighbors, 'offsets': self.offsets}
+
+    @classmethod
+    def from_arrays(cls, arrays: dict):
+        link_graph = cls.__new__(cls)
+        link_graph.node_ids = StringTable(arrays['node_ids_offsets'], arrays['node_ids_blob'])
+        link_graph.node2idx = {entity_id: i for i, entity_id in enumerate(link_graph.node_ids.to_list())}
+        link_graph.neighbors, link_graph.offsets = arrays['neighbors'], arrays['offsets']
+        logger.info('Load link graph with {} nodes from snapshot'.format(len(link_graph)))
+        return link_graph
+
+    def _neighbor_indices(self, node_idx: int) -> np.ndarray:
+        return self.neighbors[int(self.offsets[node_idx]):int(self.offsets[node_idx + 1])]
 
     def get_neighbor_ids(self, entity_id: str, max_to_keep=10) -> List[str]:
         """Get neighbors of a given entity id. Return at most max_to_keep neighbors.
-        If the number of neighbors exceeds max_to_keep, return the first max_to_keep neighbors."""
+        If the number of neighbors exceeds max_to_keep, return the first max_to_keep neighbors in sorted id order."""
         # make sure different calls return the same results
-        neighbor_ids = self.graph.get(entity_id, set())
-        return sorted(list(neighbor_ids))[:max_to_keep]
+        node_idx = self.node2idx.get(entity_id, -1)
+        if node_idx < 0:
+            return []
+        return [self.node_ids[idx] for idx in self._neighbor_indices(node_idx)[:max_to_keep].tolist()]
 
     def get_n_hop_entity_indices(self, entity_id: str,
                                  entity_dict: EntityDict,
@@ -202,20 +474,22 @@ class LinkGraph:
         if n_hop < 0:
             return set()
 
-        seen_eids = set()
-        seen_eids.add(entity_id)
-        queue = deque([entity_id])
+        start = self.node2idx.get(entity_id, -1)
+        if start < 0:
+            return {entity_dict.entity_to_idx(entity_id)}
+        seen = {start}
+        queue = deque([start])
         for i in range(n_hop):
             len_q = len(queue)
             for _ in range(len_q):
                 tp = queue.popleft()
-                for node in self.graph.get(tp, set()):
-                    if node not in seen_eids:
+                for node in self._neighbor_indices(tp).tolist():
+                    if node not in seen:
                         queue.append(node)
-                        seen_eids.add(node)
-                        if len(seen_eids) > max_nodes:
+                        seen.add(node)
+                        if len(seen) > max_nodes:
                             return set()
-        return set([entity_dict.entity_to_idx(e_id) for e_id in seen_eids])
+        return set([entity_dict.entity_to_idx(self.node_ids[node]) for node in seen])
 
 
 def reverse_triplet(obj):
@@ -1,52 +1,78 @@
 import torch
 
+import numpy as np
+
 from typing import List
 
-from config import args
-from dict_hub import get_train_triplet_dict, get_entity_dict, EntityDict, TripletDict
+from dict_hub import get_context, RuntimeContext
+
+
+def example_indices(exs: List, ctx: RuntimeContext = None) -> tuple:
+    """(head_idxs, relation_idxs, tail_idxs) LongTensors of examples, the index tensors of collated batches.
+    Heads and tails index the entity_dict, empty head ids are -1. Relations index the train_triplet_dict,
+    -1 if the relation has no training triplets and in test mode, where the train_triplet_dict is not loaded."""
+    ctx = ctx or get_context()
+    entity2idx = ctx.entity_dict.entity2idx
+    head_idxs = torch.LongTensor([entity2idx[ex.head_id] if ex.head_id else -1 for ex in exs])
+    tail_idxs = torch.LongTensor([entity2idx[ex.tail_id] for ex in exs])
+    if ctx.args.is_test:
+        relation_idxs = torch.full((len(exs),), -1, dtype=torch.long)
+    else:
+        relation_idxs = torch.LongTensor([ctx.train_triplet_dict.relation_to_idx(ex.relation) for ex in exs])
+    return head_idxs, relation_idxs, tail_idxs
 
-entity_dict: EntityDict = get_entity_dict()
-train_triplet_dict: TripletDict = get_train_triplet_dict() if not args.is_test else None
 
+def _to_train_triplet_idxs(entity_idxs: torch.tensor, ctx: RuntimeContext) -> np.ndarray:
+    entity_idxs = entity_idxs.numpy()
+    return np.where(entity_idxs >= 0, ctx.train_entity_map[entity_idxs], -1)
 
-def construct_mask(row_exs: List, col_exs: List = None) -> torch.tensor:
-    positive_on_diagonal = col_exs is None
-    num_row = len(row_exs)
-    col_exs = row_exs if col_exs is None else col_exs
-    num_col = len(col_exs)
+
+def construct_mask_by_indices(head_idxs: torch.tensor, relation_idxs: torch.tensor, tail_idxs: torch.tensor,
+                              col_tail_idxs: torch.tensor = None, ctx: RuntimeContext = None) -> torch.tensor:
+    """Triplet mask of rows (head_idxs, relation_idxs, tail_idxs) against the tails col_tail_idxs,
+    the tails of the rows themselves by default, in the index spaces of example_indices.
+    False where a column tail is a known training tail of a row other than its own positive."""
+    ctx = ctx or get_context()
+    train_triplet_dict = ctx.train_triplet_dict
+    positive_on_diagonal = col_tail_idxs is None
+    col_tail_idxs = tail_idxs if positive_on_diagonal else col_tail_idxs
+    num_col = len(col_tail_idxs)
 
     # exact match
-    row_entity_ids = torch.LongTensor([entity_dict.entity_to_idx(ex.tail_id) for ex in row_exs])
-    col_entity_ids = row_entity_ids if positive_on_diagonal else \
-        torch.LongTensor([entity_dict.entity_to_idx(ex.tail_id) for ex in col_exs])
     # num_row x num_col
-    triplet_mask = (row_entity_ids.unsqueeze(1) != col_entity_ids.unsqueeze(0))
+    triplet_mask = (tail_idxs.unsqueeze(1) != col_tail_idxs.unsqueeze(0))
+
+    # mask out other possible neighbors, one batched membership test for all rows with more than one known tail,
+    # exact match is enough for the others
+    triplet_head_idxs = _to_train_triplet_idxs(head_idxs, ctx)
+    relation_idxs = relation_idxs.numpy()
+    rows = np.nonzero(train_triplet_dict.count_tails(triplet_head_idxs, relation_idxs) > 1)[0]
+    if len(rows) > 0:
+        col_triplet_tail_idxs = _to_train_triplet_idxs(col_tail_idxs, ctx)
+        is_neighbor = train_triplet_dict.contains(np.repeat(triplet_head_idxs[rows], num_col),
+                                                  np.repeat(relation_idxs[rows], num_col),
+                                                  np.tile(col_triplet_tail_idxs, len(rows)))
+        triplet_mask[torch.from_numpy(rows)] &= ~torch.from_numpy(is_neighbor.reshape(len(rows), num_col))
+
     if positive_on_diagonal:
         triplet_mask.fill_diagonal_(True)
+    return triplet_mask
 
-    # mask out other possible neighbors
-    for i in range(num_row):
-        head_id, relation = row_exs[i].head_id, row_exs[i].relation
-        neighbor_ids = train_triplet_dict.get_neighbors(head_id, relation)
-        # exact match is enough, no further check needed
-        if len(neighbor_ids) <= 1:
-            continue
-
-        for j in range(num_col):
-            if i == j and positive_on_diagonal:
-                continue
-            tail_id = col_exs[j].tail_id
-            if tail_id in neighbor_ids:
-                triplet_mask[i][j] = False
 
-    return triplet_mask
+def construct_self_negative_mask_by_indices(head_idxs: torch.tensor, relation_idxs: torch.tensor,
+                                            ctx: RuntimeContext = None) -> torch.tensor:
+    ctx = ctx or get_context()
+    triplet_head_idxs = _to_train_triplet_idxs(head_idxs, ctx)
+    # the head is a known tail of its own (head, relation)
+    return torch.from_numpy(~ctx.train_triplet_dict.contains(triplet_head_idxs, relation_idxs.numpy(), triplet_head_idxs))
+
+
+def construct_mask(row_exs: List, col_exs: List = None, ctx: RuntimeContext = None) -> torch.tensor:
+    head_idxs, relation_idxs, tail_idxs = example_indices(row_exs, ctx=ctx)
+    col_tail_idxs = None if col_exs is None else example_indices(col_exs, ctx=ctx)[2]
+    return construct_mask_by_indices(head_idxs, relation_idxs, tail_idxs, col_tail_idxs=col_tail_idxs, ctx=ctx)
 
 
-def construct_self_negative_mask(exs: List) -> torch.tensor:
-    mask = torch.ones(len(exs))
-    for idx, ex in enumerate(exs):
-        head_id, relation = ex.head_id, ex.relation
-        neighbor_ids = train_triplet_dict.get_neighbors(head_id, relation)
-        if head_id in neighbor_ids:
-            mask[idx] = 0
-    return mask.bool()
+def construct_self_negative_mask(exs: List, ctx: RuntimeContext = None) -> torch.tensor:
+    head_idxs, relation_idxs, _ = example_indices(exs, ctx=ctx)
+    return construct_self_negative_mask_by_indices(head_idxs, relation_idxs, ctx=ctx)
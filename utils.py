@@ -2,9 +2,13 @@ import os
 import glob
 import torch
 import shutil
+import threading
 
 import numpy as np
 import torch.nn as nn
+import torch.utils.data
+
+from typing import List, Tuple, Callable
 
 from logger_config import logger
 
@@ -13,18 +17,79 @@ class AttrDict:
     pass
 
 
-def save_checkpoint(state: dict, is_best: bool, filename: str):
-    torch.save(state, filename)
-    if is_best:
-        shutil.copyfile(filename, os.path.dirname(filename) + '/model_best.mdl')
-    shutil.copyfile(filename, os.path.dirname(filename) + '/model_last.mdl')
+def snapshot_to_cpu(obj):
+    """Copy of a (nested) state with every tensor cloned to CPU memory, later updates of the originals,
+    e.g. by the next optimizer step, do not show up in the copy."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return {key: snapshot_to_cpu(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [snapshot_to_cpu(x) for x in obj]
+    elif isinstance(obj, tuple):
+        return tuple(snapshot_to_cpu(x) for x in obj)
+    else:
+        return obj
+
+
+def link_or_copy(src: str, dst: str):
+    # atomically point dst at the content of src, with a hardlink if the filesystem supports it
+    tmp = dst + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class CheckpointWriter:
+    """Writes checkpoints on a background thread. save() snapshots the states to CPU memory and returns,
+    it only blocks while the previous save is still in flight. Every file is written under a temporary name
+    and renamed, so a crash never leaves a truncated checkpoint behind."""
+
+    def __init__(self):
+        self.thread: threading.Thread = None
+        self.error: Exception = None
+
+    def save(self, jobs: List[Tuple[dict, str, List[str]]], after_write: Callable = None):
+        """jobs are (state, filename, link names) triples, link names are hardlinked to filename once it
+        is written. after_write runs on the writer thread once all jobs are done, e.g. to rotate old files."""
+        self.wait()
+        jobs = [(snapshot_to_cpu(state), filename, link_names) for state, filename, link_names in jobs]
+        self.thread = threading.Thread(target=self._write, args=(jobs, after_write))
+        self.thread.start()
+
+    def _write(self, jobs: List[Tuple[dict, str, List[str]]], after_write: Callable = None):
+        try:
+            for state, filename, link_names in jobs:
+                torch.save(state, filename + '.tmp')
+                os.replace(filename + '.tmp', filename)
+                for link_name in link_names:
+                    link_or_copy(filename, link_name)
+            if after_write is not None:
+                after_write()
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
 
 
 def delete_old_ckt(path_pattern: str, keep=5):
     files = sorted(glob.glob(path_pattern), key=os.path.getmtime, reverse=True)
     for f in files[keep:]:
         logger.info('Delete old checkpoint {}'.format(f))
-        os.system('rm -f {}'.format(f))
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
 
 
 def report_num_trainable_parameters(model: torch.nn.Module) -> int:
@@ -44,7 +109,9 @@ def get_model_obj(model: nn.Module):
     return model.module if hasattr(model, "module") else model
 
 
-def move_to_cuda(sample):
+def move_to_cuda(sample, cpu_keys: List[str] = ()):
+    """Tensors of sample on the current GPU, except the values of the top-level keys cpu_keys of a dict,
+    e.g. doc.BATCH_CPU_KEYS of batches, which are read on the CPU without waiting for the GPU."""
     if len(sample) == 0:
         return {}
 
@@ -60,31 +127,70 @@ def move_to_cuda(sample):
         else:
             return maybe_tensor
 
+    if isinstance(sample, dict):
+        return {key: value if key in cpu_keys else _move_to_cuda(value) for key, value in sample.items()}
     return _move_to_cuda(sample)
 
 
+class ResumableRandomSampler(torch.utils.data.Sampler):
+    """Shuffles like RandomSampler, but the permutation of an epoch only depends on (seed, epoch),
+    so a preempted epoch can be continued at any position: set_epoch(epoch, start) skips the first start indices."""
+
+    def __init__(self, num_samples: int, seed: int):
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch: int, start: int = 0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return iter(torch.randperm(self.num_samples, generator=generator)[self.start:].tolist())
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
 class AverageMeter(object):
-    """Computes and stores the average and current value"""
+    """Computes and stores the average and current value.
+    Tensor values are accumulated on their own device without synchronization,
+    they are only copied to the host when val / avg are read."""
     def __init__(self, name, fmt=':f'):
         self.name = name
         self.fmt = fmt
         self.reset()
 
     def reset(self):
-        self.val = 0
-        self.avg = 0
-        self.sum = 0
+        self._val = 0
+        self._sum = 0
         self.count = 0
 
     def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
+        if isinstance(val, torch.Tensor):
+            val = val.detach().double()
+        self._val = val
+        self._sum = self._sum + val * n
         self.count += n
-        self.avg = self.sum / self.count
+
+    @property
+    def val(self) -> float:
+        return float(self._val)
+
+    @property
+    def sum(self) -> float:
+        return float(self._sum)
+
+    @property
+    def avg(self) -> float:
+        return self.sum / self.count if self.count > 0 else 0
 
     def __str__(self):
         fmtstr = '{name} {val' + self.fmt + '} ({avg' + self.fmt + '})'
-        return fmtstr.format(**self.__dict__)
+        return fmtstr.format(name=self.name, val=self.val, avg=self.avg)
 
 
 class ProgressMeter(object):